@@ -0,0 +1,151 @@
+import contextlib
+import sqlite3
+import time
+
+
+# Object detection work queue, kept in the same sqlite database as the locations, tags and file_tag tables.
+#
+# Each video is a row in detection_jobs. Workers claim a few at a time, which leases them for leaseSeconds. A worker
+# that dies or hangs loses its lease, and the jobs go back in the queue for someone else, up to maxAttempts times.
+# Several workers, on one machine or sharing the database file, can pull from the same queue.
+
+QUEUED = 0
+CLAIMED = 1
+DONE = 2
+FAILED = 3
+
+# file_tag.taggedBy for tags that came from object detection
+TAGGED_BY = 2
+
+
+class DetectionQueue:
+    schema = """
+        CREATE TABLE IF NOT EXISTS detection_jobs (
+            sha1 TEXT PRIMARY KEY,
+            path TEXT NOT NULL,
+            createdAt REAL NOT NULL,
+            status INTEGER NOT NULL DEFAULT 0,
+            worker TEXT,
+            leaseUntil REAL NOT NULL DEFAULT 0,
+            attempts INTEGER NOT NULL DEFAULT 0
+        );
+        -- Claiming takes the newest queued jobs, and expiring leases looks for old claimed ones
+        CREATE INDEX IF NOT EXISTS detection_jobs_queued ON detection_jobs (status, createdAt);
+        CREATE INDEX IF NOT EXISTS detection_jobs_lease ON detection_jobs (status, leaseUntil);
+        CREATE TABLE IF NOT EXISTS detection_queue_state (
+            name TEXT PRIMARY KEY,
+            value
+        );
+        -- Finished jobs update locations by sha1
+        CREATE INDEX IF NOT EXISTS locations_sha1 ON locations (sha1);
+    """
+
+    def __init__(self, path, worker, leaseSeconds=600, maxAttempts=3):
+        # We manage transactions ourselves, so claims can take the write lock up front with BEGIN IMMEDIATE
+        self.db = sqlite3.connect(path, timeout=60, isolation_level=None)
+        # Readers don't block the writer, and the other way around
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript(self.schema)
+        self.worker = worker
+        self.leaseSeconds = leaseSeconds
+        self.maxAttempts = maxAttempts
+        # Tag name to id. Loaded on first use
+        self.tags = None
+
+    @contextlib.contextmanager
+    def transaction(self):
+        self.db.execute('BEGIN IMMEDIATE')
+        try:
+            yield self.db
+        except:
+            self.db.execute('ROLLBACK')
+            raise
+        self.db.execute('COMMIT')
+
+    def enqueue(self, since):
+        # Queues videos that haven't been through object detection, created at or after the since timestamp.
+        # Only looks at locations rows added since the last call, so this stays quick as the table grows.
+        # Returns how many jobs were added
+        with self.transaction() as db:
+            row = db.execute("SELECT value FROM detection_queue_state WHERE name = 'lastLocation'").fetchone()
+            last = row[0] if row else 0
+            newest = db.execute('SELECT MAX(rowid) FROM locations').fetchone()[0] or 0
+            # A video can be in more than one location. The first one we see is the one we'll read
+            added = db.execute("""INSERT OR IGNORE INTO detection_jobs (sha1, path, createdAt)
+                SELECT sha1, path, fileCreatedAt FROM locations
+                WHERE rowid > ? AND rowid <= ? AND objectDetectionRanAt = 0 AND fileCreatedAt >= ?""", (last, newest, since)).rowcount
+            db.execute("REPLACE INTO detection_queue_state (name, value) VALUES ('lastLocation', ?)", (newest,))
+        return added
+
+    def claim(self, limit):
+        # Leases up to limit jobs to us, newest videos first. Returns [(path, sha1), ...]
+        now = time.time()
+        with self.transaction() as db:
+            # Jobs whose worker died or hung go back in the queue, unless they've had enough tries
+            db.execute('UPDATE detection_jobs SET status = CASE WHEN attempts >= ? THEN ? ELSE ? END, worker = NULL WHERE status = ? AND leaseUntil < ?', (self.maxAttempts, FAILED, QUEUED, CLAIMED, now))
+            rows = db.execute('SELECT path, sha1 FROM detection_jobs WHERE status = ? ORDER BY createdAt DESC LIMIT ?', (QUEUED, limit)).fetchall()
+            db.executemany('UPDATE detection_jobs SET status = ?, worker = ?, leaseUntil = ?, attempts = attempts + 1 WHERE sha1 = ?',
+                [(CLAIMED, self.worker, now + self.leaseSeconds, sha1) for path, sha1 in rows])
+        return rows
+
+    def renew(self, sha1s):
+        # Extends the lease on the jobs we're still working on. Call it well within leaseSeconds.
+        # Jobs we've given up on without calling release() are left to expire
+        leaseUntil = time.time() + self.leaseSeconds
+        with self.transaction() as db:
+            db.executemany('UPDATE detection_jobs SET leaseUntil = ? WHERE sha1 = ? AND status = ? AND worker = ?',
+                [(leaseUntil, sha1, CLAIMED, self.worker) for sha1 in sha1s])
+
+    def release(self, sha1s):
+        # Gives up on jobs now rather than when their lease runs out, for when a decoder crashed on them.
+        # The attempt still counts, so a video that crashes every time ends up failed
+        if not sha1s:
+            return
+        with self.transaction() as db:
+            db.executemany('UPDATE detection_jobs SET status = CASE WHEN attempts >= ? THEN ? ELSE ? END, worker = NULL WHERE sha1 = ? AND status = ? AND worker = ?',
+                [(self.maxAttempts, FAILED, QUEUED, sha1, CLAIMED, self.worker) for sha1 in sha1s])
+
+    def complete(self, results):
+        # Tags a batch of finished videos and marks them done, all in one transaction.
+        # results is [(sha1, classes, seconds), ...] where seconds is how long detection took
+        if not results:
+            return
+        now = time.time()
+        try:
+            with self.transaction() as db:
+                tagIds = self.tagIds(db, set(tfClass for sha1, classes, seconds in results for tfClass in classes))
+                db.executemany('REPLACE INTO file_tag (tagId,fileSha1,taggedBy) VALUES(?,?,?)',
+                    [(tagIds[tfClass], sha1, TAGGED_BY) for sha1, classes, seconds in results for tfClass in classes])
+                # update locations to signal we've run tensorflow on these files
+                db.executemany('UPDATE locations SET objectDetectionRanAt=?,objectDetectionRunSeconds=? WHERE sha1=?',
+                    [(now, seconds, sha1) for sha1, classes, seconds in results])
+                db.executemany('UPDATE detection_jobs SET status = ?, worker = NULL WHERE sha1 = ?',
+                    [(DONE, sha1) for sha1, classes, seconds in results])
+        except:
+            # Tags we created were rolled back, so the cache can't be trusted
+            self.tags = None
+            raise
+
+    def tagIds(self, db, names):
+        if self.tags is None:
+            self.tags = dict( (tag, tagId) for tagId, tag in db.execute('SELECT id, tag FROM tags') )
+        for name in names:
+            if name in self.tags:
+                continue
+            # Another worker may have created it since we loaded the cache
+            row = db.execute('SELECT id FROM tags WHERE tag=?', (name,)).fetchone()
+            if row:
+                self.tags[name] = row[0]
+            else:
+                print('Tag not found, pre-creating: %s' % (name,))
+                self.tags[name] = db.execute('INSERT INTO tags (tag) VALUES(?)', (name,)).lastrowid
+        return self.tags
+
+    def counts(self):
+        # Jobs in each status, for progress reports
+        names = {QUEUED: 'queued', CLAIMED: 'claimed', DONE: 'done', FAILED: 'failed'}
+        return dict( (names[status], count) for status, count in self.db.execute('SELECT status, COUNT(*) FROM detection_jobs GROUP BY status') )
+
+    def close(self):
+        self.db.close()
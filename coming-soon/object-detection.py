@@ -1,31 +1,44 @@
 import datetime
+import itertools
+import json
 import math
+import multiprocessing
 import numpy as np
 import os
 import pathlib
+import queue
 import re
 import six.moves.urllib as urllib
-import sys
+import socket
 import tarfile
-import tensorflow as tf
 import time
-import zipfile
 import cv2
-import sqlite3
 
-from collections import defaultdict
-from io import StringIO
-from matplotlib import pyplot as plt
-from PIL import Image
-from object_detection.utils import label_map_util
-from object_detection.utils import visualization_utils as vis_util
-
-
-# open sqlite3 database for indexing
-db = sqlite3.connect('/home/user/Documents/surveillance-videos/files.sqlite3')
-c = db.cursor()
-
-# TODO: test that cap didn't fail
+from detection_queue import DetectionQueue
+
+
+# Runs tensorflow object detection on videos that haven't been processed yet, and tags them in the database.
+#
+# Videos are decoded by a pool of processes, several files at a time. They only decode the frames we sample, and skip
+# the rest with grab(). Sampled frames from all of those files are batched together, so each sess.run() call
+# handles BATCH_SIZE images, with one session and graph for the whole run.
+#
+# Recordings from main.py have a .motion.json next to them, with the motion detector's score and the box around what
+# changed for each frame it checked. For those we only look at frames with motion, cropped to where the motion was and
+# scaled up to CROP_SIZE, so small or far away objects fill more of what the model sees. Older videos without one are
+# sampled at SAMPLES_PER_SECOND, full frame.
+#
+# Videos to check come from the job queue in detection_queue.py, so several copies of this script can share the work.
+
+DATABASE = '/home/user/Documents/surveillance-videos/files.sqlite3'
+# Videos created before this aren't queued
+QUEUE_SINCE = datetime.datetime(2020, 6, 20, tzinfo=datetime.timezone.utc).timestamp()
+# A job we haven't finished or renewed within this many seconds goes back in the queue for another worker
+LEASE_SECONDS = 600
+# Jobs that fail this many times (the worker crashed or hung) are marked failed rather than retried
+MAX_ATTEMPTS = 3
+# Finished videos are tagged in batches of this many, one transaction each
+COMMIT_BATCH = 50
 
 # What model to download.
 # Models can bee found here: https://github.com/tensorflow/models/blob/master/research/object_detection/g3doc/detection_model_zoo.md
@@ -42,175 +55,362 @@ PATH_TO_LABELS = os.path.join('data', 'mscoco_label_map.pbtxt')
 # Number of classes to detect
 NUM_CLASSES = 90
 
-
-# Download Model
-if not os.path.exists(os.path.join(os.getcwd(), MODEL_FILE)):
-    print("Downloading model")
-    opener = urllib.request.URLopener()
-    opener.retrieve(DOWNLOAD_BASE + MODEL_FILE, MODEL_FILE)
-    tar_file = tarfile.open(MODEL_FILE)
-    for file in tar_file.getmembers():
-        file_name = os.path.basename(file.name)
-        if 'frozen_inference_graph.pb' in file_name:
-            tar_file.extract(file, os.getcwd())
-
-
-# Load a (frozen) Tensorflow model into memory.
-detection_graph = tf.Graph()
-with detection_graph.as_default():
-    od_graph_def = tf.compat.v1.GraphDef()
-    with tf.io.gfile.GFile(PATH_TO_CKPT, 'rb') as fid:
-        serialized_graph = fid.read()
-        od_graph_def.ParseFromString(serialized_graph)
-        tf.import_graph_def(od_graph_def, name='')
-
-
-# Loading label map
-# Label maps map indices to category names, so that when our convolution network predicts `5`, we know that this corresponds to `airplane`.  Here we use internal utility functions, but anything that returns a dictionary mapping integers to appropriate string labels would be fine
-label_map = label_map_util.load_labelmap(PATH_TO_LABELS)
-categories = label_map_util.convert_label_map_to_categories(
-    label_map, max_num_classes=NUM_CLASSES, use_display_name=True)
-category_index = label_map_util.create_category_index(categories)
-
-
-# Helper code
-#def load_image_into_numpy_array(image):
-#    (im_width, im_height) = image.size
-#    return np.array(image.getdata()).reshape(
-#        (im_height, im_width, 3)).astype(np.uint8)
-
-snafu = datetime.datetime.utcnow()
-snafu = snafu - datetime.timedelta(hours=9)
-
-# Detection
-with detection_graph.as_default():
-
-
-    # fetch all videos from database
-    c = db.cursor()
-    c.execute("SELECT l.path,l.sha1 FROM locations AS l WHERE objectDetectionRanAt = 0 AND fileCreatedAt >= strftime('%s', '2020-06-20') ORDER by fileCreatedAt DESC")
-    #c.execute("SELECT l.path,l.sha1 FROM locations AS l WHERE fileCreatedAt >= strftime('%s', '2020-06-20') AND fileCreatedAt <= strftime('%s', '2020-07-11 18:00:00') ORDER by fileCreatedAt DESC")
-    files = c.fetchall()
-    for row in files:
-        fileSha1 = row[1]
-
+# How many frames per second of video we run detection on
+SAMPLES_PER_SECOND = 4
+# Images per sess.run(). Bigger batches keep the CPU/GPU busier, at the cost of memory
+BATCH_SIZE = 8
+# Processes decoding videos. Each works on one file at a time
+DECODERS = max(1, (os.cpu_count() or 2) - 1)
+# Decoded frames waiting for inference. Bounds memory when decoding is faster than detection
+MAX_QUEUED_FRAMES = BATCH_SIZE * 4
+# Detections below this score are ignored
+MIN_SCORE = 0.70
+# Frames with a motion score below this are skipped. The detector starts recording at 1
+MIN_MOTION_SCORE = 0.5
+# Size of the square that motion crops are resized to
+CROP_SIZE = 600
+# Added around each side of the motion box, as a fraction of its longest side, so we get the whole object
+CROP_MARGIN = 0.25
+# Smallest crop, in pixels of the recording. Anything smaller is mostly upscaling noise
+MIN_CROP = 300
+
+
+def fpsFor(path):
+    # TODO: parse fps from the video itself, rather than the filename
+    dims = re.search(r'(\d+)x(\d+)x(\d+)', path)
+    if dims:
+        return int(dims.group(3))
+    return 20
+
+
+def cropRegion(box, width, height):
+    # Square around the motion box, as fractions of the frame so it doesn't matter what size the decoder gets
+    x1, y1, x2, y2 = box
+    side = max(x2 - x1, y2 - y1)
+    side = max(MIN_CROP, side + 2 * side * CROP_MARGIN)
+    # Boxes wider or taller than the frame get squashed a little when resized
+    w = min(width, side)
+    h = min(height, side)
+    left = min(max(0, (x1 + x2 - w) / 2), width - w)
+    top = min(max(0, (y1 + y2 - h) / 2), height - h)
+    return (left / width, top / height, (left + w) / width, (top + h) / height)
+
+
+def motionFrames(path, fps):
+    # The frames worth checking, going by the .motion.json main.py writes next to each recording, as
+    # {frame index: region to crop}. None if there's no .motion.json
+    sidecar = os.path.splitext(path)[0] + '.motion.json'
+    if not os.path.exists(sidecar):
+        return None
+    with open(sidecar, 'r') as f:
+        motion = json.load(f)
+    # Samples are [seconds into the video, score, [x1, y1, x2, y2] or null if nothing changed]
+    samples = [sample for sample in motion['samples'] if sample[2] is not None]
+    picked = [sample for sample in samples if sample[1] >= MIN_MOTION_SCORE]
+    if not picked and samples:
+        # Nothing scored that high, so check the frame with the most motion rather than none at all
+        picked = [max(samples, key=lambda sample: sample[1])]
+    return dict( (round(seconds * fps), cropRegion(box, motion['width'], motion['height'])) for seconds, score, box in picked )
+
+
+def crop(image, region):
+    height, width = image.shape[0:2]
+    x1, y1, x2, y2 = region
+    cropped = image[round(y1 * height):round(y2 * height), round(x1 * width):round(x2 * width)]
+    if cropped.shape[0] < CROP_SIZE:
+        return cv2.resize(cropped, (CROP_SIZE, CROP_SIZE), interpolation=cv2.INTER_CUBIC)
+    return cv2.resize(cropped, (CROP_SIZE, CROP_SIZE), interpolation=cv2.INTER_AREA)
+
+
+def decode(tasks, frames, current):
+    # Runs in a decoder process. A task is (number, path, sha1, fps). Sends (sha1, index, image) for each frame we want,
+    # then (sha1, None, how many we sent) once the file is done. current is shared memory we set to the number of the
+    # task we're working on, so if we crash the main process knows which file did it
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+        number, path, sha1, fps = task
+        current.value = number
+        regions = motionFrames(path, fps)
+        skip = max(1, math.floor(fps / SAMPLES_PER_SECOND))
+
+        cap = cv2.VideoCapture(path)
+        if not cap.isOpened():
+            print('Failed to open %s' % (path,))
+        index = 0
+        sent = 0
+        ok = cap.isOpened()
+        # With motion regions, there's no need to read past the last one
+        last = max(regions, default=-1) if regions is not None else None
+        while ok and (last is None or index <= last):
+            if (regions is None and index % skip == 0) or (regions is not None and index in regions):
+                ok, image = cap.read()
+                if ok:
+                    if regions is not None:
+                        image = crop(image, regions[index])
+                    frames.put( (sha1, index, image) )
+                    sent += 1
+            else:
+                # Advances without decoding the frame into an image
+                ok = cap.grab()
+            if ok:
+                index += 1
+        cap.release()
+        frames.put( (sha1, None, sent) )
+
+
+def downloadModel():
+    if not os.path.exists(os.path.join(os.getcwd(), MODEL_FILE)):
+        print("Downloading model")
+        opener = urllib.request.URLopener()
+        opener.retrieve(DOWNLOAD_BASE + MODEL_FILE, MODEL_FILE)
+        tar_file = tarfile.open(MODEL_FILE)
+        for file in tar_file.getmembers():
+            file_name = os.path.basename(file.name)
+            if 'frozen_inference_graph.pb' in file_name:
+                tar_file.extract(file, os.getcwd())
+
+
+class ObjectDetection:
+    # Batches sampled frames from any number of files into sess.run() calls. Once all of a file's frames have been
+    # through detection, it's added to finished for tagging
+    def __init__(self):
+        # Imported here so decoder processes don't have to load tensorflow
+        import tensorflow as tf
+        from object_detection.utils import label_map_util
+        from object_detection.utils import visualization_utils as vis_util
+        self.vis_util = vis_util
+
+        # Load a (frozen) Tensorflow model into memory.
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            od_graph_def = tf.compat.v1.GraphDef()
+            with tf.io.gfile.GFile(PATH_TO_CKPT, 'rb') as fid:
+                serialized_graph = fid.read()
+                od_graph_def.ParseFromString(serialized_graph)
+                tf.import_graph_def(od_graph_def, name='')
+        self.sess = tf.compat.v1.Session(graph=self.graph)
+
+        # Resolve tensors once, instead of for every frame
+        self.image_tensor = self.graph.get_tensor_by_name('image_tensor:0')
+        self.outputs = [
+            self.graph.get_tensor_by_name('detection_boxes:0'),
+            self.graph.get_tensor_by_name('detection_scores:0'),
+            self.graph.get_tensor_by_name('detection_classes:0'),
+            self.graph.get_tensor_by_name('num_detections:0')
+        ]
+
+        # Loading label map
+        # Label maps map indices to category names, so that when our convolution network predicts `5`, we know that this corresponds to `airplane`.  Here we use internal utility functions, but anything that returns a dictionary mapping integers to appropriate string labels would be fine
+        label_map = label_map_util.load_labelmap(PATH_TO_LABELS)
+        categories = label_map_util.convert_label_map_to_categories(
+            label_map, max_num_classes=NUM_CLASSES, use_display_name=True)
+        self.category_index = label_map_util.create_category_index(categories)
+
+        # Files we're working on, by sha1
+        self.files = {}
+        # (sha1, classes, seconds) of files that are done but not yet saved to the database
+        self.finished = []
+        self.completed = 0
+        # Frames waiting for inference, grouped by shape since a batch must be all one size
+        self.batches = {}
+        self.inferred = 0
+        self.secondsInferring = 0.0
+
+    def track(self, sha1, path, task):
+        self.files[sha1] = {
+            'path': path,
+            'task': task,
+            'startedAt': None,
+            'pending': 0,
+            'frames': 0,
+            'decoded': False,
+            'classes': set()
+        }
+
+    def add(self, sha1, index, image):
+        f = self.files[sha1]
+        if f['startedAt'] is None:
+            f['startedAt'] = time.time()
+        f['pending'] += 1
+        batch = self.batches.setdefault(image.shape, [])
+        batch.append( (sha1, index, image) )
+        if len(batch) == BATCH_SIZE:
+            self.run(image.shape)
+
+    def decoded(self, sha1, frameCount):
+        f = self.files[sha1]
+        if f['startedAt'] is None:
+            f['startedAt'] = time.time()
+        f['decoded'] = True
+        f['frames'] = frameCount
+        if f['pending'] == 0:
+            self.complete(sha1)
+
+    def drop(self, sha1):
+        # Forgets a file we won't finish, along with any of its frames still waiting for a batch
+        self.files.pop(sha1)
+        for shape in list(self.batches):
+            self.batches[shape] = [frame for frame in self.batches[shape] if frame[0] != sha1]
+            if not self.batches[shape]:
+                del self.batches[shape]
+
+    def flush(self):
+        # Runs partial batches, for when the decoders can't keep up or are done
+        for shape in list(self.batches):
+            self.run(shape)
+
+    def run(self, shape):
+        batch = self.batches.pop(shape, [])
+        if not batch:
+            return
         st = time.time()
-
-        print('')
-        print('==== ==== ====')
-        print('')
-
-        # Define the video stream
-        #cap = cv2.VideoCapture(0)  # Change only if you have more than one webcams
-
-        # TODO: parse fps from filename
-        dims = re.search(r'(\d+)x(\d+)x(\d+)', row[0])
-        if dims:
-            fps = int(dims.group(3))
-            skip = math.floor(fps / 4)
-        else:
-            skip = math.floor(20 / 4)
-
-        cap = cv2.VideoCapture(row[0])
-        if not cap:
-            print('Failed to open %s' % (row[0],))
-            break
-        print('Opened and processing: %s' % row[0])
-        final_classes = set()
-
-        with tf.compat.v1.Session(graph=detection_graph) as sess:
-            #skipFrame = False
-            frameCount = 0
-            while True:
-                # Read frame from camera
-                ret, image_np = cap.read()
-                if ret == False:
-                    print('Done')
-                    cv2.destroyAllWindows()
-                    break
-
-                frameCount += 1
-                if frameCount < skip:
-                    continue
-                else:
-                    frameCount = 0
-
-
-                # Expand dimensions since the model expects images to have shape: [1, None, None, 3]
-                image_np_expanded = np.expand_dims(image_np, axis=0)
-                # Extract image tensor
-                image_tensor = detection_graph.get_tensor_by_name('image_tensor:0')
-                # Extract detection boxes
-                boxes = detection_graph.get_tensor_by_name('detection_boxes:0')
-                # Extract detection scores
-                scores = detection_graph.get_tensor_by_name('detection_scores:0')
-                # Extract detection classes
-                classes = detection_graph.get_tensor_by_name('detection_classes:0')
-                # Extract number of detectionsd
-                num_detections = detection_graph.get_tensor_by_name(
-                    'num_detections:0')
-                # Actual detection.
-                (boxes, scores, classes, num_detections) = sess.run(
-                    [boxes, scores, classes, num_detections],
-                    feed_dict={image_tensor: image_np_expanded})
+        # Actual detection, on the whole batch at once
+        (boxes, scores, classes, num_detections) = self.sess.run(
+            self.outputs,
+            feed_dict={self.image_tensor: np.stack([image for sha1, index, image in batch])})
+        self.secondsInferring += time.time() - st
+        self.inferred += len(batch)
+
+        for i, (sha1, index, image_np) in enumerate(batch):
+            f = self.files[sha1]
+            found = set()
+            for j in range(int(num_detections[i])):
+                if scores[i][j] > MIN_SCORE:
+                    found.add( self.category_index.get( classes[i][j] )['name'] )
+            new = found - f['classes']
+            if new:
                 # Visualization of the results of a detection.
-                vis_util.visualize_boxes_and_labels_on_image_array(
+                self.vis_util.visualize_boxes_and_labels_on_image_array(
                     image_np,
-                    np.squeeze(boxes),
-                    np.squeeze(classes).astype(np.int32),
-                    np.squeeze(scores),
-                    category_index,
+                    boxes[i],
+                    classes[i].astype(np.int32),
+                    scores[i],
+                    self.category_index,
                     use_normalized_coordinates=True,
                     line_thickness=8)
-
-                p = pathlib.PurePath(row[0])
-                i = 0
-                while i < len(classes[0]):
-                    tfClassId = classes[0][i]
-                    if scores[0][i] > 0.70:
-                        className = category_index.get( tfClassId )['name']
-                        # if not already in final_classes, save snapshot of frame with detection
-                        if className not in final_classes:
-                            # save image_np
-                            imagePath = "%s/%s_%s.jpg" % (p.parent, p.stem, className)
-                            cv2.imwrite(imagePath, image_np)
-
-                            final_classes.add(className)
-                    i = i + 1
-
-                # Display output
-                #cv2.imshow('object detection', cv2.resize(image_np, (1024, 768))) #800, 600)))
-
-                #if cv2.waitKey(25) & 0xFF == ord('q'):
-                #    cv2.destroyAllWindows()
-                #    break
-            # end frame loop
-
-        # tag video with any classes we found
-        print(final_classes)
-
-        d = db.cursor()
-
-        for tfClass in final_classes:
-            # make sure tag exists in tags table
-            d.execute('SELECT id FROM tags WHERE tag=?', (tfClass,))
-            tag = d.fetchone()
-            if tag:
-                tagId = tag[0]
-            else:
-                print('Tag not found, pre-creating: %s' % (tfClass,))
-                d.execute('INSERT INTO tags (tag) VALUES(?)', (tfClass,))
-                tagId = d.lastrowid
-
-            d.execute('REPLACE INTO file_tag (tagId,fileSha1,taggedBy) VALUES(?,?,?)', (tagId,fileSha1,2))
-        d.close()
-
-        elapsed = time.time() - st
-
-        # update locations to signal we've run tensorflow on this file
-        c.execute('UPDATE locations SET objectDetectionRanAt=?,objectDetectionRunSeconds=? WHERE sha1=?', (datetime.datetime.now().timestamp(), elapsed, fileSha1))
-
-        db.commit()
-
-
-db.close()
+                # save snapshot of the first frame with each class. For recordings with motion data this is the crop
+                p = pathlib.PurePath(f['path'])
+                for className in new:
+                    imagePath = "%s/%s_%s.jpg" % (p.parent, p.stem, className)
+                    cv2.imwrite(imagePath, image_np)
+                f['classes'].update(new)
+
+            f['pending'] -= 1
+            if f['pending'] == 0 and f['decoded']:
+                self.complete(sha1)
+
+    def complete(self, sha1):
+        f = self.files.pop(sha1)
+        elapsed = time.time() - f['startedAt']
+        print('%s: %s in %.1fs (%d frames checked, %.1f frames/s)' % (f['path'], sorted(f['classes']), elapsed, f['frames'], f['frames'] / elapsed if elapsed else 0))
+        self.finished.append( (sha1, f['classes'], elapsed) )
+        self.completed += 1
+
+
+def main():
+    jobs = DetectionQueue(DATABASE, '%s:%d' % (socket.gethostname(), os.getpid()), LEASE_SECONDS, MAX_ATTEMPTS)
+    print('Queued %d new videos' % jobs.enqueue(QUEUE_SINCE))
+    # Enough to keep every decoder busy, with the next file lined up
+    inFlight = DECODERS * 2
+    claimed = jobs.claim(inFlight)
+    if not claimed:
+        print('Nothing to do')
+        return
+
+    downloadModel()
+    detection = ObjectDetection()
+
+    # Spawn rather than fork, since forking a process that has tensorflow loaded isn't safe
+    context = multiprocessing.get_context('spawn')
+    tasks = context.Queue()
+    frames = context.Queue(MAX_QUEUED_FRAMES)
+    numbers = itertools.count()
+    def dispatch(rows):
+        for path, sha1 in rows:
+            number = next(numbers)
+            detection.track(sha1, path, number)
+            tasks.put( (number, path, sha1, fpsFor(path)) )
+    def startDecoder():
+        current = context.Value('q', -1, lock=False)
+        decoder = context.Process(target=decode, args=(tasks, frames, current))
+        decoder.start()
+        return (decoder, current)
+    dispatch(claimed)
+    decoders = [startDecoder() for i in range(DECODERS)]
+    # Decoders take tasks in the order we send them. Once one has died, any file up to the one it was on that isn't
+    # decoded and isn't what a live decoder is working on is lost: the one it crashed on, and any it finished without
+    # getting all of the frames out first. Nobody will finish those, so we stop renewing their leases
+    crashedAt = -1
+    def orphaned():
+        working = set(current.value for decoder, current in decoders)
+        return [sha1 for sha1, f in detection.files.items() if f['task'] <= crashedAt and f['task'] not in working and not f['decoded']]
+
+    st = time.time()
+    renewAt = st + LEASE_SECONDS / 3
+    more = True
+    while True:
+        if more and len(detection.files) < inFlight:
+            rows = jobs.claim(inFlight - len(detection.files))
+            more = len(rows) > 0
+            dispatch(rows)
+        if not detection.files:
+            break
+        for i, (decoder, current) in enumerate(decoders):
+            if decoder.exitcode is not None:
+                # Usually a video that crashes the decoder library
+                paths = [f['path'] for f in detection.files.values() if f['task'] == current.value]
+                print('Decoder exited with %s while working on %s' % (decoder.exitcode, paths[0] if paths else 'nothing'))
+                crashedAt = max(crashedAt, current.value)
+                decoders[i] = startDecoder()
+        if time.time() > renewAt:
+            lost = set(orphaned())
+            jobs.renew([sha1 for sha1 in detection.files if sha1 not in lost] + [sha1 for sha1, classes, seconds in detection.finished])
+            renewAt = time.time() + LEASE_SECONDS / 3
+        if len(detection.finished) >= COMMIT_BATCH:
+            jobs.complete(detection.finished)
+            detection.finished = []
+
+        try:
+            sha1, index, image = frames.get(timeout=0.5)
+        except queue.Empty:
+            # Decoders are behind, so don't wait for full batches
+            detection.flush()
+            # Anything a crashed decoder sent has arrived by now, so files it didn't finish are really lost.
+            # Releasing them counts the attempt, and we claim them again until they reach MAX_ATTEMPTS
+            released = orphaned()
+            for sha1 in released:
+                print('%s: giving up after its decoder crashed' % (detection.files[sha1]['path'],))
+                detection.drop(sha1)
+            if released:
+                jobs.release(released)
+                more = True
+            continue
+        if sha1 not in detection.files:
+            # From a file we gave up on
+            continue
+        if index is None:
+            detection.decoded(sha1, image)
+            # Don't leave the last frames of this file waiting on frames from other files
+            if not any(f['decoded'] is False for f in detection.files.values()):
+                detection.flush()
+        else:
+            detection.add(sha1, index, image)
+
+    jobs.complete(detection.finished)
+    for decoder in decoders:
+        tasks.put(None)
+    for decoder, current in decoders:
+        decoder.join()
+    elapsed = time.time() - st
+    print('%d files, %d frames in %.1fs: %.1f frames/s overall, %.1f frames/s while inferring' % (
+        detection.completed, detection.inferred, elapsed, detection.inferred / elapsed if elapsed else 0,
+        detection.inferred / detection.secondsInferring if detection.secondsInferring else 0))
+    print('Queue: %s' % (jobs.counts(),))
+    detection.sess.close()
+    jobs.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+# Measures the object detection job queue against the old one-query-and-commit-per-file approach, on a
+# generated database with the same locations, tags and file_tag tables. No tensorflow needed. For example:
+#
+# python3 queue-benchmark.py --rows 100000 --workers 4
+import argparse
+import multiprocessing
+import os
+import random
+import sqlite3
+import tempfile
+import time
+
+from detection_queue import DetectionQueue
+
+CLASSES = ['person', 'car', 'truck', 'bicycle', 'dog', 'cat', 'bird', 'motorcycle', 'bus', 'backpack']
+
+
+def create(path, rows):
+    db = sqlite3.connect(path)
+    db.executescript("""
+        CREATE TABLE locations (
+            id INTEGER PRIMARY KEY,
+            path TEXT NOT NULL,
+            sha1 TEXT NOT NULL,
+            fileCreatedAt REAL NOT NULL,
+            objectDetectionRanAt REAL NOT NULL DEFAULT 0,
+            objectDetectionRunSeconds REAL NOT NULL DEFAULT 0
+        );
+        CREATE TABLE tags (id INTEGER PRIMARY KEY, tag TEXT NOT NULL UNIQUE);
+        CREATE TABLE file_tag (tagId INTEGER NOT NULL, fileSha1 TEXT NOT NULL, taggedBy INTEGER NOT NULL, PRIMARY KEY (tagId, fileSha1));
+    """)
+    # 2021-01-01, after the date the old query starts at
+    start = 1609459200
+    db.executemany('INSERT INTO locations (path, sha1, fileCreatedAt) VALUES (?, ?, ?)',
+        [('/videos/%d.mp4' % i, '%040x' % i, start + i * 60) for i in range(rows)])
+    db.commit()
+    db.close()
+
+
+def results(rows, tagsPerFile):
+    rng = random.Random(1)
+    return [ (sha1, set(rng.sample(CLASSES, tagsPerFile)), 1.0) for path, sha1 in rows ]
+
+
+def old(path, files, tagsPerFile):
+    # What object-detection.py used to do: scan locations for work, then look up each tag and commit per file
+    db = sqlite3.connect(path)
+    c = db.cursor()
+    st = time.time()
+    c.execute("SELECT l.path,l.sha1 FROM locations AS l WHERE objectDetectionRanAt = 0 AND fileCreatedAt >= strftime('%s', '2020-06-20') ORDER by fileCreatedAt DESC")
+    rows = c.fetchall()
+    scan = time.time() - st
+
+    st = time.time()
+    for sha1, classes, seconds in results(rows[:files], tagsPerFile):
+        for tfClass in classes:
+            c.execute('SELECT id FROM tags WHERE tag=?', (tfClass,))
+            tag = c.fetchone()
+            if tag:
+                tagId = tag[0]
+            else:
+                c.execute('INSERT INTO tags (tag) VALUES(?)', (tfClass,))
+                tagId = c.lastrowid
+            c.execute('REPLACE INTO file_tag (tagId,fileSha1,taggedBy) VALUES(?,?,?)', (tagId,sha1,2))
+        c.execute('UPDATE locations SET objectDetectionRanAt=?,objectDetectionRunSeconds=? WHERE sha1=?', (time.time(), seconds, sha1))
+        db.commit()
+    tagging = time.time() - st
+    db.close()
+    return scan, files / tagging
+
+
+def worker(path, name, claimSize, commitBatch, tagsPerFile, claimed):
+    # Claims and tags jobs until the queue is empty. Puts (name, sha1s, seconds claiming, seconds tagging) on claimed
+    jobs = DetectionQueue(path, name)
+    sha1s = []
+    finished = []
+    claiming = 0.0
+    tagging = 0.0
+    while True:
+        st = time.time()
+        rows = jobs.claim(claimSize)
+        claiming += time.time() - st
+        if rows:
+            sha1s.extend(sha1 for path, sha1 in rows)
+            finished.extend(results(rows, tagsPerFile))
+        if len(finished) >= commitBatch or (finished and not rows):
+            st = time.time()
+            jobs.complete(finished)
+            tagging += time.time() - st
+            finished = []
+        if not rows:
+            break
+    jobs.close()
+    claimed.put( (name, sha1s, claiming, tagging) )
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the object detection job queue')
+    parser.add_argument('--rows', type=int, default=100000, help='Rows in the generated locations table')
+    parser.add_argument('--workers', type=int, default=4, help='Processes sharing the queue')
+    parser.add_argument('--claim', type=int, default=16, help='Jobs per claim')
+    parser.add_argument('--commit', type=int, default=50, help='Finished jobs per transaction')
+    parser.add_argument('--tags', type=int, default=2, help='Tags per video')
+    parser.add_argument('--old-files', type=int, default=2000, help='Videos to tag the old way. Committing each one is slow')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as folder:
+        print('Creating %d locations rows' % args.rows)
+        create(os.path.join(folder, 'old.sqlite3'), args.rows)
+        path = os.path.join(folder, 'queue.sqlite3')
+        create(path, args.rows)
+
+        scan, oldRate = old(os.path.join(folder, 'old.sqlite3'), min(args.old_files, args.rows), args.tags)
+        print('Old: %.3fs to find work, %.0f files/s tagged' % (scan, oldRate))
+
+        jobs = DetectionQueue(path, 'setup')
+        st = time.time()
+        added = jobs.enqueue(0)
+        first = time.time() - st
+        st = time.time()
+        jobs.enqueue(0)
+        again = time.time() - st
+        jobs.close()
+        print('Queue: %.3fs to queue %d jobs, %.4fs to check for new ones afterwards' % (first, added, again))
+
+        claimed = multiprocessing.Queue()
+        processes = [multiprocessing.Process(target=worker, args=(path, 'worker%d' % i, args.claim, args.commit, args.tags, claimed)) for i in range(args.workers)]
+        st = time.time()
+        for process in processes:
+            process.start()
+        reports = [claimed.get() for process in processes]
+        for process in processes:
+            process.join()
+        elapsed = time.time() - st
+
+        seen = [sha1 for name, sha1s, claiming, tagging in reports for sha1 in sha1s]
+        claims = sum(len(sha1s) / args.claim for name, sha1s, claiming, tagging in reports)
+        for name, sha1s, claiming, tagging in sorted(reports):
+            print('%s: %d jobs, %.2fs claiming, %.2fs tagging' % (name, len(sha1s), claiming, tagging))
+        print('%d workers: %d jobs in %.2fs, %.0f jobs/s, %.0f claims/s' % (args.workers, len(seen), elapsed, len(seen) / elapsed, claims / elapsed))
+        print('Claimed twice: %d. Never claimed: %d' % (len(seen) - len(set(seen)), added - len(set(seen))))
+
+        db = sqlite3.connect(path)
+        left = db.execute('SELECT COUNT(*) FROM locations WHERE objectDetectionRanAt = 0').fetchone()[0]
+        tagged = db.execute('SELECT COUNT(*) FROM file_tag').fetchone()[0]
+        db.close()
+        print('Untagged locations left: %d. file_tag rows: %d' % (left, tagged))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,208 @@
+# Settings for main.py, and checks for changes to them. Kept apart from main.py so tools can load
+# the same settings without a camera attached
+import copy
+import json
+import logging
+import os
+
+
+# Default settings. If config.json is present, we'll merge in those values on start.
+settings = {
+    # raspi4 settings
+    'fps': 30,
+    'width': 1920,
+    'height': 1088,
+    # raspi zero settings (IIRC)
+    #'fps': 30,
+    #'width': 1280,
+    #'height': 720,
+
+    # 'frames' compares captured frames. 'vectors' uses the h264 encoder's motion vectors, which costs almost no CPU
+    'detector': 'frames',
+    'sensitivityPercentage': 0.2,
+    # 'luma' detects motion on a small Y (brightness) plane that the GPU resizer hands us, instead of a full-res BGR frame.
+    # Ignore regions and the sensitivity cutoff are scaled down to this resolution automatically.
+    # Use 'bgr' to detect on full-res frames like earlier versions did.
+    'detectionMode': 'luma',
+    'detectionWidth': 320,
+    'detectionHeight': 180,
+    # What 'frames' compares each frame against. 'average' is a running average of recent frames, so gradual lighting changes
+    # (sunrise, clouds) are learned instead of building up until they look like motion. 'lastMotion' is the last frame that had motion, like earlier versions.
+    # Try both against your own clips with: python3 tools/detector.py evaluate h264/YYYYMMDD
+    'backgroundModel': 'average',
+    # How much of each frame is blended into the average. Higher forgets parked cars and shadows sooner, but also learns slow movers
+    'backgroundLearningRate': 0.05,
+    # A pixel has changed when it differs from the background by more than pixelThreshold, or by more than noiseThreshold times
+    # the typical difference if that's higher, which it will be on grainy low light frames
+    'pixelThreshold': 25,
+    'noiseThreshold': 4.0,
+    # In luma mode we still need a full-res frame for /still.jpeg, but we only capture one this often
+    'secondsBetweenStills': 1.0,
+    # JPEG quality for /still.jpeg. Clients can ask for a lower one with ?quality=N
+    'stillQuality': 95,
+    # /stream.mjpeg is encoded by the GPU at this resolution, and sent to each viewer at no more than streamMaxFps
+    'streamWidth': 640,
+    'streamHeight': 360,
+    'streamMaxFps': 10,
+    'streamMaxViewers': 4,
+    # /stream.mp4 re-wraps the recording's h264 as fragmented MP4, so it's full framerate at almost no extra CPU.
+    # Viewers that fall more than liveMaxQueuedGops behind skip ahead to the latest keyframe
+    'liveMaxViewers': 4,
+    'liveMaxQueuedGops': 2,
+    # For the 'vectors' detector: a macroblock is moving if its motion vector is longer than this
+    'motionVectorMagnitude': 20,
+    # Check for motion at this interval. 0.3 (three times a second) is often frequent enough to pick up cars on a residential road, but it depends on many things. You'll need to fiddle.
+    'secondsBetweenDetection': 0.3,
+    # How many captured frames may wait for the detector. When it falls behind, the oldest waiting frame is dropped
+    'frameQueueSize': 2,
+    # How soon after starting we expect the camera to be recording into the pre-roll, counting from when the process started.
+    # We log a warning when it takes longer. /status.json shows startup.camera and startup.ready (motion detection running)
+    'secondsToStartRecording': 5,
+    # how many seconds of h264 to save prior to when motion is detected. Recordings start with at least this much, rounded back to a keyframe
+    'secondsToSaveBeforeMotion': 2,
+    'secondsToSaveAfterMotion': 2,
+    # Recordings are written to disk by their own thread, which fsyncs at least this often, so losing power loses at most this much video
+    'secondsBetweenFsync': 5,
+    # If the SD card can't keep up, video waiting to be written beyond this is dropped instead of using up memory
+    'writerMaxQueuedMegabytes': 64,
+    # Long events are split into files of about this size
+    'segmentMaxMegabytes': 512,
+    # Recordings live in h264/YYYYMMDD folders. The oldest folders are deleted to keep at least storageReserveMegabytes free,
+    # and to stay within storageMaxGigabytes and storageMaxDays if they're set. 0 means no limit.
+    # New recordings are skipped while less than storageMinimumFreeMegabytes is free
+    'storageMaxGigabytes': 0,
+    'storageMaxDays': 0,
+    'storageReserveMegabytes': 1024,
+    'storageMinimumFreeMegabytes': 128,
+    # Threads for regular HTTP requests. Stream viewers get their own on top of these
+    'httpThreads': 8,
+    # /events pushes motion, recording, metrics and config changes to the web UI. New clients get the last eventsReplay events
+    'eventsMaxClients': 8,
+    'eventsReplay': 50,
+    'secondsBetweenMetricsEvents': 5,
+    # Where hub.py is listening. Heartbeats name this camera heartbeatName, or the hostname if that's empty
+    'heartbeatServer': '192.168.1.173',
+    'heartbeatPort': 5001,
+    'heartbeatName': '',
+    # Temperature, timings, queue depths, HTTP requests and more are sampled this often, served at /metrics, and sent to
+    # InfluxDB at metricsUrl in batches. Leave metricsUrl empty to only serve /metrics. If Influx is down, up to
+    # metricsMaxPoints lines are kept to send later
+    'secondsBetweenMetrics': 10,
+    'metricsUrl': 'http://192.168.1.173:8086/write?db=cube',
+    'metricsMaxPoints': 20000,
+    # Also time each step of detection, and splitting the encoder's output into frames. Shows up in /status.json and /metrics
+    # as detect.<step> and h264.split. Costs a little, so it's off until you need it. /profile?seconds=N goes further,
+    # sampling what every thread is doing for N seconds
+    'detailedTimings': False,
+    # Messages at logLevel and above go to stdout, one per line, formatted as logFormat. Each line of code that logs is limited to 10 messages a minute
+    'logLevel': 'info',
+    'logFormat': 'text',
+    'ignore': [
+        # [startX, startY, endX, endY]
+        [0, 0, 1920, 669],
+        [0, 808, 1920, 1088]
+    ],
+    # Named zones, each scored on its own. A zone's score is the % of its region that changed divided by its sensitivityPercentage
+    # (which defaults to the global one). We see motion when the weighted sum of scores goes over 1, so a zone with weight 1
+    # can trigger on its own, and one with weight 0.5 needs twice as much change or help from other zones.
+    # Where zones overlap, the later one wins. Ignore regions override zones. Leave empty to treat the whole frame as one zone.
+    # The zone with the highest score when motion starts ends up in the filename.
+    'zones': [
+        # {'name': 'road', 'region': [0, 669, 1920, 808], 'sensitivityPercentage': 0.2, 'weight': 1.0}
+    ]
+}
+defaultSettings = copy.deepcopy(settings)
+
+
+# Changes to these are saved to config.json, but only take effect on restart.
+# They size the camera, the capture buffers or thread pools, or are only read on start
+restartSettings = set([
+    'fps', 'width', 'height', 'detector', 'detectionMode', 'frameQueueSize',
+    'httpThreads', 'streamMaxViewers', 'liveMaxViewers', 'eventsMaxClients', 'eventsReplay', 'heartbeatServer',
+    'metricsUrl', 'metricsMaxPoints', 'secondsToStartRecording'
+])
+settingChoices = {
+    'detector': ['frames', 'vectors'],
+    'detectionMode': ['luma', 'bgr'],
+    'backgroundModel': ['average', 'lastMotion'],
+    'logLevel': ['debug', 'info', 'warning', 'error'],
+    'logFormat': ['text', 'json']
+}
+# Numeric settings with an upper limit
+settingMaximums = {
+    'backgroundLearningRate': 1,
+    'pixelThreshold': 254,
+    'stillQuality': 100
+}
+# Numeric settings where 0 turns a limit off
+settingsOffAtZero = set(['storageMaxGigabytes', 'storageMaxDays'])
+
+def isNumber(value):
+    # bool is an int as far as isinstance is concerned, but true isn't a sensible width
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+def validateRegion(region, what):
+    if not isinstance(region, list) or len(region) != 4 or not all(isNumber(value) and value >= 0 for value in region):
+        raise ValueError('%s must be [startX, startY, endX, endY]' % what)
+    if region[2] <= region[0] or region[3] <= region[1]:
+        raise ValueError('%s must end after they start' % what)
+
+def validateConfig(o):
+    # Raises ValueError describing the first problem, before anything is applied
+    if not isinstance(o, dict):
+        raise ValueError('Expected an object of settings')
+    for key in o:
+        value = o[key]
+        if not key in defaultSettings:
+            raise ValueError('Unknown setting: %s' % key)
+        default = defaultSettings[key]
+
+        if key in settingChoices:
+            if not value in settingChoices[key]:
+                raise ValueError('%s must be one of: %s' % (key, ', '.join(settingChoices[key])))
+        elif key == 'ignore':
+            if not isinstance(value, list):
+                raise ValueError('ignore must be a list of regions')
+            for region in value:
+                validateRegion(region, 'Ignore regions')
+        elif key == 'zones':
+            # Zone numbers are stored in a uint8 mask, and 0 means ignored
+            if not isinstance(value, list) or len(value) > 255:
+                raise ValueError('zones must be a list of at most 255 zones')
+            for zone in value:
+                if not isinstance(zone, dict) or not isinstance(zone.get('name'), str):
+                    raise ValueError('Each zone needs a name')
+                validateRegion(zone.get('region'), 'Zone regions')
+                for field in ('sensitivityPercentage', 'weight'):
+                    if field in zone and not (isNumber(zone[field]) and zone[field] >= 0):
+                        raise ValueError('Zone %s must be a number, 0 or more' % field)
+        elif isinstance(default, bool):
+            if not isinstance(value, bool):
+                raise ValueError('%s must be true or false' % key)
+        elif isinstance(default, str):
+            if not isinstance(value, str):
+                raise ValueError('%s must be a string' % key)
+        elif isNumber(default):
+            if key in settingsOffAtZero:
+                if not isNumber(value) or value < 0:
+                    raise ValueError('%s must be a number, or 0 for no limit' % key)
+            elif not isNumber(value) or value <= 0:
+                raise ValueError('%s must be a number greater than 0' % key)
+            if isinstance(default, int) and not key.startswith('seconds') and value != int(value):
+                raise ValueError('%s must be a whole number' % key)
+            if key in settingMaximums and value > settingMaximums[key]:
+                raise ValueError('%s must be %s or less' % (key, settingMaximums[key]))
+
+
+def loadConfig(path):
+    # Merge in settings from config.json, if present
+    if os.path.isfile(path):
+        with open(path, 'r') as f:
+            try:
+                o = json.load(f)
+                validateConfig(o)
+                # Merge rather than replace, so settings added in newer versions get their defaults
+                settings.update(o)
+            except ValueError as e:
+                logging.getLogger('config').warning('Ignoring %s: %s', path, e)
+            f.close()
@@ -0,0 +1,558 @@
+# Motion detection, kept apart from the camera so it can also be driven by recorded clips.
+# See tools/detector.py for replaying, benchmarking and checking accuracy
+import collections
+import cv2
+import datetime
+import logging
+import math
+import numpy
+import os
+import threading
+import time
+
+log = logging.getLogger('detection')
+
+class FrameQueue:
+    # Bounded queue of (timestamp, frame) tuples between a producer and the detection worker.
+    # When it's full the oldest frame is dropped, so the detector always works on recent frames and never backs up capture.
+    # If given an allocate function, it also owns a pool of preallocated buffers for the producer to capture into.
+    # Otherwise frames that are dropped or released are handed to discard, if given
+    def __init__(self, size, allocate=None, discard=None):
+        self.size = size
+        self.discard = discard
+        self.condition = threading.Condition()
+        self.queued = collections.deque()
+        self.dropped = 0
+        self.pooled = allocate is not None
+        self.free = []
+        if self.pooled:
+            # Enough for a full queue, plus one being captured into and one being detected on
+            self.free = [allocate() for i in range(size + 2)]
+
+    def acquire(self):
+        with self.condition:
+            if self.free:
+                return self.free.pop()
+            # Shouldn't happen with a single producer and consumer, but if it does, reuse the oldest queued frame
+            self.dropped += 1
+            return self.queued.popleft()[1]
+
+    def put(self, t, frame):
+        with self.condition:
+            if len(self.queued) == self.size:
+                self.dropped += 1
+                self._recycle(self.queued.popleft()[1])
+            self.queued.append( (t, frame) )
+            self.condition.notify()
+
+    def get(self, timeout):
+        with self.condition:
+            if not self.queued:
+                self.condition.wait(timeout)
+            if not self.queued:
+                return None
+            return self.queued.popleft()
+
+    def release(self, frame):
+        with self.condition:
+            self._recycle(frame)
+
+    def _recycle(self, frame):
+        if self.pooled:
+            self.free.append(frame)
+        elif self.discard:
+            self.discard(frame)
+
+class FrameStore:
+    # Ring of preallocated full-res frames shared by the capture thread, the still endpoint and the detector.
+    # The capture thread fills a slot nobody is reading and then publishes it. Readers acquire the newest published slot
+    # and release it when done. Nobody ever reads a slot while it's being written, and nobody has to copy a 6MB frame
+    def __init__(self, slots, allocate):
+        self.lock = threading.Lock()
+        self.frames = [allocate() for i in range(slots)]
+        self.readers = [0] * slots
+        self.latest = None
+        self.generation = 0
+
+    def acquireWrite(self):
+        # Only the capture thread writes, so we just need a slot that isn't the latest and isn't being read.
+        # Returns None if every slot is busy, in which case the caller should skip this frame rather than wait
+        with self.lock:
+            for slot in range(len(self.frames)):
+                if slot != self.latest and self.readers[slot] == 0:
+                    return slot
+        return None
+
+    def publish(self, slot):
+        with self.lock:
+            self.latest = slot
+            self.generation += 1
+
+    def acquire(self):
+        # Returns (slot, frame, generation) for the newest frame, or None if nothing has been captured yet.
+        # Must be followed by release(slot)
+        with self.lock:
+            if self.latest is None:
+                return None
+            self.readers[self.latest] += 1
+            return (self.latest, self.frames[self.latest], self.generation)
+
+    def release(self, slot):
+        with self.lock:
+            self.readers[slot] -= 1
+
+class MotionDetection:
+    # Common bookkeeping for all detector backends. Subclasses look for motion and call _motion() when they see it
+    def __init__(self, camera, settings):
+        self.camera = camera
+        self.settings = settings
+
+        self.previousFrame = None
+        self.motionDetected = False
+        self.motionAtTimestamp = 0
+        self.checkAfterTimestamp = 0
+        self.updateDetectStillAfterTimestamp = 0
+        self.stopRecordingAfterTimestamp = 0
+        self.stopRecordingAfterTimestampDelta = settings['secondsToSaveAfterMotion']
+        # Passed to camera.start_recording() for backends that analyse the encoder's output
+        self.motionOutput = None
+        # Called with (event, timestamp) when motion starts and stops
+        self.listeners = []
+        # Called with (timestamp, score, motionBox) after every frame we detect on, from the detection worker
+        self.scoreListeners = []
+        # Most recent score for each zone, and the best scoring zone when motion last started
+        self.zoneScores = {}
+        # Weighted sum of the zone scores for the latest frame. Over 1 is motion
+        self.score = 0.0
+        # [x1, y1, x2, y2] around the changed pixels of the latest frame, in full-res coordinates. None if nothing changed
+        self.motionBox = None
+        self.motionZone = None
+        self.zoneGeometry = None
+        # main.py's Timings. While detailedTimings is on, each step of detection is added to it, see _stage()
+        self.stageTimings = None
+        self.stageMark = None
+        # Held while capturing and while detecting, so config changes are swapped in between cycles
+        self.captureLock = threading.Lock()
+        self.detectLock = threading.Lock()
+
+        self.setup()
+        # Full-res frames for the still endpoint. Three slots: the latest, one being written, and one for a reader still on the previous frame
+        self.stills = FrameStore(3 + self.stillsHeldByDetector(), lambda: numpy.empty( (self.settings['height'], self.settings['width'], 3), dtype=numpy.uint8))
+        # Backends that capture their own frames replace this with one that has a pool of buffers
+        self.frames = FrameQueue(settings['frameQueueSize'], None, self.discard())
+        self.apply(self.config(settings))
+
+    def setup(self):
+        pass
+
+    def discard(self):
+        # Backends that queue frames they don't own return a function that releases them
+        return None
+
+    def stillsHeldByDetector(self):
+        # How many still slots the detector may hold on to via the frame queue
+        return 0
+
+    def config(self, settings):
+        # Builds whatever depends on settings (masks, cutoffs, buffers) and returns it as a dict of attributes for apply().
+        # Must not modify self, since it runs while capture and detection carry on with the old config
+        return {}
+
+    def apply(self, state):
+        for name in state:
+            setattr(self, name, state[name])
+        self.stopRecordingAfterTimestampDelta = self.settings['secondsToSaveAfterMotion']
+
+    def reconfigure(self, settings, changes):
+        # settings is the validated config we're switching to, and changes the keys that differ.
+        # Everything is built first, then swapped in between capture and detection cycles, so recording never stops
+        # and we never detect with half of the old config and half of the new
+        state = self.config(settings)
+        with self.captureLock:
+            with self.detectLock:
+                self.settings.update(changes)
+                self.apply(state)
+
+    def capture(self):
+        # Called by the capture thread on the detection schedule
+        self.camera.annotate_text = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+        try:
+            t = time.time()
+            with self.captureLock:
+                self._capture(t)
+
+        except Exception:
+            log.exception('Exception within capture, skipping this frame')
+
+    def detect(self, frames, frame, t):
+        # Called by the detection worker with a frame from the frames queue
+        with self.detectLock:
+            if frames is not self.frames:
+                # Captured before a config change swapped out the queue, so it doesn't match our buffers
+                return
+            if self.stageTimings is not None and self.settings['detailedTimings']:
+                self.stageMark = time.perf_counter()
+            self._detect(frame, t)
+            self.stageMark = None
+            self._expire(t)
+            for listener in self.scoreListeners:
+                listener(t, self.score, self.motionBox)
+
+    def _capture(self, t):
+        self._captureStill(t)
+
+    def buildZones(self, settings, height, width, scaleX, scaleY):
+        # Zones and ignore regions are in full-res coordinates, so scale them to the resolution we detect at,
+        # then label each pixel (or macroblock) with its zone number. 0 means ignored.
+        # Returns attributes for apply()
+        zones = settings['zones'] or [ {'name': 'frame', 'region': [0, 0, settings['width'], settings['height']]} ]
+        def scaled(region):
+            return (slice(round(region[1] * scaleY), round(region[3] * scaleY)), slice(round(region[0] * scaleX), round(region[2] * scaleX)))
+
+        # Only rebuild the mask when regions or our resolution change, not when only sensitivities or weights do
+        geometry = [ [zone['region'] for zone in zones], settings['ignore'], height, width ]
+        if geometry == self.zoneGeometry:
+            labels = self.zones[0]
+        else:
+            labels = numpy.zeros( (height, width), dtype=numpy.uint8)
+            for i, zone in enumerate(zones):
+                labels[scaled(zone['region'])] = i + 1
+            for region in settings['ignore']:
+                labels[scaled(region)] = 0
+
+        names = []
+        required = []
+        weights = []
+        for zone in zones:
+            rows, columns = scaled(zone['region'])
+            area = len(range(*rows.indices(height))) * len(range(*columns.indices(width)))
+            sensitivityPercentage = zone.get('sensitivityPercentage', settings['sensitivityPercentage'])
+            names.append(zone['name'])
+            # How many changed pixels it takes for this zone alone to signal motion
+            required.append( max(1, math.floor(area * sensitivityPercentage / 100)) )
+            weights.append( zone.get('weight', 1.0) )
+        return {
+            # A single tuple, so the mask, names and cutoffs always match
+            'zones': (labels, names, numpy.array(required, dtype=numpy.float64), numpy.array(weights, dtype=numpy.float64)),
+            'zoneGeometry': geometry,
+            # Takes motion boxes back to full-res coordinates
+            'boxScale': (1 / scaleX, 1 / scaleY)
+        }
+
+    def scoreZones(self, labelled, zones):
+        # labelled holds the zone number of each changed pixel and 0 everywhere else,
+        # so a single histogram pass counts the changes in every zone, no matter how many zones there are
+        labels, names, required, weights = zones
+        counts = cv2.calcHist([labelled], [0], None, [len(names) + 1], [0, len(names) + 1])
+        scores = counts.ravel()[1:] / required
+        self.zoneScores = dict(zip(names, scores.tolist()))
+        self.score = float(numpy.dot(scores, weights))
+        self.motionBox = None
+        if self.score > 0:
+            # boundingRect treats a single channel image as the set of its non-zero pixels
+            x, y, w, h = cv2.boundingRect(labelled)
+            scaleX, scaleY = self.boxScale
+            self.motionBox = [ round(x * scaleX), round(y * scaleY), min(self.settings['width'], round((x + w) * scaleX)), min(self.settings['height'], round((y + h) * scaleY)) ]
+        return self.score > 1
+
+    def _stage(self, name):
+        # Called after each step of detection. While we're timing, adds the time since the previous step to stageTimings.
+        # The benchmark in tools/detector.py overrides this to time them itself
+        if self.stageMark is not None:
+            now = time.perf_counter()
+            self.stageTimings.add('detect.' + name, now - self.stageMark)
+            self.stageMark = now
+
+    def _notify(self, event, t):
+        for listener in self.listeners:
+            listener(event, t)
+
+    def _captureStill(self, t):
+        if self.updateDetectStillAfterTimestamp < t:
+            slot = self.stills.acquireWrite()
+            if slot is None:
+                return None
+            self.camera.capture(self.stills.frames[slot], format='bgr', use_video_port=True)
+            self.stills.publish(slot)
+            self.updateDetectStillAfterTimestamp = t + self.settings['secondsBetweenStills']
+            return slot
+        return None
+
+    def _motion(self, currentFrameTimestamp):
+        started = not self.motionDetected
+        if started and self.zoneScores:
+            self.motionZone = max(self.zoneScores, key=self.zoneScores.get)
+        # Log that we are seeing motion
+        self.motionDetected = True
+        self.motionAtTimestamp = currentFrameTimestamp
+        # Stop recording after 10 seconds of no motion
+        self.stopRecordingAfterTimestamp = currentFrameTimestamp + self.stopRecordingAfterTimestampDelta                        
+        log.debug('Seeing motion. Will stop recording after %s', self.stopRecordingAfterTimestamp)
+        if started:
+            self._notify('motionStarted', currentFrameTimestamp)
+
+    def _expire(self, currentFrameTimestamp):
+        if self.motionDetected and self.stopRecordingAfterTimestamp < currentFrameTimestamp:
+            # Tell writer we haven't seen motion for a while
+            log.info('%d seconds without motion', self.stopRecordingAfterTimestampDelta)
+
+            # Commented out the following so we preserve the timestamp of last motion
+            #self.motionAtTimestamp = 0
+            # Log that we are no longer seeing motion
+            self.motionDetected = False
+            self._notify('motionStopped', currentFrameTimestamp)
+
+class FrameDifferenceDetection(MotionDetection):
+    # Compares captured frames against a background frame, see backgroundModel
+    def setup(self):
+        self.luma = self.settings['detectionMode'] == 'luma'
+        self.width = None
+        self.height = None
+
+    def config(self, settings):
+        if self.luma:
+            width = settings['detectionWidth']
+            height = settings['detectionHeight']
+        else:
+            width = settings['width']
+            height = settings['height']
+
+        state = {}
+        if (width, height) != (self.width, self.height):
+            # picamera pads YUV captures to a width that's a multiple of 32 and a height that's a multiple of 16
+            paddedWidth = (width + 31) // 32 * 32
+            paddedHeight = (height + 15) // 16 * 16
+            # Create ndarrays ahead of time to reduce memory operations and GC
+            state = {
+                'width': width,
+                'height': height,
+                'paddedWidth': paddedWidth,
+                'paddedHeight': paddedHeight,
+                'grayscale': numpy.empty( (height, width), dtype=numpy.uint8),
+                # Start over, since the background is the wrong size now
+                'previous': None,
+                'background': numpy.empty( (height, width), dtype=numpy.float32),
+                'diff': numpy.empty( (height, width), dtype=numpy.uint8),
+                'threshold': numpy.empty( (height, width), dtype=numpy.uint8),
+                'scratch': numpy.empty( (height, width), dtype=numpy.uint8)
+            }
+            if self.luma:
+                # New capture buffers too. In bgr mode we detect on full-res frames from the still store, so there's nothing to allocate
+                size = paddedWidth * paddedHeight * 3 // 2
+                state['frames'] = FrameQueue(settings['frameQueueSize'], lambda: numpy.empty( (size,), dtype=numpy.uint8))
+
+        if settings['backgroundModel'] != getattr(self, 'backgroundModel', None):
+            state['previous'] = None
+        state['backgroundModel'] = settings['backgroundModel']
+        state['learningRate'] = settings['backgroundLearningRate']
+        state['pixelThreshold'] = settings['pixelThreshold']
+        state['noiseThreshold'] = settings['noiseThreshold']
+
+        state.update( self.buildZones(settings, height, width, width / settings['width'], height / settings['height']) )
+        return state
+
+    def discard(self):
+        if self.luma:
+            return None
+        # In bgr mode queued frames are still slots, which go back to the store
+        return self.stills.release
+
+    def stillsHeldByDetector(self):
+        if self.luma:
+            return 0
+        # A full queue plus the frame being detected on
+        return self.settings['frameQueueSize'] + 1
+
+    def _capture(self, t):
+        if self.luma:
+            frame = self.frames.acquire()
+            try:
+                # The GPU resizer shrinks the frame before it's copied to us, so this is far cheaper than a full-res capture
+                self.camera.capture(frame, format='yuv', use_video_port=True, resize=(self.width, self.height))
+            except:
+                self.frames.release(frame)
+                raise
+            self.frames.put(t, frame)
+            self._captureStill(t)
+        else:
+            # Every full-res frame doubles as the still, so force a capture into the store each time
+            self.updateDetectStillAfterTimestamp = 0
+            if self._captureStill(t) is None:
+                return
+            # Hold a reader reference on the slot until the detector is done with it
+            slot = self.stills.acquire()[0]
+            self.frames.put(t, slot)
+
+    def _detect(self, frame, currentFrameTimestamp):
+        if self.luma:
+            # The Y plane comes first, so grayscale is just a view into the start of the capture buffer
+            grayscale = frame[:self.paddedWidth * self.paddedHeight].reshape( (self.paddedHeight, self.paddedWidth) )[:self.height, :self.width]
+        else:
+            # In bgr mode frame is a slot in the still store
+            grayscale = self.grayscale
+            cv2.cvtColor(self.stills.frames[frame], cv2.COLOR_BGR2GRAY, grayscale)
+            self._stage('cvtColor')
+        self.compare(grayscale, currentFrameTimestamp)
+
+    def compare(self, grayscale, currentFrameTimestamp):
+        # grayscale is a (height, width) uint8 frame. Returns whether it had motion.
+        # Also called directly when replaying recorded clips
+        if self.previous is None:
+            self.previous = numpy.empty( (self.height, self.width), dtype=numpy.uint8)
+            numpy.copyto(self.previous, grayscale)
+            numpy.copyto(self.background, grayscale)
+            self.noise = 0.0
+            return False
+
+        zones = self.zones
+        average = self.backgroundModel == 'average'
+        if average:
+            # Shift the background by the change in overall brightness, so the sun going behind a cloud or the
+            # exposure adjusting doesn't look like every pixel changed. Ignored regions don't count
+            offset = cv2.mean(grayscale, zones[0])[0] - cv2.mean(self.background, zones[0])[0]
+            cv2.convertScaleAbs(self.background, self.previous, 1, offset)
+            cv2.absdiff(self.previous, grayscale, dst=self.diff)
+            self._stage('absdiff')
+            # The median difference from the background is mostly sensor noise, which goes way up in low light
+            histogram = cv2.calcHist([self.diff], [0], zones[0], [256], [0, 256]).ravel()
+            median = int(numpy.searchsorted(numpy.cumsum(histogram), histogram.sum() / 2))
+            threshold = min(254, max(self.pixelThreshold, self.noiseThreshold * self.noise))
+            self._stage('noise')
+        else:
+            cv2.absdiff(self.previous, grayscale, dst=self.diff)
+            threshold = self.pixelThreshold
+            self._stage('absdiff')
+        # Changed pixels become 1, everything else 0
+        cv2.threshold(self.diff, threshold, 1, cv2.THRESH_BINARY, self.threshold)
+        self._stage('threshold')
+        # Multiplying by the zone labels gives each changed pixel its zone number, and zeroes out ignored pixels
+        numpy.multiply(self.threshold, zones[0], out=self.scratch)
+        self._stage('mask')
+
+        motion = self.scoreZones(self.scratch, zones)
+        self._stage('score')
+        if motion: # motion detected in frame
+            self._motion(currentFrameTimestamp)
+
+        if average:
+            cv2.accumulateWeighted(grayscale, self.background, self.learningRate)
+            if not motion:
+                # Moving objects would make the noise look worse than it is
+                self.noise += self.learningRate * (median - self.noise)
+        elif motion:
+            # Let's only use the current frame for detection if it contains motion.
+            # The thought is that we want to detect very slow moving objects ... objects that might not trigger 2% of pixel changes within 1/3 second but that might over a longer time frame.
+            numpy.copyto(self.previous, grayscale)
+        # End conditional frame comparison logic
+        self._stage('learn')
+        return motion
+
+class MotionVectorDetection(MotionDetection):
+    # Uses the per-macroblock motion vectors the h264 encoder already computes, so we never decode a frame
+    def setup(self):
+        # One vector per 16x16 macroblock, plus an extra column the encoder always adds
+        self.columns = (self.settings['width'] + 15) // 16 + 1
+        self.rows = (self.settings['height'] + 15) // 16
+        self.magnitude = numpy.empty( (self.rows, self.columns), dtype=numpy.int32)
+        self.scratch = numpy.empty( (self.rows, self.columns), dtype=numpy.int32)
+        self.moving = numpy.empty( (self.rows, self.columns), dtype=bool)
+        self.labelled = numpy.empty( (self.rows, self.columns), dtype=numpy.uint8)
+        # The encoder's motion vectors arrive through motionOutput, which main.py sets to a MotionVectorAnalysis
+
+    def config(self, settings):
+        # A macroblock belongs to a zone (or is ignored) if its center falls within the region.
+        # The extra column is never part of a zone
+        state = self.buildZones(settings, self.rows, self.columns, 1 / 16, 1 / 16)
+        # Compare squared magnitudes so we don't need a sqrt per block
+        state['minimumMagnitude'] = settings['motionVectorMagnitude'] ** 2
+        return state
+
+    def _detect(self, a, currentFrameTimestamp):
+        zones = self.zones
+        numpy.multiply(a['x'], a['x'], out=self.magnitude, dtype=numpy.int32)
+        numpy.multiply(a['y'], a['y'], out=self.scratch, dtype=numpy.int32)
+        numpy.add(self.magnitude, self.scratch, out=self.magnitude)
+        numpy.greater(self.magnitude, self.minimumMagnitude, out=self.moving)
+        self._stage('magnitude')
+        # Each moving macroblock gets its zone number, everything else 0
+        numpy.multiply(self.moving, zones[0], out=self.labelled)
+        self._stage('mask')
+        motion = self.scoreZones(self.labelled, zones)
+        self._stage('score')
+        if motion:
+            self._motion(currentFrameTimestamp)
+
+# Detector backends, selected by settings['detector']
+detectors = {
+    'frames': FrameDifferenceDetection,
+    'vectors': MotionVectorDetection
+}
+
+
+imageExtensions = ('.jpg', '.jpeg', '.png', '.bmp')
+videoExtensions = ('.h264', '.mp4', '.avi', '.mkv')
+
+def findClips(paths):
+    # Video files, and folders of images, within the given paths. Each is replayed as a clip
+    found = []
+    for path in paths:
+        if not os.path.isdir(path):
+            found.append(path)
+            continue
+        for root, dirs, files in os.walk(path):
+            found.extend( os.path.join(root, name) for name in files if name.lower().endswith(videoExtensions) )
+            if any( name.lower().endswith(imageExtensions) for name in files ):
+                found.append(root)
+    return sorted(found)
+
+def readFrames(path, step=1):
+    # Yields every step'th BGR frame of a video file, or of the images in a folder in filename order
+    if os.path.isdir(path):
+        names = sorted( name for name in os.listdir(path) if name.lower().endswith(imageExtensions) )
+        for name in names[::step]:
+            frame = cv2.imread(os.path.join(path, name))
+            if frame is not None:
+                yield frame
+        return
+
+    video = cv2.VideoCapture(path)
+    try:
+        i = 0
+        while True:
+            if i % step == 0:
+                ok, frame = video.read()
+                if not ok:
+                    return
+                yield frame
+            elif not video.grab():
+                return
+            i += 1
+    finally:
+        video.release()
+
+def replay(path, settings):
+    # Feeds a recorded clip through the 'frames' detector at our detection interval, as if it came from the camera.
+    # Raw h264 has no timestamps, so we assume clips were recorded at settings['fps'].
+    # Returns the motionStarted and motionStopped events as (event, timestamp), and (timestamp, motion) for every frame detected on
+    detector = FrameDifferenceDetection(None, settings)
+    events = []
+    detector.listeners.append(lambda event, t: events.append( (event, t) ))
+    step = max(1, round(settings['secondsBetweenDetection'] * settings['fps']))
+    grayscale = numpy.empty( (detector.height, detector.width), dtype=numpy.uint8)
+    samples = []
+    # The detector logs whenever motion starts and stops, which is just noise when replaying a whole folder of clips
+    level = log.level
+    log.setLevel(logging.WARNING)
+    try:
+        for i, frame in enumerate(readFrames(path, step)):
+            t = i * step / settings['fps']
+            # Stands in for the GPU resizer we'd use when capturing
+            cv2.resize(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY), (detector.width, detector.height), grayscale, interpolation=cv2.INTER_AREA)
+            samples.append( (t, detector.compare(grayscale, t)) )
+            detector._expire(t)
+        # Finish a recording that's still going when the clip ends
+        detector._expire(math.inf)
+    finally:
+        log.setLevel(level)
+    return events, samples
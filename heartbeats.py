@@ -0,0 +1,46 @@
+# Heartbeats that camera nodes (main.py) send to the hub (hub.py) over UDP. Each one is a single datagram of
+# a couple dozen bytes, so 50 nodes every 2 seconds is nothing for the network or the hub
+import struct
+
+MAGIC = b'RH'
+VERSION = 1
+# Bits in flags
+MOTION = 1
+RECORDING = 2
+# magic, version, flags, sequence, http port, fps, CPU temperature in hundredths of a degree, free disk in MB,
+# then the length of the node's name. The name follows as utf-8
+header = struct.Struct('!2sBBIHHhIB')
+# Sent when we can't read the temperature
+NO_TEMPERATURE = -32768
+
+
+def packHeartbeat(name, sequence, port, fps, motion=False, recording=False, temperature=None, diskFreeMegabytes=0):
+    # sequence goes up by one each heartbeat, so the hub can tell when some went missing or the node restarted
+    name = name.encode('utf-8')[:255]
+    flags = (MOTION if motion else 0) | (RECORDING if recording else 0)
+    if temperature is None:
+        temperature = NO_TEMPERATURE
+    else:
+        temperature = max(-32767, min(32767, round(temperature * 100)))
+    return header.pack(MAGIC, VERSION, flags, sequence & 0xffffffff, port, round(fps), temperature, min(0xffffffff, max(0, int(diskFreeMegabytes))), len(name)) + name
+
+
+def unpackHeartbeat(data):
+    # Returns the heartbeat as a dict. Raises ValueError if it isn't one we understand
+    if len(data) < header.size:
+        raise ValueError('Heartbeat too short')
+    magic, version, flags, sequence, port, fps, temperature, diskFreeMegabytes, nameLength = header.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError('Not a heartbeat, or from a different version')
+    if len(data) != header.size + nameLength:
+        raise ValueError('Heartbeat name is cut off')
+    return {
+        'name': data[header.size:].decode('utf-8', 'replace'),
+        'sequence': sequence,
+        'port': port,
+        'fps': fps,
+        'motion': bool(flags & MOTION),
+        'recording': bool(flags & RECORDING),
+        'temperature': None if temperature == NO_TEMPERATURE else temperature / 100,
+        'diskFreeMegabytes': diskFreeMegabytes
+    }
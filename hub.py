@@ -0,0 +1,329 @@
+#!/usr/bin/env python3
+# Central daemon for a house full of camera nodes running main.py. Nodes send heartbeats (see heartbeats.py) to
+# heartbeatPort, and we serve a page with a grid of every camera we've heard from.
+#
+# However many people are watching a camera, we keep a single connection to that node's /stream.mjpeg and copy
+# each frame to everyone, so a Pi never has more than one stream viewer because of us. Viewers that can't keep up
+# skip frames rather than making us buffer them.
+#
+# Needs nothing beyond Python 3.7. Run it on any box the nodes can reach:
+#
+# python3 hub.py --http-port 8081
+#
+# Try it without any cameras using: python3 tools/simulate-nodes.py --nodes 50
+import argparse
+import asyncio
+import json
+import os
+import re
+import time
+import urllib.parse
+
+from heartbeats import unpackHeartbeat
+
+
+class Node:
+    # What we know about a camera node, going by its latest heartbeat
+    def __init__(self, name):
+        self.name = name
+        self.address = None
+        self.heartbeat = {}
+        self.firstSeen = time.time()
+        self.lastSeen = 0
+        self.online = False
+        # Heartbeats that never arrived, going by gaps in the sequence, and how often the sequence started over
+        self.missed = 0
+        self.restarts = 0
+        self.upstream = None
+
+    def update(self, heartbeat, address):
+        previous = self.heartbeat.get('sequence')
+        if previous is not None:
+            if heartbeat['sequence'] > previous:
+                self.missed += heartbeat['sequence'] - previous - 1
+            elif heartbeat['sequence'] < previous:
+                # main.py starts counting from 0 when it starts
+                self.restarts += 1
+        self.heartbeat = heartbeat
+        self.address = address
+        self.lastSeen = time.time()
+        self.online = True
+
+    def status(self, now):
+        o = dict(self.heartbeat)
+        o.update({
+            'address': self.address,
+            'online': self.online,
+            'secondsSinceHeartbeat': round(now - self.lastSeen, 1),
+            'missedHeartbeats': self.missed,
+            'restarts': self.restarts,
+            'viewers': self.upstream.viewers if self.upstream else 0,
+            'upstream': self.upstream.stats() if self.upstream else None
+        })
+        return o
+
+
+class Upstream:
+    # One connection to a node's /stream.mjpeg, shared by everyone watching that camera. Opened when the first viewer
+    # arrives and closed lingerSeconds after the last one leaves, so the grid polling for frames or someone flipping
+    # between cameras doesn't reconnect every time
+    def __init__(self, node, lingerSeconds):
+        self.node = node
+        self.lingerSeconds = lingerSeconds
+        self.viewers = 0
+        self.connected = False
+        self.connections = 0
+        self.frames = 0
+        # The latest frame, and a future that's resolved with the next one. Viewers wait on the future,
+        # so there's no per-viewer queue to fill up
+        self.frame = None
+        self.next = asyncio.get_event_loop().create_future()
+        self.task = None
+        self.closer = None
+
+    def join(self):
+        self.viewers += 1
+        if self.closer:
+            self.closer.cancel()
+            self.closer = None
+        if self.task is None:
+            self.task = asyncio.ensure_future(self.run())
+
+    def leave(self):
+        self.viewers -= 1
+        if self.viewers == 0:
+            self.closer = asyncio.get_event_loop().call_later(self.lingerSeconds, self.close)
+
+    def close(self):
+        self.closer = None
+        if self.task:
+            self.task.cancel()
+            self.task = None
+        self.connected = False
+        self.frame = None
+
+    async def nextFrame(self, timeout):
+        # The next frame from the node, or None if there isn't one within timeout seconds
+        try:
+            return await asyncio.wait_for(asyncio.shield(self.next), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    def publish(self, frame):
+        self.frame = frame
+        self.frames += 1
+        waiting = self.next
+        self.next = asyncio.get_event_loop().create_future()
+        waiting.set_result(frame)
+
+    def stats(self):
+        return {'connected': self.connected, 'connections': self.connections, 'frames': self.frames}
+
+    async def run(self):
+        # Reconnects until close(), backing off while the node is unreachable
+        delay = 1
+        while True:
+            frames = self.frames
+            try:
+                await self.stream()
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError) as e:
+                print('%s: stream failed: %s' % (self.node.name, str(e) or type(e).__name__))
+            self.connected = False
+            # Otherwise the grid would keep showing the last frame we got as if the camera were still live
+            self.frame = None
+            if self.frames > frames:
+                delay = 1
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 30)
+
+    async def stream(self):
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(self.node.address, self.node.heartbeat['port']), 5)
+        try:
+            writer.write(b'GET /stream.mjpeg HTTP/1.0\r\nHost: %s\r\n\r\n' % self.node.address.encode('ascii'))
+            status = await asyncio.wait_for(reader.readline(), 5)
+            if status.split(b' ')[1:2] != [b'200']:
+                raise ValueError('Node responded with %s' % status.strip().decode('latin-1'))
+            await readHeaders(reader)
+            self.connected = True
+            self.connections += 1
+            while True:
+                line = await asyncio.wait_for(reader.readline(), 10)
+                if not line:
+                    raise ValueError('Node closed the stream')
+                if not line.startswith(b'--'):
+                    continue
+                headers = await readHeaders(reader)
+                length = int(headers.get('content-length', 0))
+                if length <= 0 or length > 16777216:
+                    raise ValueError('Bad frame length: %d' % length)
+                self.publish(await asyncio.wait_for(reader.readexactly(length), 10))
+        finally:
+            writer.close()
+
+
+async def readHeaders(reader):
+    # Reads header lines up to the blank line, and returns them with lowercase names
+    headers = {}
+    for i in range(100):
+        line = await asyncio.wait_for(reader.readline(), 10)
+        if line in (b'\r\n', b'\n', b''):
+            return headers
+        name, separator, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    raise ValueError('Too many headers')
+
+
+class HeartbeatProtocol(asyncio.DatagramProtocol):
+    def __init__(self, hub):
+        self.hub = hub
+
+    def datagram_received(self, data, address):
+        self.hub.heartbeat(data, address)
+
+
+class Hub:
+    def __init__(self, args):
+        self.args = args
+        self.nodes = {}
+        self.invalidHeartbeats = 0
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'hub.html'), 'rb') as f:
+            self.page = f.read()
+
+    def heartbeat(self, data, address):
+        try:
+            heartbeat = unpackHeartbeat(data)
+        except ValueError:
+            self.invalidHeartbeats += 1
+            return
+        node = self.nodes.get(heartbeat['name'])
+        if node is None:
+            node = Node(heartbeat['name'])
+            self.nodes[node.name] = node
+        if not node.online:
+            print('%s is online at %s' % (node.name, address[0]))
+        node.update(heartbeat, address[0])
+
+    async def watch(self):
+        # Marks nodes offline once their heartbeats stop, and eventually forgets them
+        while True:
+            await asyncio.sleep(1)
+            now = time.time()
+            for node in list(self.nodes.values()):
+                quiet = now - node.lastSeen
+                if node.online and quiet > self.args.offline_seconds:
+                    print('%s is offline, no heartbeat for %d seconds' % (node.name, quiet))
+                    node.online = False
+                if quiet > self.args.forget_seconds and (node.upstream is None or node.upstream.viewers == 0):
+                    if node.upstream:
+                        node.upstream.close()
+                    del self.nodes[node.name]
+
+    def upstream(self, name):
+        # The node's shared stream, or None if we can't reach it
+        node = self.nodes.get(name)
+        if node is None or not node.online:
+            return None
+        if node.upstream is None:
+            node.upstream = Upstream(node, self.args.linger_seconds)
+        return node.upstream
+
+    async def handle(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readline(), 10)
+            await readHeaders(reader)
+            parts = request.decode('latin-1').split()
+            if len(parts) < 2 or parts[0] != 'GET':
+                await respond(writer, 405, 'text/plain', b'Only GET is supported')
+                return
+            path = urllib.parse.urlsplit(parts[1]).path
+            camera = re.match(r'^/cameras/([^/]+)/(stream\.mjpeg|frame\.jpeg)$', path)
+            if path == '/':
+                await respond(writer, 200, 'text/html', self.page)
+            elif path == '/nodes.json':
+                now = time.time()
+                o = {
+                    'nodes': [self.nodes[name].status(now) for name in sorted(self.nodes)],
+                    'invalidHeartbeats': self.invalidHeartbeats
+                }
+                await respond(writer, 200, 'application/json', json.dumps(o).encode('utf-8'))
+            elif camera:
+                upstream = self.upstream(urllib.parse.unquote(camera.group(1)))
+                if upstream is None:
+                    await respond(writer, 404, 'text/plain', b'No such camera, or it is offline')
+                elif camera.group(2) == 'frame.jpeg':
+                    await self.sendFrame(writer, upstream)
+                else:
+                    await self.sendStream(writer, upstream)
+            else:
+                await respond(writer, 404, 'text/plain', b'Not found')
+        except (OSError, asyncio.TimeoutError, ValueError):
+            # Viewer went away, or sent something we can't make sense of
+            pass
+        finally:
+            writer.close()
+
+    async def sendFrame(self, writer, upstream):
+        # The latest frame, for the grid. Keeps the upstream open a while, since the grid will be back for another
+        upstream.join()
+        try:
+            frame = upstream.frame or await upstream.nextFrame(5)
+        finally:
+            upstream.leave()
+        if frame is None:
+            await respond(writer, 504, 'text/plain', b'No frames from camera')
+            return
+        await respond(writer, 200, 'image/jpeg', frame)
+
+    async def sendStream(self, writer, upstream):
+        upstream.join()
+        try:
+            writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: multipart/x-mixed-replace; boundary=FRAME\r\nCache-Control: no-cache\r\nConnection: close\r\n\r\n')
+            frame = upstream.frame
+            while True:
+                if frame is None:
+                    frame = await upstream.nextFrame(10)
+                    if frame is None:
+                        print('No frames from %s, closing stream' % upstream.node.name)
+                        return
+                writer.write(b'--FRAME\r\nContent-Type: image/jpeg\r\nContent-Length: %d\r\n\r\n' % len(frame))
+                writer.write(frame)
+                writer.write(b'\r\n')
+                # While we wait on a slow viewer, frames go by and they get whichever is latest afterwards
+                await asyncio.wait_for(writer.drain(), 30)
+                frame = None
+        finally:
+            upstream.leave()
+
+
+async def respond(writer, code, contentType, body):
+    reasons = {200: 'OK', 404: 'Not Found', 405: 'Method Not Allowed', 504: 'Gateway Timeout'}
+    writer.write(b'HTTP/1.1 %d %s\r\nContent-Type: %s\r\nContent-Length: %d\r\nCache-Control: no-cache\r\nConnection: close\r\n\r\n' % (code, reasons[code].encode('ascii'), contentType.encode('ascii'), len(body)))
+    writer.write(body)
+    await asyncio.wait_for(writer.drain(), 30)
+
+
+async def serve(args):
+    hub = Hub(args)
+    loop = asyncio.get_event_loop()
+    await loop.create_datagram_endpoint(lambda: HeartbeatProtocol(hub), local_addr=(args.host, args.heartbeat_port))
+    hub.server = await asyncio.start_server(hub.handle, args.host, args.http_port)
+    print('Listening for heartbeats on UDP port %d, serving the grid on port %d' % (args.heartbeat_port, args.http_port))
+    await hub.watch()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Shows the cameras of every node that sends us heartbeats')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--http-port', type=int, default=8081)
+    parser.add_argument('--heartbeat-port', type=int, default=5001, help="Should match the nodes' heartbeatPort setting")
+    parser.add_argument('--offline-seconds', type=float, default=7, help='Nodes send a heartbeat every 2 seconds')
+    parser.add_argument('--forget-seconds', type=float, default=86400, help='Offline nodes drop off the grid after this long')
+    parser.add_argument('--linger-seconds', type=float, default=10, help='Keep streams from nodes open this long after the last viewer leaves')
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+# Logging for main.py. One line per message on stdout (which ends up in the journal under systemd), either as text
+# or as JSON with a field for everything passed in extra=. Each place that logs gets a budget of messages per minute,
+# so an exception on every frame can't drown out everything else or fill up the SD card
+import datetime
+import json
+import logging
+import sys
+import threading
+
+
+# Attributes every LogRecord has. Anything else was passed in extra=, and is logged as a field
+standardAttributes = set(logging.LogRecord('', 0, '', 0, '', (), None).__dict__) | set(['message', 'asctime', 'suppressed'])
+
+def fields(record):
+    return dict((name, value) for name, value in record.__dict__.items() if name not in standardAttributes)
+
+
+class RateLimit(logging.Filter):
+    # Lets through up to burst messages per windowSeconds from each call site (file and line).
+    # Once a new window starts, the first message from that call site says how many were suppressed in the last one
+    def __init__(self, burst=10, windowSeconds=60):
+        logging.Filter.__init__(self)
+        self.burst = burst
+        self.windowSeconds = windowSeconds
+        self.lock = threading.Lock()
+        # (pathname, lineno) -> [window start, messages let through, messages suppressed]
+        self.sites = {}
+
+    def filter(self, record):
+        key = (record.pathname, record.lineno)
+        with self.lock:
+            site = self.sites.get(key)
+            if site is None or record.created - site[0] >= self.windowSeconds:
+                if site and site[2]:
+                    record.suppressed = site[2]
+                site = [record.created, 0, 0]
+                self.sites[key] = site
+            if site[1] >= self.burst:
+                site[2] += 1
+                return False
+            site[1] += 1
+        return True
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        logging.Formatter.__init__(self, '%(asctime)s %(levelname)s %(threadName)s: %(message)s')
+
+    def format(self, record):
+        text = logging.Formatter.format(self, record)
+        extra = ''.join(' %s=%s' % (name, json.dumps(value, default=str)) for name, value in sorted(fields(record).items()))
+        suppressed = ' (%d similar messages suppressed)' % record.suppressed if getattr(record, 'suppressed', 0) else ''
+        # Tracebacks go after the fields, so they stay on the first line
+        first, newline, rest = text.partition('\n')
+        return first + extra + suppressed + newline + rest
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        o = {
+            'time': datetime.datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname.lower(),
+            'logger': record.name,
+            'thread': record.threadName,
+            'message': record.getMessage()
+        }
+        o.update(fields(record))
+        if getattr(record, 'suppressed', 0):
+            o['suppressed'] = record.suppressed
+        if record.exc_info:
+            o['exception'] = self.formatException(record.exc_info)
+        return json.dumps(o, default=str)
+
+
+handler = None
+
+def configureLogging(settings):
+    # Called on start and again when logLevel or logFormat change. Reuses our handler, so it's safe to call repeatedly
+    global handler
+    root = logging.getLogger()
+    if handler is None:
+        handler = logging.StreamHandler(sys.stdout)
+        handler.addFilter(RateLimit())
+        root.addHandler(handler)
+    handler.setFormatter(JsonFormatter() if settings['logFormat'] == 'json' else TextFormatter())
+    root.setLevel(settings['logLevel'].upper())
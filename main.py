@@ -1,250 +1,905 @@
-import cv2
+import collections
+import concurrent.futures
+import copy
 import datetime
-import gpiozero
 import http.server
 import json
-import math
-import numpy
+import logging
 import os
-import pathlib
-import picamera
-import requests
+import queue
+import re
+import shutil
 import signal
 import socket
-import subprocess
+import sqlite3
+import struct
 import threading
 import time
 import urllib
 
+from config import settings, restartSettings, validateConfig, loadConfig
+from heartbeats import packHeartbeat
+from logs import configureLogging
+from metrics import Metrics, InfluxExporter
+from profiling import StackSampler
+
 # Hi! Use this code to turn your Raspberry Pi into a surveillance camera.
-# It records h264 videos when motion is detected
+# It records an mp4 video of each motion event, including a couple of seconds from before the motion started
 # It also contains a simple webpage where you can watch the live stream via JPEGs that refresh twice a second
-# 
-# Regarding the output video, you'll need to join the before and after files together files into a mp4 to view them. You can use ffmpeg to do this:
-# ffmpeg -framerate 10 -i "concat:20201025060604_before.h264|20201025060604_after.h264" -c:v copy 20201025060604.mp4 
 
 # A raspi4 can handle 1088p () 30fps and detect motion 2-3 times per second, while keeping CPU core around 80%!
 
-# Default settings. If config.json is present, we'll merge in those values on start.
-settings = {
-    # raspi4 settings
-    'fps': 30,
-    'width': 1920,
-    'height': 1088,
-    # raspi zero settings (IIRC)
-    #'fps': 30,
-    #'width': 1280,
-    #'height': 720,
-
-    'sensitivityPercentage': 0.2,
-    # Check for motion at this interval. 0.3 (three times a second) is often frequent enough to pick up cars on a residential road, but it depends on many things. You'll need to fiddle.
-    'secondsBetweenDetection': 0.3,
-    # how many seconds of h264 to save prior to when motion is detected. this will be saved in a *_before.h264 file
-    'secondsToSaveBeforeMotion': 2,
-    'secondsToSaveAfterMotion': 2,
-    'heartbeatServer': '192.168.1.173',
-    'heartbeatPort': 5001,
-    'ignore': [
-        # [startX, startY, endX, endY]
-        [0, 0, 1920, 669],
-        [0, 808, 1920, 1088]
-    ]
-}
+# Importing this doesn't touch the camera. picamera, gpiozero and OpenCV are only imported once main() or a thread needs them,
+# so the camera can start recording as soon as possible, and everything else here can be imported on any machine
 
+log = logging.getLogger('main')
 
 class SplitFrames(object):
     def __init__(self):
         self.buf = None
+        self.generation = 0
+        self.condition = threading.Condition()
 
     def write(self, buf):
         if not buf.startswith(b'\xff\xd8'):
-            print('ERROR: buffer with JPEG data does not start with magic bytes')
+            log.error('Buffer with JPEG data does not start with magic bytes')
 
         # NOTE: Until i see "buffer does not start with magic bytes" actually happen, let's just use the buffer picamera gives us instead of copying into a BytesIO stream
-        self.buf = buf
+        with self.condition:
+            self.buf = buf
+            self.generation += 1
+            self.condition.notify_all()
+
+    def wait(self, generation, timeout):
+        # Waits for a frame newer than generation. Returns (generation, buf), with buf None if we timed out
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.generation != generation, timeout):
+                return (generation, None)
+            return (self.generation, self.buf)
 
-class MotionDetection:
-    def __init__(self, camera, settings, streamer):
+class LiveStream:
+    # Runs the GPU's MJPEG encoder on a spare splitter port while anyone is watching /stream.mjpeg.
+    # Every viewer reads the latest frame from the same SplitFrames, so a slow viewer just skips frames and never holds up the camera
+    def __init__(self, camera, settings):
         self.camera = camera
         self.settings = settings
+        self.output = SplitFrames()
+        self.lock = threading.Lock()
+        self.viewers = 0
 
-        self.previousFrame = None
-        self.motionDetected = False
-        self.motionAtTimestamp = 0
-        self.checkAfterTimestamp = 0
-        self.updateDetectStillAfterTimestamp = 0
-        self.stopRecordingAfterTimestamp = 0
-        self.stopRecordingAfterTimestampDelta = settings['secondsToSaveAfterMotion']
-
-        # Create ndarrays ahead of time to reduce memory operations and GC
-        self.decoded = numpy.empty( (self.settings['height'], self.settings['width'], 3), dtype=numpy.uint8)
-        streamer.httpd.still = self.decoded
-        self.grayscale = numpy.empty( (self.settings['height'], self.settings['width']), dtype=numpy.uint8)
-        self.previous = None
-        self.diff = numpy.empty( (self.settings['height'], self.settings['width']), dtype=numpy.uint8)
-        self.threshold = numpy.empty( (self.settings['height'], self.settings['width']), dtype=numpy.uint8)
-        self.ignore = numpy.ones( (self.settings['height'], self.settings['width']), dtype=numpy.uint8)
-        self.scratch = numpy.empty( (self.settings['height'], self.settings['width']), dtype=numpy.uint8)
-
-        self.config(settings)
-
-    def config(self, settings):
-        self.sensitivityPercentage = self.settings['sensitivityPercentage'] / 100
-
-        # N% of white pixels signals motion
-        cutoff = math.floor(self.settings['width'] * self.settings['height'] * self.sensitivityPercentage)
-        # Pixels with motion will have a value of 255
-        # Sum the % of pixels having value of 255 to 
-        self.cutoff = cutoff * 255
-
-        # Assemble an ndarray of our ignore regions. We'll multiply this by our current frame to zero-out pixels we want to ignore
-        for region in self.settings['ignore']:
-            x = region[0]
-            y = region[1]
-            while y < region[3]:
-                self.ignore[y, x:region[2]] = 0
-                y += 1
-    
-    def check(self):
-        global streamer
-        self.camera.annotate_text = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    def join(self):
+        # Returns False if we already have as many viewers as we allow
+        with self.lock:
+            if self.viewers >= self.settings['streamMaxViewers']:
+                return False
+            if self.viewers == 0:
+                # Port 1 is the h264 recording and port 0 is used for captures
+                self.camera.start_recording(self.output, format='mjpeg', splitter_port=2, resize=(self.settings['streamWidth'], self.settings['streamHeight']))
+            self.viewers += 1
+            return True
 
-        try:
-            # TODO: capture into a buffer not shared with the http streamer ...
-            # as-is we can have race-conditions
-            self.camera.capture(self.decoded, format='bgr', use_video_port=True)
-            t = time.time()
-            print('Checking for motion')
-            self._detect(t)
+    def leave(self):
+        with self.lock:
+            self.viewers -= 1
+            if self.viewers == 0:
+                self.camera.stop_recording(splitter_port=2)
 
-        except Exception as e:
-            print('Exception within capture_continuous, bailing')
-            print(str(e))
+def nalUnits(data):
+    # Splits Annex B h264 (what the encoder gives us) into NAL units without their start codes
+    units = []
+    start = data.find(b'\x00\x00\x01')
+    while start != -1:
+        start += 3
+        end = data.find(b'\x00\x00\x01', start)
+        if end == -1:
+            units.append(data[start:])
+            break
+        # A 4 byte start code leaves a zero on the end of the previous unit. NAL units never end in a zero byte, so strip them
+        units.append(data[start:end].rstrip(b'\x00'))
+        start = end
+    return units
 
-    def _detect(self, currentFrameTimestamp):
-        cv2.cvtColor(self.decoded, cv2.COLOR_BGR2GRAY, self.grayscale)
+def box(kind, *payloads):
+    data = b''.join(payloads)
+    return struct.pack('>I4s', 8 + len(data), kind) + data
 
-        if self.previous is None:
-            self.previous = numpy.empty( (self.settings['height'], self.settings['width']), dtype=numpy.uint8)
-            numpy.copyto(self.previous, self.grayscale)
-            return False
+def fullBox(kind, version, flags, *payloads):
+    return box(kind, struct.pack('>I', (version << 24) | flags), *payloads)
+
+class Mp4Muxer:
+    # Minimal fragmented MP4 writer for a single h264 track. init() returns the header (ftyp and moov),
+    # then each call to fragment() returns a moof and mdat holding some samples. No re-encoding, we just re-wrap the encoder's NAL units
+    matrix = struct.pack('>9I', 0x00010000, 0, 0, 0, 0x00010000, 0, 0, 0, 0x40000000)
+
+    def __init__(self, width, height, timescale=1000000):
+        self.width = width
+        self.height = height
+        # Camera frame timestamps are in microseconds
+        self.timescale = timescale
+        self.sequence = 0
+        self.codec = None
+
+    def init(self, sps, pps):
+        # Browsers need this for MediaSource.addSourceBuffer()
+        self.codec = 'avc1.%02x%02x%02x' % (sps[1], sps[2], sps[3])
+        avcC = box(b'avcC',
+            # version, profile, compatibility, level, 4 byte NAL lengths
+            struct.pack('>5B', 1, sps[1], sps[2], sps[3], 0xff),
+            struct.pack('>BH', 0xe1, len(sps)), sps,
+            struct.pack('>BH', 1, len(pps)), pps)
+        avc1 = box(b'avc1',
+            b'\x00' * 6, struct.pack('>H', 1), b'\x00' * 16,
+            struct.pack('>HHIIIH', self.width, self.height, 0x00480000, 0x00480000, 0, 1),
+            b'\x00' * 32, struct.pack('>Hh', 0x18, -1),
+            avcC)
+        stbl = box(b'stbl',
+            fullBox(b'stsd', 0, 0, struct.pack('>I', 1), avc1),
+            fullBox(b'stts', 0, 0, struct.pack('>I', 0)),
+            fullBox(b'stsc', 0, 0, struct.pack('>I', 0)),
+            fullBox(b'stsz', 0, 0, struct.pack('>II', 0, 0)),
+            fullBox(b'stco', 0, 0, struct.pack('>I', 0)))
+        minf = box(b'minf',
+            fullBox(b'vmhd', 0, 1, b'\x00' * 8),
+            box(b'dinf', fullBox(b'dref', 0, 0, struct.pack('>I', 1), fullBox(b'url ', 0, 1))),
+            stbl)
+        mdia = box(b'mdia',
+            # language is 'und'
+            fullBox(b'mdhd', 0, 0, struct.pack('>IIIIHH', 0, 0, self.timescale, 0, 0x55c4, 0)),
+            fullBox(b'hdlr', 0, 0, struct.pack('>I4s', 0, b'vide'), b'\x00' * 12, b'VideoHandler\x00'),
+            minf)
+        trak = box(b'trak',
+            # flags: enabled, in movie
+            fullBox(b'tkhd', 0, 3, struct.pack('>IIIII', 0, 0, 1, 0, 0), b'\x00' * 8, struct.pack('>hhhH', 0, 0, 0, 0), self.matrix, struct.pack('>II', self.width << 16, self.height << 16)),
+            mdia)
+        moov = box(b'moov',
+            fullBox(b'mvhd', 0, 0, struct.pack('>IIIIIH', 0, 0, 1000, 0, 0x00010000, 0x0100), b'\x00' * 10, self.matrix, b'\x00' * 24, struct.pack('>I', 2)),
+            trak,
+            box(b'mvex', fullBox(b'trex', 0, 0, struct.pack('>IIIII', 1, 1, 0, 0, 0))))
+        ftyp = box(b'ftyp', b'isom', struct.pack('>I', 0x200), b'isom', b'iso5', b'avc1', b'mp41')
+        return ftyp + moov
+
+    def fragment(self, decodeTime, samples):
+        # samples is a list of (duration, keyframe, annex b data) tuples, durations in timescale units
+        self.sequence += 1
+        entries = []
+        data = []
+        for duration, keyframe, frame in samples:
+            size = 0
+            for unit in nalUnits(frame):
+                # SPS and PPS live in the header, and access unit delimiters aren't needed
+                if unit[0] & 0x1f in (7, 8, 9):
+                    continue
+                data.append(struct.pack('>I', len(unit)))
+                data.append(unit)
+                size += 4 + len(unit)
+            # Keyframes don't depend on other frames. Everything else does and isn't a sync sample
+            entries.append(struct.pack('>III', duration, size, 0x02000000 if keyframe else 0x01010000))
+        mdat = box(b'mdat', *data)
+
+        def moof(offset):
+            return box(b'moof',
+                fullBox(b'mfhd', 0, 0, struct.pack('>I', self.sequence)),
+                box(b'traf',
+                    # default-base-is-moof, so data offsets are relative to the start of moof
+                    fullBox(b'tfhd', 0, 0x020000, struct.pack('>I', 1)),
+                    fullBox(b'tfdt', 1, 0, struct.pack('>Q', decodeTime)),
+                    # data offset, sample duration, size and flags present
+                    fullBox(b'trun', 0, 0x000701, struct.pack('>Ii', len(samples), offset), *entries)))
+        # moof's size doesn't depend on the offset, so build it once to measure it
+        header = moof(0)
+        return moof(len(header) + 8) + mdat
+
+class H264Output(object):
+    # Output for camera.start_recording(). Hands the encoder's h264 to H264Stream along with the camera's frame info,
+    # which tells it where frames end and when they were captured. Live viewers and recordings all share this one encode
+    def __init__(self, camera, live):
+        self.camera = camera
+        self.live = live
+
+    def write(self, buf):
+        self.live.write(buf, self.camera.frame)
+        return len(buf)
+
+    def flush(self):
+        pass
+
+class H264Viewer:
+    # Access units waiting to be sent to one viewer or recording. gops counts the keyframes among them.
+    # Recordings keep everything, viewers that fall behind have GOPs dropped
+    def __init__(self, keepAll=False):
+        self.units = collections.deque()
+        self.gops = 0
+        self.dropped = 0
+        self.keepAll = keepAll
+
+class H264Stream:
+    # Collects the encoder's output into access units and fans them out to /stream.mp4 viewers and the recorder.
+    # We always hold the current GOP, so a new viewer starts from its keyframe instead of waiting for the next one.
+    # We also hold enough whole GOPs before it to cover secondsToSaveBeforeMotion, so a recording can start with them.
+    # Each viewer has its own queue. When a viewer falls more than liveMaxQueuedGops behind we drop whole GOPs,
+    # so it picks back up at a keyframe instead of getting a broken picture
+    # picamera.PiVideoFrameType values, so we don't need picamera to make sense of the frames it gives us
+    keyFrame = 1
+    spsHeader = 2
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.condition = threading.Condition()
+        self.pending = []
+        self.header = None
+        self.sps = None
+        self.pps = None
+        self.gop = []
+        # When the current GOP started, as ('camera' or 'clock', microseconds)
+        self.gopStart = None
+        # (gopStart, GOP) for the GOPs before the current one
+        self.preroll = collections.deque()
+        self.viewers = []
+
+    def write(self, buf, frame):
+        # Called from the encoder thread for every buffer, so this needs to be quick
+        self.pending.append(buf)
+        if frame is None:
+            return
+        if frame.frame_type == self.spsHeader:
+            # Keep the headers and send them along with the keyframe that follows
+            self.header = b''.join(self.pending)
+            self.pending = []
+            return
+        if not frame.complete:
+            return
+        start = time.time() if self.settings['detailedTimings'] else None
+        data = b''.join(self.pending)
+        self.pending = []
+        keyframe = frame.frame_type == self.keyFrame
+        if keyframe and self.header:
+            data = self.header + data
+            self.header = None
+        self._publish( (keyframe, frame.timestamp, data) )
+        if start is not None:
+            timings.add('h264.split', time.time() - start)
+
+    def _publish(self, unit):
+        keyframe, timestamp, data = unit
+        with self.condition:
+            if keyframe:
+                if self.sps is None:
+                    for nal in nalUnits(data):
+                        if nal[0] & 0x1f == 7:
+                            self.sps = nal
+                        elif nal[0] & 0x1f == 8:
+                            self.pps = nal
+                if self.gop:
+                    self.preroll.append( (self.gopStart, self.gop) )
+                # The camera doesn't always give us a timestamp, and then the clock is the next best thing. The two
+                # don't count from the same place, so a GOP timed by the other one is treated as too old
+                if timestamp is None:
+                    self.gopStart = ('clock', time.monotonic() * 1000000)
+                else:
+                    self.gopStart = ('camera', timestamp)
+                # We only need the oldest GOP if the one after it started less than secondsToSaveBeforeMotion ago
+                source, start = self.gopStart
+                cutoff = start - self.settings['secondsToSaveBeforeMotion'] * 1000000
+                while len(self.preroll) > 1 and (self.preroll[1][0][0] != source or self.preroll[1][0][1] <= cutoff):
+                    self.preroll.popleft()
+                self.gop = []
+            elif not self.gop:
+                # Haven't seen a keyframe yet, so there's nothing a viewer could decode this against
+                return
+            self.gop.append(unit)
+
+            for viewer in self.viewers:
+                if keyframe:
+                    if viewer.gops >= self.settings['liveMaxQueuedGops'] and not viewer.keepAll:
+                        # Too far behind. Skip straight to this keyframe
+                        viewer.dropped += viewer.gops
+                        viewer.units.clear()
+                        viewer.gops = 0
+                    viewer.gops += 1
+                viewer.units.append(unit)
+            self.condition.notify_all()
+
+    def join(self):
+        # Returns None if we already have as many viewers as we allow, or haven't seen a keyframe yet
+        with self.condition:
+            viewers = sum(1 for viewer in self.viewers if not viewer.keepAll)
+            if viewers >= self.settings['liveMaxViewers'] or not self.gop or self.sps is None:
+                return None
+            viewer = H264Viewer()
+            viewer.units.extend(self.gop)
+            viewer.gops = 1
+            self.viewers.append(viewer)
+            return viewer
+
+    def record(self):
+        # Like join(), but starts with the pre-roll and never drops anything. Returns None if we haven't seen a keyframe yet
+        with self.condition:
+            if not self.gop or self.sps is None:
+                return None
+            viewer = H264Viewer(keepAll=True)
+            for start, gop in self.preroll:
+                viewer.units.extend(gop)
+            viewer.units.extend(self.gop)
+            viewer.gops = len(self.preroll) + 1
+            self.viewers.append(viewer)
+            return viewer
+
+    def leave(self, viewer):
+        with self.condition:
+            self.viewers.remove(viewer)
+
+    def get(self, viewer, timeout):
+        with self.condition:
+            if not self.condition.wait_for(lambda: viewer.units, timeout):
+                return None
+            unit = viewer.units.popleft()
+            if unit[0]:
+                viewer.gops -= 1
+            return unit
 
-        cv2.absdiff(self.previous, self.grayscale, dst=self.diff)
-        numpy.multiply(self.ignore, self.diff, out=self.scratch)
-        # rely on numpy to ignore certain portions of the frame by multiplying those pixels by 0
-        cv2.threshold(self.scratch, 25, 255, cv2.THRESH_BINARY, self.threshold)
+class Timings:
+    # Per-stage timings, so we can see where each capture/detect/record cycle goes.
+    # Percentiles are over the last `recent` runs of each stage, so they show how things are going now rather than since we started
+    def __init__(self, recent=1000):
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.recent = recent
 
-        # Add up all pixels. Pixels with motion will have a value of 255
-        pixelSum = numpy.sum(self.threshold)
-        if pixelSum > self.cutoff: # motion detected in frame
-            # Log that we are seeing motion
-            self.motionDetected = True
-            self.motionAtTimestamp = currentFrameTimestamp
-            # Stop recording after 10 seconds of no motion
-            self.stopRecordingAfterTimestamp = currentFrameTimestamp + self.stopRecordingAfterTimestampDelta                        
-            print('Seeing motion. Will stop recording after %s' % str(self.stopRecordingAfterTimestamp))
+    def add(self, stage, seconds):
+        with self.lock:
+            if stage not in self.stages:
+                self.stages[stage] = {'count': 0, 'total': 0.0, 'last': 0.0, 'max': 0.0, 'recent': collections.deque(maxlen=self.recent)}
+            s = self.stages[stage]
+            s['count'] += 1
+            s['total'] += seconds
+            s['last'] = seconds
+            if seconds > s['max']:
+                s['max'] = seconds
+            s['recent'].append(seconds)
 
-            # Let's only use the current frame for detection if it contains motion.
-            # The thought is that we want to detect very slow moving objects ... objects that might not trigger 2% of pixel changes within 1/3 second but that might over a longer time frame.
-            numpy.copyto(self.previous, self.grayscale)
-        # End conditional frame comparison logic
+    def snapshot(self):
+        with self.lock:
+            stages = dict( (stage, dict(s, recent=list(s['recent']))) for stage, s in self.stages.items() )
+        # Sorting happens outside the lock, so the threads adding timings don't wait on it
+        o = {}
+        for stage, s in stages.items():
+            recent = sorted(s['recent'])
+            o[stage] = {
+                'count': s['count'],
+                'total': s['total'],
+                'average': s['total'] / s['count'],
+                'last': s['last'],
+                'max': s['max'],
+                'p50': recent[len(recent) // 2],
+                'p95': recent[min(len(recent) - 1, len(recent) * 95 // 100)],
+                'p99': recent[min(len(recent) - 1, len(recent) * 99 // 100)]
+            }
+        return o
+
+timings = Timings()
+profiler = StackSampler()
+
+class EventBus:
+    # Recent events for /events. Each gets an increasing id, so a client that reconnects with Last-Event-ID
+    # gets what it missed, and a new client gets the last few so it knows the current state.
+    # Periodic kinds like metrics would soon push every state change out of the replay, so we only keep the latest of each
+    def __init__(self, size, maxClients, periodic=('metrics',)):
+        self.condition = threading.Condition()
+        self.events = collections.deque(maxlen=size)
+        self.periodic = set(periodic)
+        # kind -> the latest (id, kind, json) of each periodic kind
+        self.latest = {}
+        self.id = 0
+        self.maxClients = maxClients
+        self.clients = 0
+
+    def publish(self, kind, data):
+        with self.condition:
+            self.id += 1
+            event = (self.id, kind, json.dumps(data))
+            if kind in self.periodic:
+                self.latest[kind] = event
+            else:
+                self.events.append(event)
+            self.condition.notify_all()
+
+    def since(self, lastId, timeout):
+        # Waits for events newer than lastId. Returns a list of (id, kind, json) in id order, empty if we timed out
+        with self.condition:
+            self.condition.wait_for(lambda: self.id > lastId, timeout)
+            pending = [event for event in self.events if event[0] > lastId]
+            pending.extend(event for event in self.latest.values() if event[0] > lastId)
+            return sorted(pending)
+
+    def join(self):
+        with self.condition:
+            if self.clients >= self.maxClients:
+                return False
+            self.clients += 1
+            return True
+
+    def leave(self):
+        with self.condition:
+            self.clients -= 1
+
+class StillCache:
+    # JPEGs of the latest still. Each variant is encoded at most once per frame generation and shared by every viewer,
+    # so more open browser tabs don't mean more encodes competing with motion detection
+    def __init__(self, store, settings):
+        self.store = store
+        self.settings = settings
+        self.lock = threading.Lock()
+        self.generation = None
+        # (width, quality) -> JPEG bytes for the current generation
+        self.variants = {}
+
+    def variant(self, width, quality):
+        # Clamp requested variants so clients can't make us upscale or pick silly values
+        if width is None or width >= self.settings['width']:
+            width = None
+        else:
+            width = max(16, width)
+        if quality is None:
+            quality = self.settings['stillQuality']
+        quality = min(100, max(10, quality))
+        return (width, quality)
+
+    def etag(self, width, quality):
+        generation = self.store.generation
+        if generation == 0:
+            return None
+        return self._etag(generation, width, quality)
+
+    def _etag(self, generation, width, quality):
+        return '"%d-%s-%d"' % (generation, width or 'full', quality)
+
+    def get(self, width, quality):
+        # Returns (etag, jpeg bytes) for the latest frame, or None if nothing has been captured yet
+        frame = self.store.acquire()
+        if frame is None:
+            return None
+        slot, image, generation = frame
+        try:
+            jpeg = None
+            # Held while encoding so concurrent requests for the same frame wait for one encode instead of each doing their own
+            with self.lock:
+                if self.generation is None or generation > self.generation:
+                    self.generation = generation
+                    self.variants = {}
+                if generation == self.generation:
+                    key = (width, quality)
+                    if key not in self.variants:
+                        self.variants[key] = self._encode(image, width, quality)
+                    jpeg = self.variants[key]
+            if jpeg is None:
+                # Someone already cached a newer frame while we were waiting for the lock. Don't throw their JPEGs away
+                # for ours, this request just gets an encode of its own
+                jpeg = self._encode(image, width, quality)
+        finally:
+            self.store.release(slot)
+        return (self._etag(generation, width, quality), jpeg)
 
-        if self.motionDetected and self.stopRecordingAfterTimestamp < currentFrameTimestamp:
-            # Tell writer we haven't seen motion for a while
-            print("%d seconds without motion" % self.stopRecordingAfterTimestampDelta)
+    def _encode(self, image, width, quality):
+        import cv2
+        start = time.time()
+        if width:
+            height = round(image.shape[0] * width / image.shape[1])
+            image = cv2.resize(image, (width, height), interpolation=cv2.INTER_AREA)
+        jpeg = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, quality])[1].tobytes()
+        timings.add('jpeg', time.time() - start)
+        return jpeg
 
-            # Commented out the following so we preserve the timestamp of last motion
-            #self.motionAtTimestamp = 0
-            # Log that we are no longer seeing motion
-            self.motionDetected = False
+def motionVectorAnalysis(camera):
+    # motion_output for the 'vectors' detector. picamera calls analyse() from the encoder thread with the motion vectors
+    # for every frame. The class is made here so picamera is only imported on the Pi.
+    # The camera starts recording before the detector exists, so vectors are dropped until main() sets detector
+    import picamera.array
 
+    class MotionVectorAnalysis(picamera.array.PiMotionAnalysis):
+        detector = None
+
+        def analyse(self, a):
+            # Hand off to the detection worker so we never hold up the encoder
+            if self.detector:
+                self.detector.frames.put(time.time(), a)
+
+    return MotionVectorAnalysis(camera)
 
 class requestHandler(http.server.BaseHTTPRequestHandler):
+    # HTTP/1.1 so browsers can keep connections open between polls. That means every response needs a Content-Length,
+    # except for the streams, which close the connection when they're done
+    protocol_version = 'HTTP/1.1'
+    # Close idle keep-alive connections so they don't tie up a pool thread for long
+    timeout = 5
+
+    # Paths we count requests for. Everything else is counted as 'other', so a scan for random URLs can't make endless series
+    routes = set(['/', '/status.json', '/metrics', '/profile', '/recordings', '/storage.json', '/still.jpeg', '/stream.mjpeg', '/stream.mp4', '/events', '/config.json'])
+
     def log_message(self, *args):
         # Suppress the default behavior of logging every incoming HTTP request to stdout
         return
 
+    def send_response(self, code, message=None):
+        # Every response goes through here, errors included
+        path = urllib.parse.urlparse(getattr(self, 'path', '')).path
+        if path.startswith('/recordings/'):
+            route = '/recordings/<id>'
+        elif path in self.routes:
+            route = path
+        else:
+            route = 'other'
+        metrics.count('http_requests', route=route, status=code)
+        super().send_response(code, message)
+
+    def respond(self, status, contentType, body, headers={}):
+        self.send_response(status)
+        self.send_header('Content-Type', contentType)
+        self.send_header('Content-Length', len(body))
+        if self.server.busy():
+            # Other connections are waiting for a thread, so give this one up rather than keeping it alive
+            self.close_connection = True
+            self.send_header('Connection', 'close')
+        for name in headers:
+            self.send_header(name, headers[name])
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError, socket.timeout):
+            # Client went away
+            self.close_connection = True
+
+    def startStream(self, contentType, headers={}):
+        # Streams have no length, so the connection closes when they end
+        self.close_connection = True
+        # Give slow viewers longer than the keep-alive timeout before we give up on them
+        self.connection.settimeout(30)
+        self.send_response(200)
+        self.send_header('Content-Type', contentType)
+        self.send_header('Cache-Control', 'no-cache, private')
+        self.send_header('Connection', 'close')
+        for name in headers:
+            self.send_header(name, headers[name])
+        self.end_headers()
+
+    def sendFile(self, path, contentType):
+        # Sends a file with a single byte range if asked, so browsers can seek in videos and downloads can resume
+        try:
+            f = open(path, 'rb')
+        except OSError:
+            self.send_error(404)
+            return
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            start = 0
+            end = size - 1
+            status = 200
+            # Malformed or multiple ranges are ignored, and we send the whole file
+            match = re.match(r'^bytes=(\d*)-(\d*)$', self.headers.get('Range', '').strip())
+            if match and (match.group(1) or match.group(2)):
+                if match.group(1):
+                    start = int(match.group(1))
+                    if match.group(2):
+                        end = min(int(match.group(2)), size - 1)
+                else:
+                    # The last N bytes
+                    start = max(0, size - int(match.group(2)))
+                if start > end:
+                    self.respond(416, 'text/plain', b'', {'Content-Range': 'bytes */%d' % size})
+                    return
+                status = 206
+
+            self.send_response(status)
+            self.send_header('Content-Type', contentType)
+            self.send_header('Content-Length', end - start + 1)
+            self.send_header('Accept-Ranges', 'bytes')
+            # Recordings never change once they're indexed
+            self.send_header('Cache-Control', 'private, max-age=86400')
+            if status == 206:
+                self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, size))
+            if self.server.busy():
+                self.close_connection = True
+                self.send_header('Connection', 'close')
+            self.end_headers()
+            if end < start:
+                return
+            # Give slow downloads longer than the keep-alive timeout
+            self.connection.settimeout(30)
+            try:
+                # Straight from the page cache to the socket, without copying through Python
+                self.connection.sendfile(f, start, end - start + 1)
+            except (BrokenPipeError, ConnectionResetError, socket.timeout):
+                # Client went away
+                self.close_connection = True
+            self.connection.settimeout(self.timeout)
+
     def do_POST(self):
-        global settings
         url = urllib.parse.urlparse(self.path)
         path = url.path
+        contentLength = int(self.headers.get('Content-Length', 0))
+        # Always read the body, otherwise it would be mistaken for the next request on this connection
+        data = self.rfile.read(contentLength).decode('utf-8')
         if path == '/config.json':
-            contentLength = int(self.headers['Content-Length'])
-            data = self.rfile.read(contentLength).decode('utf-8')
-            o = json.loads(data)
-            print('Updating settings', data)
-            mergeConfig(o)
-            self.send_response(200)
-            self.send_header('Content-Type', 'application/json')
-            self.end_headers()
-            self.wfile.write(b"{}")
-
+            try:
+                o = json.loads(data)
+                log.info('Updating settings', extra={'settings': o})
+                result = mergeConfig(o)
+            except ValueError as e:
+                # Includes malformed JSON
+                self.respond(400, 'application/json', json.dumps({'error': str(e)}).encode('utf-8'))
+                return
+            self.respond(200, 'application/json', json.dumps(result).encode('utf-8'))
+        else:
+            self.send_error(404)
 
     def do_GET(self):
         url = urllib.parse.urlparse(self.path)
         path = url.path
         if path == '/':
-            with open('index.html', 'r') as f:
-                html = f.read()
-            self.send_response(200)
-            self.send_header('Content-Type', 'text/html')
-            #self.send_headers('Content-Length', len(html))
-            self.end_headers()
-            self.wfile.write(html.encode())
+            self.respond(200, 'text/html; charset=utf-8', self.server.index)
+
         elif path == '/status.json':
             data = {
                 'motion': motionDetection.motionDetected,
-                'motionAtTimestamp': motionDetection.motionAtTimestamp
+                'motionAtTimestamp': motionDetection.motionAtTimestamp,
+                'droppedFrames': motionDetection.frames.dropped,
+                'zones': motionDetection.zoneScores,
+                'writer': writer.stats(),
+                'timings': timings.snapshot()
             }
-            self.send_response(200)
-            self.send_header('Content-Type', 'application/json')
-            self.end_headers()
-            self.wfile.write( json.dumps(data).encode() )
+            self.respond(200, 'application/json', json.dumps(data).encode())
 
-        elif path == '/still.jpeg':
-            if self.wfile.closed or not self.wfile.writable():
+        elif path == '/metrics':
+            # For Prometheus or anything else that scrapes. Sampled values are up to secondsBetweenMetrics old
+            self.respond(200, 'text/plain; version=0.0.4', metrics.prometheus().encode('utf-8'))
+
+        elif path == '/profile':
+            # Samples what every thread is doing for ?seconds=N and sends the collapsed stacks, ready for a flame graph.
+            # Waiting threads are left out unless you add ?idle=1
+            query = urllib.parse.parse_qs(url.query)
+            try:
+                seconds = float(query.get('seconds', ['10'])[0])
+            except ValueError:
+                seconds = 0
+            if not 0 < seconds <= 120:
+                self.respond(400, 'text/plain', b'seconds must be more than 0 and at most 120')
+                return
+            result = profiler.capture(seconds, idle=query.get('idle', ['0'])[0] == '1')
+            if result is None:
+                self.respond(409, 'text/plain', b'Already capturing a profile, try again shortly')
                 return
+            samples, stacks = result
+            filename = 'profile-%s-%s.txt' % (socket.gethostname(), datetime.datetime.now().strftime('%Y%m%d%H%M%S'))
+            self.respond(200, 'text/plain; charset=utf-8', stacks.encode('utf-8'), {'Content-Disposition': 'attachment; filename="%s"' % filename, 'X-Samples': samples})
+
+        elif path == '/recordings':
+            # ?before=<id> pages back through older recordings, ?day=YYYYMMDD picks one day
+            query = urllib.parse.parse_qs(url.query)
+            try:
+                before = int(query.get('before', ['0'])[0])
+                limit = max(1, min(200, int(query.get('limit', ['50'])[0])))
+            except ValueError:
+                self.send_error(400)
+                return
+            recordings = self.server.recordings.list(before, limit, query.get('day', [None])[0])
+            for recording in recordings:
+                recording['video'] = '/recordings/%d.mp4' % recording['id']
+                recording['thumbnail'] = '/recordings/%d.jpg' % recording['id'] if recording['thumbnail'] else None
+            data = {
+                'recordings': recordings,
+                'before': recordings[-1]['id'] if len(recordings) == limit else None
+            }
+            self.respond(200, 'application/json', json.dumps(data).encode())
+
+        elif re.match(r'^/recordings/\d+\.(mp4|jpg)$', path):
+            id, extension = path[12:].split('.')
+            recording = self.server.recordings.get(int(id))
+            if recording is None or (extension == 'jpg' and not recording['thumbnail']):
+                self.send_error(404)
+                return
+            if extension == 'mp4':
+                self.sendFile(recording['path'], 'video/mp4')
+            else:
+                self.sendFile(recording['thumbnail'], 'image/jpeg')
+
+        elif path == '/storage.json':
+            data = self.server.storage.stats()
+            data['limits'] = dict( (key, settings[key]) for key in ('storageMaxGigabytes', 'storageMaxDays', 'storageReserveMegabytes', 'storageMinimumFreeMegabytes') )
+            self.respond(200, 'application/json', json.dumps(data).encode())
+
+        elif path == '/still.jpeg':
             if self.server.still is None:
-                return False
+                self.send_error(503, 'Not capturing yet')
+                return
 
-            # TODO: race condition alert. should not use a buffer that's being actively used by MotionDetection
-            still = cv2.imencode('.jpg', self.server.still)[1]
+            # Optional ?width=N&quality=N for a smaller variant
+            query = urllib.parse.parse_qs(url.query)
+            try:
+                width = int(query['width'][0]) if 'width' in query else None
+                quality = int(query['quality'][0]) if 'quality' in query else None
+            except ValueError:
+                self.send_error(400)
+                return
+            width, quality = self.server.still.variant(width, quality)
 
-            # send headers
-            self.send_response(200)
-            self.send_header('Content-Type', 'image/jpeg')
-            self.send_header('Content-Length', len(still))
-            self.end_headers()
-            # this doesn't seem to work
+            etag = self.server.still.etag(width, quality)
+            if etag is not None and self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.end_headers()
+                return
+
+            cached = self.server.still.get(width, quality)
+            if cached is None:
+                self.send_error(503, 'Not capturing yet')
+                return
+            etag, still = cached
+            self.respond(200, 'image/jpeg', still, {'ETag': etag, 'Cache-Control': 'no-cache'})
+
+        elif path == '/stream.mjpeg':
+            if not self.server.live.join():
+                self.send_error(503, 'Too many viewers')
+                return
+            try:
+                self.startStream('multipart/x-mixed-replace; boundary=FRAME', {'Age': 0, 'Pragma': 'no-cache'})
+
+                minimumInterval = 1.0 / self.server.live.settings['streamMaxFps']
+                generation = 0
+                sentAt = 0
+                while True:
+                    delay = sentAt + minimumInterval - time.time()
+                    if delay > 0:
+                        time.sleep(delay)
+                    generation, frame = self.server.live.output.wait(generation, 5.0)
+                    if frame is None:
+                        log.warning('No frames from MJPEG encoder, closing stream')
+                        break
+                    sentAt = time.time()
+                    self.wfile.write(b'--FRAME\r\n')
+                    self.send_header('Content-Type', 'image/jpeg')
+                    self.send_header('Content-Length', len(frame))
+                    self.end_headers()
+                    self.wfile.write(frame)
+                    self.wfile.write(b'\r\n')
+            except (BrokenPipeError, ConnectionResetError, socket.timeout):
+                # Viewer went away
+                pass
+            finally:
+                self.server.live.leave()
+
+        elif path == '/stream.mp4':
+            live = self.server.h264
+            viewer = live.join()
+            if viewer is None:
+                self.send_error(503, 'Too many viewers, or no keyframe yet')
+                return
             try:
-                self.wfile.write(still)
-            except BrokenPipeError as e:
-                print('BrokenPipeError')
-            except ConnectionResetError as e:
-                print('ConnectionResetError')
+                muxer = Mp4Muxer(live.settings['width'], live.settings['height'])
+                header = muxer.init(live.sps, live.pps)
+                # X-Codec tells the browser what to pass to MediaSource.addSourceBuffer()
+                self.startStream('video/mp4', {'X-Codec': muxer.codec})
+                self.wfile.write(header)
+
+                # One frame per fragment keeps latency down. We don't know how long a frame lasts until the next arrives, so assume 1/fps
+                frameDuration = muxer.timescale // live.settings['fps']
+                firstTimestamp = None
+                decodeTime = 0
+                while True:
+                    unit = live.get(viewer, 5.0)
+                    if unit is None:
+                        log.warning('No frames from h264 encoder, closing stream')
+                        break
+                    keyframe, timestamp, data = unit
+                    if timestamp is not None:
+                        if firstTimestamp is None:
+                            firstTimestamp = timestamp
+                        decodeTime = timestamp - firstTimestamp
+                    self.wfile.write(muxer.fragment(decodeTime, [ (frameDuration, keyframe, data) ]))
+                    decodeTime += frameDuration
+            except (BrokenPipeError, ConnectionResetError, socket.timeout):
+                # Viewer went away
+                pass
+            finally:
+                live.leave(viewer)
+
+        elif path == '/events':
+            bus = self.server.events
+            if not bus.join():
+                self.send_error(503, 'Too many clients')
+                return
+            try:
+                try:
+                    lastId = int(self.headers.get('Last-Event-ID', 0))
+                except ValueError:
+                    lastId = 0
+                if lastId > bus.id:
+                    # We restarted since this client last connected, so ids started over
+                    lastId = 0
+                self.startStream('text/event-stream')
+                self.wfile.write(b'retry: 3000\n\n')
+                if lastId == 0:
+                    # Motion that started before the replay window would otherwise never reach a new client. These have no id,
+                    # and anything replayed after them is newer
+                    for kind, data in stateEvents():
+                        self.wfile.write( ('event: %s\ndata: %s\n\n' % (kind, json.dumps(data))).encode() )
+                while True:
+                    pending = bus.since(lastId, 15.0)
+                    if not pending:
+                        # Heartbeat, so proxies don't time us out and we notice when the client goes away
+                        self.wfile.write(b': heartbeat\n\n')
+                        continue
+                    for id, kind, data in pending:
+                        self.wfile.write( ('id: %d\nevent: %s\ndata: %s\n\n' % (id, kind, data)).encode() )
+                    lastId = pending[-1][0]
+            except (BrokenPipeError, ConnectionResetError, socket.timeout):
+                # Client went away
+                pass
+            finally:
+                bus.leave()
 
         else:
-            # TODO: return 404
-            return False
+            self.send_error(404)
+
+class PooledHTTPServer(http.server.ThreadingHTTPServer):
+    # Like ThreadingHTTPServer, but connections are handled by a fixed pool of threads instead of a new thread each,
+    # so a burst of clients can't pile up threads on a Pi. Connections beyond the pool wait their turn
+    daemon_threads = True
+    # The default listen backlog of 5 drops connections when many clients reconnect at once
+    request_queue_size = 64
+
+    def __init__(self, address, handler, threads):
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=threads, thread_name_prefix='http')
+        self.lock = threading.Lock()
+        self.waiting = 0
+        http.server.ThreadingHTTPServer.__init__(self, address, handler)
+
+    def process_request(self, request, client_address):
+        with self.lock:
+            self.waiting += 1
+        self.pool.submit(self.processPooled, request, client_address)
+
+    def processPooled(self, request, client_address):
+        with self.lock:
+            self.waiting -= 1
+        self.process_request_thread(request, client_address)
+
+    def busy(self):
+        # True if connections are queued waiting for a thread
+        return self.waiting > 0
+
+    def server_close(self):
+        http.server.ThreadingHTTPServer.server_close(self)
+        self.pool.shutdown(wait=False)
 
 class Streamer(threading.Thread):
-    def __init__(self):
-        threading.Thread.__init__(self)
+    def __init__(self, settings):
+        threading.Thread.__init__(self, name=type(self).__name__)
         self.outputs = []
-        self.httpd = http.server.HTTPServer(('0.0.0.0', 8080), requestHandler)
+        # Each stream viewer holds a thread for as long as it watches, so leave room for them on top of regular requests
+        threads = settings['httpThreads'] + settings['streamMaxViewers'] + settings['liveMaxViewers'] + settings['eventsMaxClients']
+        self.httpd = PooledHTTPServer(('0.0.0.0', 8080), requestHandler, threads)
+        # Read once, rather than on every request
+        with open('index.html', 'rb') as f:
+            self.httpd.index = f.read()
         self.httpd.still = None
+        self.httpd.live = None
+        self.httpd.h264 = None
+        self.httpd.storage = None
+        self.httpd.recordings = None
+        self.httpd.events = events
         self.start()
     
     def run(self):
         self.httpd.serve_forever()
         
     def done(self):
-        print('Streamer exiting')
+        log.info('Streamer exiting')
         self.httpd.shutdown()
+        self.httpd.server_close()
 
 class Periodic(threading.Thread):
     def __init__(self, settings):
-        threading.Thread.__init__(self)
+        # Named after the subclass, so logs and /profile say which thread is which
+        threading.Thread.__init__(self, name=type(self).__name__)
         self.settings = settings
         self.running = True
         self.start()
@@ -252,141 +907,934 @@ class Periodic(threading.Thread):
     def done(self):
         self.running = False
 
+def cpuTemperature():
+    # gpiozero's CPUTemperature, or None if we can't read it. gpiozero takes a while to import, so we wait until a thread asks
+    try:
+        import gpiozero
+        return gpiozero.CPUTemperature()
+    except Exception as e:
+        log.warning('Unable to read CPU temperature: %s', e)
+        return None
+
 class Heartbeat(Periodic):
+    # Tells the hub (hub.py) we're alive every 2 seconds, along with where to find our stream and how we're doing
     def run(self):
         sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sequence = 0
+        cpu = cpuTemperature()
         while self.running:
-            sock.sendto(b"hi", (self.settings['heartbeatServer'], self.settings['heartbeatPort']))
+            try:
+                temperature = cpu.temperature if cpu else None
+            except Exception:
+                temperature = None
+            payload = packHeartbeat(
+                self.settings['heartbeatName'] or socket.gethostname(),
+                sequence,
+                streamer.httpd.server_address[1],
+                self.settings['fps'],
+                motionDetection.motionDetected,
+                recorder.viewer is not None,
+                temperature,
+                storage.stats()['freeBytes'] // 1048576
+            )
+            try:
+                sock.sendto(payload, (self.settings['heartbeatServer'], self.settings['heartbeatPort']))
+            except OSError as e:
+                # Network's down. We'll try again next time
+                log.warning('Failed to send heartbeat: %s', e)
+            sequence += 1
             time.sleep(2)
 
-class Temperature(Periodic):
+class MetricsSampler(Periodic):
+    # Records temperature, queue depths, totals and stage timings in metrics every secondsBetweenMetrics.
+    # HTTP requests are counted as they happen. The InfluxExporter sends what we sample, on its own thread
     def run(self):
-        influx_url = 'http://%s:8086/write' % (self.settings['heartbeatServer'],)
+        cpu = cpuTemperature()
         while self.running:
-            cpu = gpiozero.CPUTemperature()
-            s = 'raspi.temperature_celsius,host=%s value=%f %d' % (socket.gethostname(), math.floor(cpu.temperature), time.time_ns())
-            r = requests.post(influx_url, params={'db': 'cube'}, data=s)
-            time.sleep(30)
+            if cpu:
+                # sysfs reads can fail now and then. We skip the gauge rather than lose the rest of the metrics
+                try:
+                    metrics.gauge('temperature_celsius', cpu.temperature)
+                except Exception as e:
+                    log.warning('Unable to read CPU temperature: %s', e)
+            metrics.gauge('frame_queue_depth', len(motionDetection.frames.queued))
+            metrics.total('dropped_frames', motionDetection.frames.dropped)
+            metrics.gauge('motion_score', motionDetection.score)
+            stats = writer.stats()
+            metrics.gauge('writer_queue_depth', stats['queued'])
+            metrics.gauge('writer_queued_bytes', stats['queuedBytes'])
+            metrics.total('recording_bytes_written', stats['written'])
+            metrics.total('recording_writes_dropped', stats['dropped'])
+            metrics.total('recording_write_errors', stats['errors'])
+            metrics.gauge('storage_free_bytes', storage.stats()['freeBytes'])
+            metrics.gauge('stream_viewers', streamer.httpd.live.viewers)
+            metrics.gauge('event_clients', events.clients)
+            # Detection, capture, JPEG encoding and the rest, see Timings
+            for stage, s in timings.snapshot().items():
+                metrics.total('stage_runs', s['count'], stage=stage)
+                metrics.total('stage_seconds', s['total'], stage=stage)
+                metrics.gauge('stage_max_seconds', s['max'], stage=stage)
+                for quantile in ('p50', 'p95', 'p99'):
+                    metrics.gauge('stage_seconds_' + quantile, s[quantile], stage=stage)
+            metrics.sample()
+            time.sleep(self.settings['secondsBetweenMetrics'])
+
+class MetricsEvents(Periodic):
+    # Publishes detection metrics to /events every so often
+    def run(self):
+        while self.running:
+            time.sleep(self.settings['secondsBetweenMetricsEvents'])
+            events.publish('metrics', {
+                'droppedFrames': motionDetection.frames.dropped,
+                'zones': motionDetection.zoneScores,
+                'writer': writer.stats(),
+                'timings': timings.snapshot()
+            })
+
+def motionEvent(motion):
+    return {'motion': motion, 'motionAtTimestamp': motionDetection.motionAtTimestamp, 'zone': motionDetection.motionZone}
+
+def publishMotion(event, t):
+    # Detector listener that forwards motion changes to /events
+    events.publish('motion', motionEvent(event == 'motionStarted'))
+
+def stateEvents():
+    # (kind, data) describing where things stand now, in the same form as the events that change them, for new /events clients
+    state = [ ('motion', motionEvent(motionDetection.motionDetected)) ]
+    if recorder.viewer is not None:
+        state.append( ('recording', {'state': 'started', 'file': recorder.path}) )
+    return state
 
+class FrameCapture(Periodic):
+    # Producer: captures frames for the detector every secondsBetweenDetection
+    def __init__(self, settings, detector):
+        self.detector = detector
+        Periodic.__init__(self, settings)
 
+    def run(self):
+        captureAt = time.time()
+        while self.running:
+            delay = captureAt - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            t = time.time()
+            # Schedule from when this capture was due rather than when it finished, so slow captures don't stretch the cadence.
+            # If we've fallen a whole interval behind, start over from now instead of bursting to catch up
+            captureAt = max(captureAt + self.settings['secondsBetweenDetection'], t)
+            self.detector.capture()
+            timings.add('capture', time.time() - t)
+
+class DetectionWorker(Periodic):
+    # Consumer: runs the detector on queued frames as they arrive
+    def __init__(self, settings, detector):
+        self.detector = detector
+        Periodic.__init__(self, settings)
+
+    def run(self):
+        while self.running:
+            frames = self.detector.frames
+            frame = frames.get(0.5)
+            if frame is None:
+                # Nothing captured recently, but motion may still need to time out
+                self.detector._expire(time.time())
+                continue
+            t, buffer = frame
+            start = time.time()
+            timings.add('queue', start - t)
+            try:
+                self.detector.detect(frames, buffer, t)
+            except Exception:
+                log.exception('Exception while detecting motion')
+            finally:
+                frames.release(buffer)
+            end = time.time()
+            timings.add('detect', end - start)
+            # From capture to detection result
+            timings.add('cycle', end - t)
+
+class Storage(threading.Thread):
+    # Keeps the recordings folder within its limits, see storageMaxGigabytes in config.py. Usage per day folder is counted once
+    # on start, then kept up to date as the Writer writes and we delete, so we never walk the whole tree again.
+    # Deleting is done on this thread, since removing thousands of files can take a while on an SD card
+    def __init__(self, root, settings):
+        threading.Thread.__init__(self, name=type(self).__name__)
+        self.root = root
+        self.settings = settings
+        self.condition = threading.Condition()
+        self.requested = False
+        self.running = True
+        # Bytes in each YYYYMMDD folder
+        self.days = {}
+        # The folder being written to, which we never delete
+        self.active = None
+        self.free = 0
+        self.total = 0
+        self.evictedDays = 0
+        self.evictedBytes = 0
+        self.lastEviction = None
+        self.skipped = 0
+        # Called with the name of each day folder we delete
+        self.listeners = []
+        self.scan()
+        self.start()
+
+    def scan(self):
+        os.makedirs(self.root, exist_ok=True)
+        for day in os.scandir(self.root):
+            if not day.is_dir():
+                continue
+            size = 0
+            for entry in os.scandir(day.path):
+                if entry.is_file():
+                    size += entry.stat().st_size
+            self.days[day.name] = size
+        self.checkFree()
+
+    def checkFree(self):
+        usage = shutil.disk_usage(self.root)
+        self.free = usage.free
+        self.total = usage.total
+
+    def opened(self, path):
+        # Called by the Writer
+        with self.condition:
+            self.active = os.path.basename(os.path.dirname(path))
+            self.days.setdefault(self.active, 0)
+
+    def closed(self):
+        with self.condition:
+            self.active = None
+
+    def add(self, size):
+        # Called by the Writer with the bytes it just wrote to the open file
+        with self.condition:
+            if self.active is not None:
+                self.days[self.active] = self.days.get(self.active, 0) + size
+            self.free -= size
+
+    def canRecord(self):
+        # Called by the recorder before each event. Also makes sure we clear some headroom for it
+        self.request()
+        with self.condition:
+            if self.free >= self.settings['storageMinimumFreeMegabytes'] * 1048576:
+                return True
+            self.skipped += 1
+            return False
+
+    def request(self):
+        with self.condition:
+            self.requested = True
+            self.condition.notify()
+
+    def done(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+
+    def stats(self):
+        with self.condition:
+            return {
+                'usedBytes': sum(self.days.values()),
+                'freeBytes': self.free,
+                'totalBytes': self.total,
+                'days': dict(self.days),
+                'evictedDays': self.evictedDays,
+                'evictedBytes': self.evictedBytes,
+                'lastEviction': self.lastEviction,
+                'skippedRecordings': self.skipped
+            }
+
+    def run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.requested or not self.running, 60)
+                if not self.running:
+                    return
+                self.requested = False
+            try:
+                self.enforce()
+            except OSError:
+                log.exception('Exception while freeing up space')
+
+    def enforce(self):
+        # Deletes the oldest day folders until we're within every limit
+        while True:
+            self.checkFree()
+            with self.condition:
+                days = sorted(day for day in self.days if day != self.active)
+                used = sum(self.days.values())
+            if not days:
+                if self.free < self.settings['storageReserveMegabytes'] * 1048576:
+                    log.warning('Low on space, but there are no old recordings left to delete')
+                return
+            maxBytes = self.settings['storageMaxGigabytes'] * 1073741824
+            maxDays = self.settings['storageMaxDays']
+            cutoff = (datetime.datetime.now() - datetime.timedelta(days=maxDays)).strftime('%Y%m%d')
+            if not (self.free < self.settings['storageReserveMegabytes'] * 1048576
+                    or (maxBytes and used > maxBytes)
+                    or (maxDays and days[0] < cutoff)):
+                return
+            self.evict(days[0])
+
+    def evict(self, day):
+        log.info('Deleting recordings from %s to free up space', day)
+        start = time.time()
+        shutil.rmtree(os.path.join(self.root, day), ignore_errors=True)
+        timings.add('evict', time.time() - start)
+        with self.condition:
+            size = self.days.pop(day, 0)
+            self.evictedDays += 1
+            self.evictedBytes += size
+            self.lastEviction = day
+        for listener in self.listeners:
+            listener(day)
+        events.publish('storage', {'evicted': day, 'bytes': size})
+
+class Writer(threading.Thread):
+    # Does all the disk I/O for recordings, so a slow SD card never holds up the recorder, capture or detection.
+    # The recorder queues up open, write and close operations. Whatever has piled up is written with one os.writev(),
+    # and we fsync every secondsBetweenFsync and on close. When more than writerMaxQueuedMegabytes is waiting, new writes
+    # are dropped instead of using up memory. Recordings are fragmented mp4, so a dropped fragment leaves a gap, not a broken file.
+    # Headers are always written, see write()
+    def __init__(self, settings, storage):
+        threading.Thread.__init__(self, name=type(self).__name__)
+        self.settings = settings
+        self.storage = storage
+        self.condition = threading.Condition()
+        self.queued = collections.deque()
+        self.queuedBytes = 0
+        self.running = True
+        self.fd = None
+        self.lastFsync = 0
+        self.written = 0
+        self.secondsWriting = 0.0
+        self.dropped = 0
+        self.errors = 0
+        self.start()
+
+    def open(self, path):
+        self._queue( ('open', path) )
+
+    def write(self, data, required=False):
+        # Returns False if data was dropped because too much is waiting already. Small writes a file is useless without,
+        # like an mp4's header, pass required and are never dropped
+        with self.condition:
+            if not required and self.queuedBytes + len(data) > self.settings['writerMaxQueuedMegabytes'] * 1048576:
+                self.dropped += 1
+                return False
+            self.queuedBytes += len(data)
+        self._queue( ('write', data) )
+        return True
+
+    def close(self):
+        self._queue( ('close', None) )
+
+    def after(self, function):
+        # Calls function on the writer thread, once everything queued before it has been written
+        self._queue( ('call', function) )
+
+    def _queue(self, operation):
+        with self.condition:
+            self.queued.append(operation)
+            self.condition.notify()
+
+    def done(self):
+        # Finishes what's queued before the thread exits
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+
+    def stats(self):
+        with self.condition:
+            return {
+                'queued': len(self.queued),
+                'queuedBytes': self.queuedBytes,
+                'written': self.written,
+                'megabytesPerSecond': self.written / 1048576 / self.secondsWriting if self.secondsWriting else 0.0,
+                'dropped': self.dropped,
+                'errors': self.errors
+            }
+
+    def run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.queued or not self.running, self.settings['secondsBetweenFsync'])
+                if not self.queued and not self.running:
+                    break
+                operations = list(self.queued)
+                self.queued.clear()
+
+            chunks = []
+            for operation, argument in operations:
+                if operation == 'write':
+                    chunks.append(argument)
+                    continue
+                self._writev(chunks)
+                chunks = []
+                if operation == 'open':
+                    self._open(argument)
+                elif operation == 'close':
+                    self._close()
+                else:
+                    try:
+                        argument()
+                    except Exception:
+                        log.exception('Exception on the writer thread')
+            self._writev(chunks)
+            if self.fd is not None and time.time() - self.lastFsync >= self.settings['secondsBetweenFsync']:
+                self._fsync()
+        self._close()
+
+    def _open(self, path):
+        self._close()
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            self.lastFsync = time.time()
+            self.storage.opened(path)
+        except OSError as e:
+            log.error('Failed to open %s: %s', path, e)
+            self.errors += 1
+
+    def _writev(self, chunks):
+        if not chunks:
+            return
+        size = sum(len(chunk) for chunk in chunks)
+        if self.fd is not None:
+            start = time.time()
+            try:
+                # Stay under the kernel's limit on buffers per call
+                for i in range(0, len(chunks), 512):
+                    batch = chunks[i:i + 512]
+                    written = os.writev(self.fd, batch)
+                    # Only copy what's left after a short write, which is rare
+                    remaining = b''.join(batch)[written:] if written < sum(len(chunk) for chunk in batch) else b''
+                    while remaining:
+                        remaining = remaining[os.write(self.fd, remaining):]
+                self.written += size
+                self.storage.add(size)
+            except OSError as e:
+                # Likely a full disk. Give up on this file, the next recording will try again
+                log.error('Failed to write recording: %s', e)
+                self.errors += 1
+                self._close()
+            elapsed = time.time() - start
+            self.secondsWriting += elapsed
+            timings.add('writev', elapsed)
+        with self.condition:
+            self.queuedBytes -= size
+
+    def _fsync(self):
+        start = time.time()
+        try:
+            os.fsync(self.fd)
+        except OSError as e:
+            log.error('Failed to fsync recording: %s', e)
+            self.errors += 1
+        self.lastFsync = time.time()
+        timings.add('fsync', self.lastFsync - start)
+
+    def _close(self):
+        if self.fd is None:
+            return
+        self._fsync()
+        try:
+            os.close(self.fd)
+        except OSError as e:
+            log.error('Failed to close recording: %s', e)
+        self.fd = None
+        self.storage.closed()
+
+class RecordingIndex:
+    # sqlite index of the recordings on this Pi, so listing them is one indexed query instead of a walk of the h264 folder.
+    # WAL mode lets HTTP threads read while the Writer adds rows. A row is added once its file is complete,
+    # and removed when Storage deletes its day folder
+    schema = """
+        CREATE TABLE IF NOT EXISTS recordings (
+            id INTEGER PRIMARY KEY,
+            path TEXT NOT NULL UNIQUE,
+            day TEXT NOT NULL,
+            startedAt REAL NOT NULL,
+            duration REAL NOT NULL,
+            bytes INTEGER NOT NULL,
+            zone TEXT,
+            peakScore REAL NOT NULL,
+            thumbnail TEXT
+        );
+        CREATE INDEX IF NOT EXISTS recordings_day ON recordings (day, id);
+    """
+    columns = ('path', 'day', 'startedAt', 'duration', 'bytes', 'zone', 'peakScore', 'thumbnail')
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        db = self.connection()
+        db.execute('PRAGMA journal_mode=WAL')
+        db.executescript(self.schema)
+
+    def connection(self):
+        # sqlite connections can't be shared between threads, so each thread gets its own
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=10)
+            db.row_factory = sqlite3.Row
+            # Safe with WAL. We might lose the last few rows on power loss, but the database can't be corrupted
+            db.execute('PRAGMA synchronous=NORMAL')
+            self.local.db = db
+        return db
+
+    def add(self, recording):
+        db = self.connection()
+        with db:
+            db.execute('INSERT OR REPLACE INTO recordings (%s) VALUES (%s)' % (','.join(self.columns), ','.join('?' * len(self.columns))),
+                [recording[column] for column in self.columns])
+
+    def removeDay(self, day):
+        db = self.connection()
+        with db:
+            db.execute('DELETE FROM recordings WHERE day=?', (day,))
+
+    def list(self, before, limit, day=None):
+        # Newest first. Pass the last id of one page as before to get the next
+        where = []
+        params = []
+        if before:
+            where.append('id < ?')
+            params.append(before)
+        if day:
+            where.append('day = ?')
+            params.append(day)
+        sql = 'SELECT * FROM recordings %s ORDER BY id DESC LIMIT ?' % ('WHERE ' + ' AND '.join(where) if where else '')
+        return [dict(row) for row in self.connection().execute(sql, params + [limit])]
+
+    def get(self, id):
+        row = self.connection().execute('SELECT * FROM recordings WHERE id=?', (id,)).fetchone()
+        return dict(row) if row else None
+
+class Recorder:
+    # Reacts to motion events from the detector by writing one mp4 per event. When motion starts we write the pre-roll
+    # H264Stream holds in memory right away, then keep appending what the encoder gives us until motion stops.
+    # The mp4 is fragmented, one fragment per GOP, so a file cut short by a crash or power loss still plays up to the last GOP.
+    # Events longer than segmentMaxMegabytes continue in another file, named with _2, _3 and so on.
+    # Each file is added to the RecordingIndex once it's complete, along with a thumbnail from when motion started.
+    # Next to each mp4 we write a .motion.json with the detector's score and motion box for every frame it checked,
+    # so object detection can skip quiet frames and zoom in on what moved
+    # Runs on the main thread and hands all disk I/O to the Writer, so neither we nor the detector wait on the SD card
+    def __init__(self, live, writer, storage, index, still, detector, settings):
+        self.live = live
+        self.writer = writer
+        self.storage = storage
+        self.index = index
+        self.still = still
+        self.detector = detector
+        self.settings = settings
+        self.events = queue.Queue()
+        self.viewer = None
+        self.name = None
+        self.path = None
+        self.thumbnail = None
+        self.zone = None
+        self.segment = 0
+        self.segmentBytes = 0
+        # When the current segment starts, and the highest detector score within it
+        self.startedAt = 0
+        self.peakScore = 0.0
+        # (timestamp, score, motionBox) from the detection worker. Kept while we're not recording too, so we have
+        # them for the pre-roll. The oldest fall off on their own
+        self.samples = collections.deque(maxlen=1000)
+        # Samples since startedAt, for the .motion.json
+        self.motion = []
+        self.muxer = None
+        # Access units of the GOP we're collecting. They're written as one fragment once the next keyframe arrives
+        self.gop = []
+        self.decodeTime = 0
+
+    def notify(self, event, t):
+        # Called from the detection worker
+        self.events.put( (event, t) )
+
+    def sample(self, t, score, box):
+        # Called from the detection worker after every frame it checks
+        self.samples.append( (t, score, box) )
+
+    def collect(self):
+        while self.samples:
+            sample = self.samples.popleft()
+            if sample[0] >= self.startedAt:
+                self.motion.append(sample)
+
+    def handle(self, timeout):
+        try:
+            if self.viewer is None:
+                event, t = self.events.get(timeout=timeout)
+            else:
+                # Don't wait for events while recording, there's video to write
+                event, t = self.events.get_nowait()
+        except queue.Empty:
+            if self.viewer is not None:
+                self.peakScore = max(self.peakScore, self.detector.score)
+                self.collect()
+                unit = self.live.get(self.viewer, timeout)
+                if unit is not None:
+                    self.write(unit)
+                    self.drain()
+            return
+        if event == 'motionStarted':
+            self.start(t)
+        elif event == 'motionStopped':
+            self.stop()
+
+    def start(self, t):
+        if self.viewer is not None:
+            return
+        viewer = self.live.record()
+        if viewer is None:
+            log.warning('Motion detected before the first keyframe, not recording')
+            return
+        if not self.storage.canRecord():
+            # Keep detecting and streaming, we'll record again once old recordings have been deleted
+            self.live.leave(viewer)
+            log.warning('Motion detected, but the disk is almost full. Not recording')
+            events.publish('recording', {'state': 'skipped', 'reason': 'Disk is almost full'})
+            return
+        log.info('Motion detected', extra={'zone': self.detector.motionZone, 'score': round(self.detector.score, 3)})
+        filename = datetime.datetime.fromtimestamp(t).strftime('%Y%m%d%H%M%S_%%dx%%dx%%d') % (self.settings['width'], self.settings['height'], self.settings['fps'])   
+        self.zone = None
+        if self.settings['zones'] and self.detector.motionZone:
+            # Name the zone that triggered us, so recordings are easy to sort through
+            self.zone = self.detector.motionZone
+            filename += '_' + re.sub(r'[^A-Za-z0-9-]', '', self.zone)
+        self.name = 'h264/%s/%s' % (filename[0:8], filename)
+
+        self.thumbnail = None
+        still = self.still.get(320, 70) if self.still else None
+        if still:
+            self.thumbnail = self.name + '.jpg'
+            self.writer.open(self.thumbnail)
+            self.writer.write(still[1])
+            self.writer.close()
+
+        # The pre-roll goes back further than t
+        first = viewer.units[0][1] if viewer.units else None
+        last = viewer.units[-1][1] if viewer.units else None
+        self.startedAt = t - ( (last - first) / 1000000 if first is not None and last is not None else 0 )
+        self.peakScore = self.detector.score
+        self.motion = []
+        self.viewer = viewer
+        self.segment = 0
+        self.openSegment()
+        events.publish('recording', {'state': 'started', 'file': self.path})
+        # Queue the pre-roll for writing now, so it's on disk even if we crash before motion stops
+        self.drain()
+
+    def openSegment(self):
+        self.segment += 1
+        self.path = self.name + ('.mp4' if self.segment == 1 else '_%d.mp4' % self.segment)
+        self.writer.open(self.path)
+        self.muxer = Mp4Muxer(self.settings['width'], self.settings['height'])
+        header = self.muxer.init(self.live.sps, self.live.pps)
+        # Fragments appended to a file without its header can't be played, so this one mustn't be dropped
+        self.writer.write(header, required=True)
+        self.segmentBytes = len(header)
+        self.gop = []
+        self.decodeTime = 0
+
+    def drain(self):
+        # Write everything the encoder has given us so far, without waiting for more
+        while True:
+            unit = self.live.get(self.viewer, 0)
+            if unit is None:
+                return
+            self.write(unit)
+
+    def write(self, unit):
+        if unit[0] and self.gop:
+            self.flush(unit[1])
+            if self.segmentBytes >= self.settings['segmentMaxMegabytes'] * 1048576:
+                # Start the next segment with this keyframe
+                self.closeSegment()
+                self.startedAt += self.decodeTime / self.muxer.timescale
+                self.peakScore = self.detector.score
+                self.openSegment()
+                events.publish('recording', {'state': 'segment', 'file': self.path})
+        self.gop.append(unit)
+
+    def flush(self, nextTimestamp):
+        # Each frame lasts until the next one starts, going by the camera's timestamps.
+        # The last frame of an event has no next one, so we assume 1/fps
+        start = time.time()
+        samples = []
+        for i, (keyframe, timestamp, data) in enumerate(self.gop):
+            following = self.gop[i + 1][1] if i + 1 < len(self.gop) else nextTimestamp
+            if timestamp is None or following is None or following <= timestamp:
+                duration = self.muxer.timescale // self.settings['fps']
+            else:
+                duration = following - timestamp
+            samples.append( (duration, keyframe, data) )
+        fragment = self.muxer.fragment(self.decodeTime, samples)
+        if self.writer.write(fragment):
+            self.segmentBytes += len(fragment)
+        # Even if the fragment was dropped, later ones keep their place in time
+        self.decodeTime += sum(sample[0] for sample in samples)
+        self.gop = []
+        timings.add('mux', time.time() - start)
+
+    def stop(self):
+        if self.viewer is None:
+            return
+        log.info('Motion stopped', extra={'file': self.path})
+        # Write what the encoder gave us up until motion stopped
+        self.live.leave(self.viewer)
+        for unit in self.viewer.units:
+            self.write(unit)
+        self.viewer = None
+        if self.gop:
+            self.flush(None)
+        self.closeSegment()
+        events.publish('recording', {'state': 'finished', 'file': self.path})
+
+    def closeSegment(self):
+        self.writer.close()
+        duration = self.decodeTime / self.muxer.timescale
+        self.collect()
+        # Samples past the end of this segment belong to the next one. Times are seconds into the mp4
+        end = self.startedAt + duration
+        sidecar = {
+            'width': self.settings['width'],
+            'height': self.settings['height'],
+            'samples': [ [round(t - self.startedAt, 3), round(score, 3), box] for t, score, box in self.motion if t < end ]
+        }
+        self.motion = [ sample for sample in self.motion if sample[0] >= end ]
+        self.writer.open(self.path[:-len('.mp4')] + '.motion.json')
+        self.writer.write(json.dumps(sidecar, separators=(',', ':')).encode('utf-8'), required=True)
+        self.writer.close()
+
+        recording = {
+            'path': self.path,
+            'day': os.path.basename(os.path.dirname(self.path)),
+            'startedAt': self.startedAt,
+            'duration': duration,
+            'bytes': self.segmentBytes,
+            'zone': self.zone,
+            'peakScore': self.peakScore,
+            'thumbnail': self.thumbnail
+        }
+        # Index it once the file is on disk
+        self.writer.after(lambda: self.index.add(recording))
+
+
+class ConfigWriter(threading.Thread):
+    # Saves config.json off the request thread, so a slow SD card doesn't hold up the HTTP response.
+    # Saves that pile up are coalesced into one write of the latest settings
+    def __init__(self, path):
+        threading.Thread.__init__(self, name=type(self).__name__)
+        self.path = path
+        self.pending = None
+        self.running = True
+        self.condition = threading.Condition()
+        self.start()
+
+    def save(self, o):
+        with self.condition:
+            self.pending = o
+            self.condition.notify()
+
+    def done(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.pending is not None or not self.running)
+                o = self.pending
+                self.pending = None
+            if o is None:
+                # Only stop once everything has been saved
+                return
+            try:
+                self.write(o)
+            except Exception:
+                log.exception('Failed to save config.json')
+
+    def write(self, o):
+        # Write to a temporary file and rename it over config.json, so losing power mid-write can't leave us with half a config
+        temporary = self.path + '.tmp'
+        with open(temporary, 'w') as f:
+            json.dump(o, f, indent=4)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, self.path)
+
+
+configLock = threading.Lock()
 def mergeConfig(o):
-    global settings
-    for key in o:
-        settings[key] = o[key]
-    with open('config.json', 'w') as f:
-        json.dump(settings, f)
-        f.close()
+    # Applies what we can to the running camera and saves everything to config.json.
+    # Raises ValueError if anything in o is invalid, in which case nothing changes
+    global savedSettings
+    validateConfig(o)
+    with configLock:
+        applied = {}
+        restartRequired = []
+        for key in o:
+            if key in restartSettings:
+                if o[key] != settings[key]:
+                    restartRequired.append(key)
+            elif o[key] != settings[key]:
+                applied[key] = o[key]
+
+        if applied:
+            pending = copy.deepcopy(settings)
+            pending.update(applied)
+            # Rebuilds zone masks and buffers as needed, then swaps them in along with the new settings
+            motionDetection.reconfigure(pending, applied)
+            if 'logLevel' in applied or 'logFormat' in applied:
+                configureLogging(settings)
+
+        savedSettings = copy.deepcopy(savedSettings)
+        savedSettings.update(o)
+        configWriter.save(savedSettings)
+    events.publish('config', o)
+    return {'applied': sorted(applied.keys()), 'restartRequired': sorted(restartRequired)}
 
 
 running = True
 def signal_handler(sig, frame):
     global running
     running = False
-    print('Exiting ...')
-signal.signal(signal.SIGINT, signal_handler)
-signal.signal(signal.SIGTERM, signal_handler)
-
-# Merge in settings from config.json
-if os.path.isfile('config.json'):
-    with open('config.json', 'r') as f:
-        settings = json.load(f)
-        f.close()
-
-
-with picamera.PiCamera() as camera:
-    camera.resolution = (settings['width'], settings['height'])
-    camera.framerate = settings['fps']
-    camera.annotate_background = picamera.Color(y=0, u=0, v=0)
-
-    heartbeat = Heartbeat(settings)
-    temperature = Temperature(settings)
-    streamer = Streamer()
-    motionDetection = MotionDetection(camera, settings, streamer)
-
-    # See stream.copy_to() usage below for why I'm creating a larher buffer
-    stream = picamera.PiCameraCircularIO(camera, seconds = settings['secondsToSaveBeforeMotion'] * 2)
-    camera.start_recording(stream, format='h264')
-    while running:
-        try:
-            # Need a better way to do this, based on how long capture() actually/usually takes
-            # Hardcoded this to 0.1 for now, since capture() is slow and I want detection 3x per second
-            camera.wait_recording(0.1) #settings['secondsBetweenDetection'])
-        except picamera.PiCameraError as e:
-            print('Exception while recording to circular buffer')
-            print(str(e))
-            break
-        except Exception as e:
-            print('Non PiCamera exception while recording to circular buffer')
-            print(str(e))
-            break
-    
-        # TODO: return boolean from check instead of reaching into motionDetection.motionDetected
-        motionDetection.check()
-    
-        if motionDetection.motionDetected:
-            print('Motion detected!')
-            # As soon as we detect motion, split and start recording to h264
-            # We'll save the circular buffer to h264 later, since it contains "before motion detected" frames
-            filename = datetime.datetime.fromtimestamp(motionDetection.motionAtTimestamp).strftime('%Y%m%d%H%M%S_%%dx%%dx%%d') % (settings['width'], settings['height'], settings['fps'])   
-            subfolder = 'h264/' + filename[0:8]
-            pathlib.Path(subfolder).mkdir(parents=True, exist_ok=True)
+    log.info('Exiting ...')
 
-            try:
-                camera.split_recording('%s/%s_after.h264' % (subfolder, filename))
-            except picamera.PiCameraError as e:
-                print('Exception while calling split_recording')
-                print(str(e))
-                break
-            except Exception as e:
-                print('Non PiCamera exception while calling split_recording')
-                print(str(e))
-                break
+def secondsSinceStart():
+    # How long ago this process started, going by /proc, so it includes starting Python and importing modules
+    with open('/proc/self/stat') as f:
+        # The process name is in parentheses and may have spaces in it, so count fields from after it. starttime is the 22nd
+        fields = f.read().rsplit(')', 1)[1].split()
+    with open('/proc/uptime') as f:
+        uptime = float(f.read().split()[0])
+    return uptime - int(fields[19]) / os.sysconf('SC_CLK_TCK')
 
-            # Wait until motion is no longer detected, then split recording back to the in-memory circular buffer
-            while motionDetection.motionDetected:
-                if running == False:
-                    break
-                try:
-                    camera.wait_recording(1.0)
-                except picamera.PiCameraError as e:
-                    print('Exception while recording to h264 file')
-                    print(str(e))
-                    # TODO: Unsure how to handle full disk
-                    break
-                except Exception as e:
-                    print('Non PiCamera exception while calling split_recording')
-                    print(str(e))
-                    break
-                motionDetection.check()
-            print('Motion stopped!')
+def notifySystemd(state):
+    # Tells systemd how startup is going when we run as a Type=notify service (see etc/systemd). Does nothing otherwise
+    address = os.environ.get('NOTIFY_SOCKET')
+    if not address:
+        return
+    if address.startswith('@'):
+        # An abstract socket
+        address = '\0' + address[1:]
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.sendto(state.encode('utf-8'), address)
+    except OSError as e:
+        log.warning('Failed to notify systemd: %s', e)
 
-            # Write the frames from "before" motion to disk as well
-            try:
-                # The reason I'm explicitly specifying seconds here is that according to the documentation,
-                # even if you create a circular buffer to hold 2 seconds, that's the lower bound. It might hold more
-                # depending on how much has changed between frames. Sounds like it allocates by bitrate behind the scenes,
-                # and truncates based on bytes within the buffer. So if some frames have less data it'll be able to pack more into the buffer
-                stream.copy_to('%s/%s_before.h264' % (subfolder, filename), seconds = settings['secondsToSaveBeforeMotion'])
-            except Exception as e:
-                print('Exception while calling copy_to')
-                print(str(e))
-                break
-            stream.clear()
+def main():
+    global savedSettings, configWriter, metrics, events, storage, writer, streamer, motionDetection, recorder
+    signal.signal(signal.SIGINT, signal_handler)
+    signal.signal(signal.SIGTERM, signal_handler)
+
+    # Once with the defaults, so problems with config.json are logged, then again with what it says
+    configureLogging(settings)
+    loadConfig('config.json')
+    configureLogging(settings)
+    # What's in config.json, which may include changes that are waiting for a restart
+    savedSettings = copy.deepcopy(settings)
+    configWriter = ConfigWriter('config.json')
+    metrics = Metrics(settings['metricsMaxPoints'], {'host': socket.gethostname()})
 
+    import picamera
+    with picamera.PiCamera() as camera:
+        camera.resolution = (settings['width'], settings['height'])
+        camera.framerate = settings['fps']
+        camera.annotate_background = picamera.Color(y=0, u=0, v=0)
+
+        # Start recording into the pre-roll before anything else, so after a reboot or restart we're back to catching motion
+        # as soon as we can. The rest, OpenCV included, loads while the encoder runs
+        h264 = H264Stream(settings)
+        motionOutput = motionVectorAnalysis(camera) if settings['detector'] == 'vectors' else None
+        camera.start_recording(H264Output(camera, h264), format='h264', motion_output=motionOutput)
+        seconds = secondsSinceStart()
+        timings.add('startup.camera', seconds)
+        if seconds > settings['secondsToStartRecording']:
+            log.warning('Camera took %.1f seconds to start recording, more than secondsToStartRecording', seconds)
+        else:
+            log.info('Camera recording %.1f seconds after starting', seconds)
+        notifySystemd('STATUS=Camera recording, starting motion detection')
+
+        events = EventBus(settings['eventsReplay'], settings['eventsMaxClients'])
+        exporter = InfluxExporter(metrics, settings['metricsUrl'], settings) if settings['metricsUrl'] else None
+        storage = Storage('h264', settings)
+        recordings = RecordingIndex('h264/index.sqlite3')
+        storage.listeners.append(recordings.removeDay)
+        writer = Writer(settings, storage)
+        # Imports OpenCV and numpy, which is most of our startup time on a Pi Zero
+        from detection import detectors
+        motionDetection = detectors[settings['detector']](camera, settings)
+        if motionOutput:
+            motionDetection.motionOutput = motionOutput
+            motionOutput.detector = motionDetection
+        still = StillCache(motionDetection.stills, settings)
+        recorder = Recorder(h264, writer, storage, recordings, still, motionDetection, settings)
+        # Started once the detector and recorder exist, since most requests ask them something
+        streamer = Streamer(settings)
+        streamer.httpd.live = LiveStream(camera, settings)
+        streamer.httpd.h264 = h264
+        streamer.httpd.storage = storage
+        streamer.httpd.recordings = recordings
+        streamer.httpd.still = still
+
+        motionDetection.listeners.append(recorder.notify)
+        motionDetection.scoreListeners.append(recorder.sample)
+        motionDetection.listeners.append(publishMotion)
+        motionDetection.stageTimings = timings
+        metricsEvents = MetricsEvents(settings)
+        detectionWorker = DetectionWorker(settings, motionDetection)
+        frameCapture = FrameCapture(settings, motionDetection)
+        # Started last, since these report on the detector, recorder and storage
+        heartbeat = Heartbeat(settings)
+        metricsSampler = MetricsSampler(settings)
+        seconds = secondsSinceStart()
+        timings.add('startup.ready', seconds)
+        log.info('Detecting motion %.1f seconds after starting', seconds)
+        notifySystemd('READY=1\nSTATUS=Detecting motion')
+
+        while running:
             try:
-                camera.split_recording(stream)
-            except picamera.PiCameraError as e:
-                print('Exception while calling split_recording (2)')
-                print(str(e))
+                # Raises if the encoder hit an error
+                camera.wait_recording(0)
+                recorder.handle(0.5)
+            except picamera.PiCameraError:
+                log.exception('Exception while recording')
+                # The encoder only writes to memory, so this isn't a full disk. Those are handled by Storage and the Writer
                 break
-            except Exception as e:
-                print('Non PiCamera exception while calling split_recording (2)')
-                print(str(e))
+            except Exception:
+                log.exception('Non PiCamera exception while recording')
                 break
-    heartbeat.done()
-    temperature.done()
-    streamer.done()
-    # TODO: find the proper way to wait for threads to terminate
-    time.sleep(3)
-    camera.stop_recording()
 
+        notifySystemd('STOPPING=1')
+        frameCapture.done()
+        detectionWorker.done()
+        try:
+            # Save what we have if we're exiting mid-event
+            recorder.stop()
+        except Exception:
+            log.exception('Exception while finishing recording')
+        # Wait for the recording to reach the disk
+        writer.done()
+        writer.join()
+        storage.done()
+        metricsEvents.done()
+        heartbeat.done()
+        metricsSampler.done()
+        if exporter:
+            # Sends what's left
+            exporter.done()
+            exporter.join()
+        streamer.done()
+        configWriter.done()
+        # TODO: find the proper way to wait for threads to terminate
+        time.sleep(3)
+        camera.stop_recording()
+
+if __name__ == '__main__':
+    main()
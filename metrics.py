@@ -0,0 +1,202 @@
+# Metrics for main.py: counters and gauges we can serve at /metrics, and a bounded ring of timestamped samples of them
+# that InfluxExporter sends to InfluxDB in batches. Nothing here touches the camera, so it can be tried against
+# tools/influx-stub.py on any machine
+import collections
+import http.client
+import logging
+import random
+import threading
+import time
+import urllib.parse
+
+log = logging.getLogger('metrics')
+
+
+def escapeTag(value):
+    # Influx line protocol tag keys and values escape commas, equals signs and spaces
+    return str(value).replace('\\', '\\\\').replace(',', '\\,').replace('=', '\\=').replace(' ', '\\ ')
+
+
+class Metrics:
+    # Counters only go up. Gauges are whatever they were last set to. Both are keyed by name and a tuple of
+    # (tag, value) pairs, like ('http_requests', (('route', '/'), ('status', 200)))
+    def __init__(self, maxPoints, tags=None):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        # Tags added to every point we export, like the host
+        self.tags = tags or {}
+        # Influx lines waiting to be sent. When Influx is away for long enough, the oldest are dropped
+        self.points = collections.deque(maxlen=maxPoints)
+        self.droppedPoints = 0
+
+    def count(self, name, value=1, **tags):
+        key = (name, tuple(sorted(tags.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def total(self, name, value, **tags):
+        # Sets a counter that something else keeps, like the bytes the Writer has written
+        key = (name, tuple(sorted(tags.items())))
+        with self.lock:
+            self.counters[key] = value
+
+    def gauge(self, name, value, **tags):
+        key = (name, tuple(sorted(tags.items())))
+        with self.lock:
+            self.gauges[key] = value
+
+    def sample(self, t=None):
+        # Adds the current value of every counter and gauge to the ring, as one line each
+        timestamp = int((t or time.time()) * 1000000000)
+        common = ''.join(',%s=%s' % (escapeTag(tag), escapeTag(value)) for tag, value in sorted(self.tags.items()))
+        with self.lock:
+            lines = []
+            for (name, tags), value in list(self.counters.items()) + list(self.gauges.items()):
+                if value is None:
+                    continue
+                tagged = common + ''.join(',%s=%s' % (escapeTag(tag), escapeTag(tagValue)) for tag, tagValue in tags)
+                lines.append('raspi.%s%s value=%s %d' % (name, tagged, float(value), timestamp))
+            self._add(lines)
+
+    def _add(self, lines):
+        overflow = len(self.points) + len(lines) - self.points.maxlen
+        if overflow > 0:
+            self.droppedPoints += overflow
+        self.points.extend(lines)
+
+    def take(self, limit):
+        # Removes and returns up to limit of the oldest points, for the exporter
+        with self.lock:
+            return [self.points.popleft() for i in range(min(limit, len(self.points)))]
+
+    def putBack(self, lines):
+        # Returns points the exporter couldn't send, ahead of anything newer. The oldest go if there's no room
+        with self.lock:
+            newer = list(self.points)
+            self.points.clear()
+            self._add(lines)
+            self._add(newer)
+
+    def prometheus(self):
+        # Text for /metrics, in the format Prometheus scrapes
+        def labels(tags):
+            if not tags:
+                return ''
+            return '{%s}' % ','.join('%s="%s"' % (tag, str(value).replace('\\', '\\\\').replace('"', '\\"')) for tag, value in tags)
+        with self.lock:
+            counters = sorted(self.counters.items())
+            gauges = sorted((key, value) for key, value in self.gauges.items() if value is not None)
+            pending = len(self.points)
+            dropped = self.droppedPoints
+        lines = []
+        typed = set()
+        for kind, series, suffix in (('counter', counters, '_total'), ('gauge', gauges, '')):
+            for (name, tags), value in series:
+                if name not in typed:
+                    lines.append('# TYPE raspi_%s%s %s' % (name, suffix, kind))
+                    typed.add(name)
+                lines.append('raspi_%s%s%s %s' % (name, suffix, labels(tags), float(value)))
+        lines.append('# TYPE raspi_metrics_pending_points gauge')
+        lines.append('raspi_metrics_pending_points %d' % pending)
+        lines.append('# TYPE raspi_metrics_dropped_points_total counter')
+        lines.append('raspi_metrics_dropped_points_total %d' % dropped)
+        return '\n'.join(lines) + '\n'
+
+
+class InfluxExporter(threading.Thread):
+    # Sends the ring's points to Influx's /write endpoint every secondsBetweenMetrics, up to maxBatch lines per request.
+    # Uses one keep-alive connection with a short timeout, so a slow or missing Influx server can't hold us up for long.
+    # After a failure we put the points back and wait twice as long each time, up to maxBackoff seconds
+    def __init__(self, metrics, url, settings, maxBatch=5000, maxBackoff=300):
+        threading.Thread.__init__(self, name=type(self).__name__)
+        self.metrics = metrics
+        self.settings = settings
+        self.maxBatch = maxBatch
+        self.maxBackoff = maxBackoff
+        url = urllib.parse.urlsplit(url)
+        self.https = url.scheme == 'https'
+        self.host = url.hostname
+        self.port = url.port
+        self.path = url.path + ('?' + url.query if url.query else '')
+        self.connection = None
+        self.failures = 0
+        self.sent = 0
+        self.lastError = None
+        self.running = True
+        self.condition = threading.Condition()
+        self.start()
+
+    def done(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+
+    def stats(self):
+        return {'sent': self.sent, 'failures': self.failures, 'lastError': self.lastError}
+
+    def run(self):
+        while True:
+            delay = self.settings['secondsBetweenMetrics']
+            if self.failures:
+                # With some jitter, so a room full of Pis don't all retry at the same moment
+                delay = min(self.maxBackoff, delay * 2 ** self.failures) * random.uniform(0.8, 1.2)
+            with self.condition:
+                self.condition.wait_for(lambda: not self.running, delay)
+                running = self.running
+            self.flush()
+            if not running:
+                break
+        if self.connection:
+            self.connection.close()
+
+    def flush(self):
+        while True:
+            lines = self.metrics.take(self.maxBatch)
+            if not lines:
+                return
+            try:
+                status, text = self.post('\n'.join(lines).encode('utf-8'))
+                if status >= 500 or status == 429:
+                    raise http.client.HTTPException('Influx responded %d: %s' % (status, text))
+            except (OSError, http.client.HTTPException) as e:
+                self.metrics.putBack(lines)
+                self.failures += 1
+                self.lastError = str(e) or type(e).__name__
+                if self.failures == 1:
+                    # Only mention the first failure in a row, rather than every retry
+                    log.warning('Failed to send metrics, will keep trying: %s', self.lastError)
+                if self.connection:
+                    self.connection.close()
+                    self.connection = None
+                return
+            if status >= 300:
+                # Influx didn't like these lines, and won't next time either
+                log.error('Influx rejected %d metrics: %d %s', len(lines), status, text)
+            else:
+                self.sent += len(lines)
+            if self.failures:
+                log.info('Sending metrics again')
+            self.failures = 0
+            if len(lines) < self.maxBatch:
+                return
+
+    def post(self, body):
+        # Returns (status, start of the response body)
+        while True:
+            fresh = self.connection is None
+            if fresh:
+                connectionClass = http.client.HTTPSConnection if self.https else http.client.HTTPConnection
+                self.connection = connectionClass(self.host, self.port, timeout=5)
+            try:
+                self.connection.request('POST', self.path, body, {'Content-Type': 'text/plain; charset=utf-8'})
+                response = self.connection.getresponse()
+                # Read it all, or the connection can't be reused
+                text = response.read()
+                return (response.status, text[:200].decode('utf-8', 'replace'))
+            except (OSError, http.client.HTTPException):
+                self.connection.close()
+                self.connection = None
+                if fresh:
+                    raise
+                # The server closed our idle keep-alive connection, so try again on a new one
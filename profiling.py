@@ -0,0 +1,65 @@
+# Sampling profiler for main.py, for when the Pi falls behind and the stage timings don't say why.
+# While a capture runs, a thread looks at what every other thread is running every interval seconds and counts each
+# distinct stack. Nothing runs between captures, so it costs nothing until someone asks for one.
+#
+# Results are collapsed stacks, one per line: "thread;outermost (file:line);...;innermost (file:line) count",
+# which flamegraph.pl and https://www.speedscope.app read as they are
+import os
+import sys
+import threading
+import time
+
+
+# Where threads block waiting for work, as (file, function) of the innermost Python frame, since the wait itself is in C.
+# Samples that end in one of these are idle threads, and left out unless asked for. Matching the function rather than
+# the whole file means a thread that's busy in threading.py or socket.py still counts
+idleFrames = set([
+    ('threading.py', 'wait'),                   # Condition.wait, Event.wait
+    ('threading.py', '_wait_for_tstate_lock'),  # Thread.join
+    ('queue.py', 'get'),                        # Queue.get
+    ('thread.py', '_worker'),                   # ThreadPoolExecutor workers, in SimpleQueue.get
+    ('selectors.py', 'select'),                 # serve_forever between requests
+    ('socket.py', 'accept'),
+    ('socket.py', 'readinto'),                  # Keep-alive connections waiting for their next request
+])
+
+class StackSampler:
+    def __init__(self):
+        # Only one capture at a time, since each one has a thread to itself
+        self.lock = threading.Lock()
+
+    def capture(self, seconds, interval=0.005, idle=False):
+        # Samples for seconds and returns (samples taken, collapsed stacks text). Returns None if a capture is already running
+        if not self.lock.acquire(blocking=False):
+            return None
+        try:
+            return self._capture(seconds, interval, idle)
+        finally:
+            self.lock.release()
+
+    def _capture(self, seconds, interval, idle):
+        ourself = threading.get_ident()
+        counts = {}
+        samples = 0
+        end = time.perf_counter() + seconds
+        while time.perf_counter() < end:
+            # Threads come and go, so their names are looked up on every sample
+            names = dict((thread.ident, thread.name) for thread in threading.enumerate())
+            for ident, frame in sys._current_frames().items():
+                if ident == ourself:
+                    continue
+                if not idle and (os.path.basename(frame.f_code.co_filename), frame.f_code.co_name) in idleFrames:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append('%s (%s:%d)' % (frame.f_code.co_name, os.path.basename(frame.f_code.co_filename), frame.f_lineno))
+                    frame = frame.f_back
+                stack.append(names.get(ident, 'thread-%d' % ident))
+                key = ';'.join(reversed(stack))
+                counts[key] = counts.get(key, 0) + 1
+            samples += 1
+            # Drop our reference to the frames before sleeping, so we don't keep them alive
+            frame = None
+            time.sleep(interval)
+        lines = ['%s %d' % (stack, count) for stack, count in sorted(counts.items(), key=lambda item: -item[1])]
+        return (samples, '\n'.join(lines) + '\n')
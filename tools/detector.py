@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+# Runs the motion detector against recorded clips instead of the camera, so settings can be tuned and
+# performance checked on any Linux box. Clips are video files, or folders of images. For example:
+#
+# python3 tools/detector.py evaluate h264/20210101
+# python3 tools/detector.py benchmark --sizes 320x180,1920x1088
+# python3 tools/detector.py accuracy labels.json
+#
+# Settings come from config.json in the current folder, like main.py
+import argparse
+import copy
+import json
+import os
+import resource
+import sys
+import time
+import tracemalloc
+
+import cv2
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from config import settings, settingChoices, loadConfig
+from detection import FrameDifferenceDetection, findClips, readFrames, replay
+
+
+def recordings(events, end):
+    # (start, stop) of each recording the detector's events would have made, cut off at the end of the clip
+    started = [t for event, t in events if event == 'motionStarted']
+    stopped = [min(t, end) for event, t in events if event == 'motionStopped']
+    return list(zip(started, stopped))
+
+def evaluate(args):
+    # How many recordings each background model would have started, and how long they'd have been
+    models = settingChoices['backgroundModel']
+    totals = dict( (model, [0, 0.0]) for model in models )
+    print('%-50s' % 'clip' + ''.join('%30s' % ('%s triggers / seconds' % model) for model in models))
+    for path in findClips(args.clips):
+        line = '%-50s' % path
+        for model in models:
+            o = copy.deepcopy(settings)
+            o['backgroundModel'] = model
+            events, samples = replay(path, o)
+            made = recordings(events, samples[-1][0] if samples else 0)
+            seconds = sum(stop - start for start, stop in made)
+            totals[model][0] += len(made)
+            totals[model][1] += seconds
+            line += '%30s' % ('%d / %.1f' % (len(made), seconds))
+        print(line)
+    print('%-50s' % 'total' + ''.join('%30s' % ('%d / %.1f' % tuple(totals[model])) for model in models))
+
+
+class TimedDetection(FrameDifferenceDetection):
+    # Adds up how long each step of detection takes
+    def setup(self):
+        super().setup()
+        self.stageSeconds = {}
+        self.mark = 0
+
+    def _stage(self, name):
+        now = time.perf_counter()
+        self.stageSeconds[name] = self.stageSeconds.get(name, 0) + now - self.mark
+        self.mark = now
+
+def syntheticFrames(width, height, count):
+    # Noisy background with a square moving across it, in case there's no clip handy
+    rng = numpy.random.default_rng(1)
+    background = rng.integers(40, 80, (height, width), dtype=numpy.uint8)
+    frames = []
+    for i in range(count):
+        frame = cv2.add(background, rng.integers(0, 6, (height, width), dtype=numpy.uint8))
+        size = height // 4
+        x = (i * width // count) % (width - size)
+        frame[height // 3:height // 3 + size, x:x + size] = 220
+        frames.append(cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR))
+    return frames
+
+def benchmark(args):
+    sizes = [tuple(int(value) for value in size.split('x')) for size in args.sizes.split(',')]
+    source = None
+    if args.clip:
+        source = []
+        for frame in readFrames(args.clip):
+            source.append(frame)
+            if len(source) == args.frames:
+                break
+
+    print('%d frames per size, %s background' % (args.frames, settings['backgroundModel']))
+    rows = []
+    for width, height in sizes:
+        o = copy.deepcopy(settings)
+        o['detectionMode'] = 'luma'
+        o['detectionWidth'] = width
+        o['detectionHeight'] = height
+        if source:
+            frames = [cv2.resize(source[i % len(source)], (width, height), interpolation=cv2.INTER_AREA) for i in range(args.frames)]
+        else:
+            frames = syntheticFrames(width, height, args.frames)
+        detector = TimedDetection(None, o)
+        grayscale = numpy.empty( (height, width), dtype=numpy.uint8)
+
+        def run(frame, t):
+            detector.mark = time.perf_counter()
+            cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, grayscale)
+            detector._stage('cvtColor')
+            detector.compare(grayscale, t)
+            detector._expire(t)
+
+        # The first frame only sets up the background
+        run(frames[0], 0)
+        detector.stageSeconds = {}
+        start = time.perf_counter()
+        for i, frame in enumerate(frames[1:], 1):
+            run(frame, i * settings['secondsBetweenDetection'])
+        elapsed = time.perf_counter() - start
+
+        # Separate pass, since tracing allocations slows everything down.
+        # Peak heap growth within a frame is what detection allocates and frees each time
+        tracemalloc.start()
+        perFrame = []
+        for i, frame in enumerate(frames[1:], 1):
+            before = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            run(frame, i * settings['secondsBetweenDetection'])
+            perFrame.append(tracemalloc.get_traced_memory()[1] - before)
+        tracemalloc.stop()
+
+        count = len(frames) - 1
+        stages = dict( (name, seconds / count * 1000) for name, seconds in detector.stageSeconds.items() )
+        rows.append( ('%dx%d' % (width, height), count / elapsed, stages, sum(perFrame) / count / 1024, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024) )
+
+    names = []
+    for row in rows:
+        names.extend( name for name in row[2] if not name in names )
+    print('%-10s %8s ' % ('size', 'frames/s') + ' '.join('%9s' % name for name in names) + ' %11s %12s' % ('alloc KB/f', 'peak RSS MB'))
+    for size, fps, stages, allocated, rss in rows:
+        print('%-10s %8.1f ' % (size, fps) + ' '.join('%9.3f' % stages.get(name, 0) for name in names) + ' %11.1f %12.1f' % (allocated, rss))
+    print('Stage times are milliseconds per frame. Peak RSS is for the whole run so far')
+
+
+def accuracy(args):
+    # The labels file maps clips, relative to itself, to the [start, end] seconds where there really is motion:
+    # {"20210101/090000_after.h264": [[3.5, 9]], "20210101/093000_after.h264": []}
+    with open(args.labels, 'r') as f:
+        labels = json.load(f)
+    folder = os.path.dirname(os.path.abspath(args.labels))
+
+    def moving(intervals, t):
+        return any(start <= t < end for start, end in intervals)
+
+    totals = dict(tp=0, fp=0, fn=0, tn=0, triggers=0, falseTriggers=0, events=0, missed=0)
+    print('%-50s %9s %7s %9s %7s %7s' % ('clip', 'precision', 'recall', 'triggers', 'false', 'missed'))
+    for name in sorted(labels):
+        intervals = labels[name]
+        events, samples = replay(os.path.join(folder, name), copy.deepcopy(settings))
+        counts = dict(tp=0, fp=0, fn=0, tn=0)
+        for t, motion in samples:
+            truth = moving(intervals, t)
+            counts[('t' if motion == truth else 'f') + ('p' if motion else 'n')] += 1
+
+        # A recording is a false trigger if no labelled motion falls within it,
+        # and labelled motion is missed if no recording covers any of it
+        made = recordings(events, samples[-1][0] if samples else 0)
+        falseTriggers = sum(1 for start, stop in made if not any(a < stop and start < b for a, b in intervals))
+        missed = sum(1 for a, b in intervals if not any(start < b and a < stop for start, stop in made))
+
+        for key in counts:
+            totals[key] += counts[key]
+        totals['triggers'] += len(made)
+        totals['falseTriggers'] += falseTriggers
+        totals['events'] += len(intervals)
+        totals['missed'] += missed
+        print('%-50s %9s %7s %9d %7d %7s' % (name, ratio(counts['tp'], counts['tp'] + counts['fp']), ratio(counts['tp'], counts['tp'] + counts['fn']), len(made), falseTriggers, '%d/%d' % (missed, len(intervals))))
+
+    print('%-50s %9s %7s %9d %7d %7s' % ('total', ratio(totals['tp'], totals['tp'] + totals['fp']), ratio(totals['tp'], totals['tp'] + totals['fn']), totals['triggers'], totals['falseTriggers'], '%d/%d' % (totals['missed'], totals['events'])))
+    print('Precision and recall are per detected frame. Triggers are recordings that would have been made')
+
+def ratio(a, b):
+    return '%.2f' % (a / b) if b else '-'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay, benchmark and check the accuracy of the motion detector without a camera')
+    parser.add_argument('--config', default='config.json', help='Settings to merge over the defaults')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    command = commands.add_parser('evaluate', help='Count the recordings each background model would make')
+    command.add_argument('clips', nargs='+', help='Video files, folders of images, or folders to search for either')
+    command.set_defaults(run=evaluate)
+
+    command = commands.add_parser('benchmark', help='Time each stage of detection at several resolutions')
+    command.add_argument('clip', nargs='?', help='Video file or folder of images. Uses generated frames if left out')
+    command.add_argument('--sizes', default='320x180,640x360,1280x720,1920x1088')
+    command.add_argument('--frames', type=int, default=200)
+    command.set_defaults(run=benchmark)
+
+    command = commands.add_parser('accuracy', help='Compare detected motion to labelled clips')
+    command.add_argument('labels', help='JSON file of clips and the seconds where they have motion')
+    command.set_defaults(run=accuracy)
+
+    args = parser.parse_args()
+    loadConfig(args.config)
+    args.run(args)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+# Load test for the web UI. Some number of clients hammer the given paths over keep-alive connections,
+# then we report latency per path. For example, against a Pi:
+#
+# python3 tools/http-benchmark.py http://192.168.1.50:8080 --clients 20 --seconds 30
+import argparse
+import http.client
+import threading
+import time
+import urllib.parse
+
+
+def percentile(values, p):
+    # Nearest-rank percentile. values must be sorted
+    if not values:
+        return 0.0
+    index = max(0, min(len(values) - 1, round(p / 100 * len(values)) - 1))
+    return values[index]
+
+def client(host, port, paths, deadline, results, errors, lock):
+    connection = http.client.HTTPConnection(host, port, timeout=10)
+    i = 0
+    while time.time() < deadline:
+        path = paths[i % len(paths)]
+        i += 1
+        start = time.perf_counter()
+        try:
+            connection.request('GET', path)
+            response = connection.getresponse()
+            response.read()
+            ok = response.status == 200
+        except (OSError, http.client.HTTPException):
+            ok = False
+            connection.close()
+            connection = http.client.HTTPConnection(host, port, timeout=10)
+        elapsed = time.perf_counter() - start
+        with lock:
+            if ok:
+                results[path].append(elapsed)
+            else:
+                errors[path] += 1
+    connection.close()
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure web UI request latency under concurrent load')
+    parser.add_argument('url', help='Base URL of the camera, like http://192.168.1.50:8080')
+    parser.add_argument('--clients', type=int, default=20)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--paths', default='/status.json,/still.jpeg', help='Comma separated paths to request, in rotation')
+    args = parser.parse_args()
+
+    url = urllib.parse.urlparse(args.url)
+    paths = args.paths.split(',')
+    results = {path: [] for path in paths}
+    errors = {path: 0 for path in paths}
+    lock = threading.Lock()
+    deadline = time.time() + args.seconds
+
+    threads = []
+    for i in range(args.clients):
+        # Stagger the rotation so clients don't all request the same path at once
+        rotated = paths[i % len(paths):] + paths[:i % len(paths)]
+        thread = threading.Thread(target=client, args=(url.hostname, url.port or 80, rotated, deadline, results, errors, lock))
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+
+    print('%d clients for %.0f seconds' % (args.clients, args.seconds))
+    print('%-16s %8s %7s %8s %8s %8s %8s %8s' % ('path', 'requests', 'errors', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms'))
+    for path in paths:
+        values = sorted(results[path])
+        print('%-16s %8d %7d %8.1f %8.1f %8.1f %8.1f %8.1f' % (
+            path, len(values), errors[path], len(values) / args.seconds,
+            percentile(values, 50) * 1000, percentile(values, 95) * 1000, percentile(values, 99) * 1000,
+            (values[-1] if values else 0) * 1000))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+# Stands in for InfluxDB's /write endpoint, so metrics can be checked without an Influx server. For example:
+#
+# python3 tools/influx-stub.py --port 8086
+#   then set metricsUrl to http://<this machine>:8086/write?db=cube and watch the batches arrive
+#
+# python3 tools/influx-stub.py --exercise
+#   runs metrics.py against the stub while it goes down, hangs and comes back, and reports what was sent
+import argparse
+import http.server
+import logging
+import os
+import socketserver
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from metrics import Metrics, InfluxExporter
+
+
+class Stub:
+    def __init__(self, quiet):
+        self.quiet = quiet
+        # 'ok', 'fail' (503) or 'hang' (no response for longer than the exporter waits)
+        self.mode = 'ok'
+        self.lines = 0
+        self.requests = 0
+        self.connections = 0
+        self.lock = threading.Lock()
+
+
+class handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        return
+
+    def setup(self):
+        super().setup()
+        with self.server.stub.lock:
+            self.server.stub.connections += 1
+
+    def do_POST(self):
+        stub = self.server.stub
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if stub.mode == 'hang':
+            time.sleep(10)
+        if stub.mode != 'ok':
+            self.send_response(503)
+            self.send_header('Content-Length', 0)
+            self.end_headers()
+            return
+        lines = body.decode('utf-8').split('\n')
+        with stub.lock:
+            stub.requests += 1
+            stub.lines += len(lines)
+        if not stub.quiet:
+            print('%s: %d lines, like %s' % (self.path, len(lines), lines[0]))
+        self.send_response(204)
+        self.send_header('Content-Length', 0)
+        self.end_headers()
+
+
+class Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+def exercise(server, stub):
+    settings = {'secondsBetweenMetrics': 0.5}
+    metrics = Metrics(2000, {'host': 'stub-test'})
+    exporter = InfluxExporter(metrics, 'http://127.0.0.1:%d/write?db=cube' % server.server_address[1], settings, maxBatch=500, maxBackoff=4)
+    phases = [('ok', 5), ('fail', 8), ('hang', 6), ('ok', 10)]
+    t = 0
+    for mode, seconds in phases:
+        stub.mode = mode
+        print('Stub is %s for %d seconds' % ({'ok': 'up', 'fail': 'returning 503', 'hang': 'not responding'}[mode], seconds))
+        end = time.time() + seconds
+        while time.time() < end:
+            # About what main.py produces, but 20 times as often
+            for i in range(40):
+                metrics.gauge('test_gauge', t, series=i)
+            metrics.count('http_requests', route='/', status=200)
+            metrics.sample()
+            t += 1
+            time.sleep(0.1)
+        print('  sampled %d lines so far, stub received %d in %d requests over %d connections. Pending %d, dropped %d, exporter %s' % (
+            t * 41, stub.lines, stub.requests, stub.connections, len(metrics.points), metrics.droppedPoints, exporter.stats()))
+    exporter.done()
+    exporter.join()
+    print('After the final flush: stub received %d of %d lines, %d dropped while the stub was away' % (stub.lines, t * 41, metrics.droppedPoints))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fake InfluxDB /write endpoint for testing metrics')
+    parser.add_argument('--port', type=int, default=0, help='Defaults to any free port')
+    parser.add_argument('--exercise', action='store_true', help='Run the metrics exporter against the stub and report')
+    args = parser.parse_args()
+    # So we see what the exporter logs
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    stub = Stub(quiet=args.exercise)
+    server = Server(('127.0.0.1' if args.exercise else '0.0.0.0', args.port), handler)
+    server.stub = stub
+    if args.exercise:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        exercise(server, stub)
+        return
+    print('Listening on port %d' % server.server_address[1])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+# Pretends to be a bunch of camera nodes on this machine, so hub.py can be tried out without any Pis.
+# Each simulated node sends heartbeats like main.py does and serves /stream.mjpeg on its own port. For example:
+#
+# python3 hub.py &
+# python3 tools/simulate-nodes.py --nodes 50 --viewers 3
+#
+# With --viewers, every camera is also watched that many times through the hub, and we report the frame rate viewers
+# get along with how many stream connections each node has. Should be one per node, however many viewers there are.
+# --stop N stops heartbeats from N nodes after 20 seconds, so you can watch the hub mark them offline.
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import sys
+import urllib.parse
+import urllib.request
+
+import cv2
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from heartbeats import packHeartbeat
+
+
+class SimulatedNode:
+    def __init__(self, index, port, fps):
+        self.name = 'sim-%02d' % index
+        self.port = port
+        self.fps = fps
+        self.sequence = 0
+        self.beating = True
+        self.motion = False
+        self.connections = 0
+        self.framesServed = 0
+        # A few frames to cycle through, so we're not JPEG encoding on every send
+        self.frames = []
+        for i in range(fps):
+            image = numpy.full( (180, 320, 3), (40 + index * 37 % 160, 60, 90), dtype=numpy.uint8)
+            cv2.putText(image, self.name, (10, 40), cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 255, 255), 2)
+            cv2.rectangle(image, (i * 300 // fps, 120), (i * 300 // fps + 20, 140), (255, 255, 255), -1)
+            self.frames.append(cv2.imencode('.jpg', image)[1].tobytes())
+
+    async def handle(self, reader, writer):
+        streaming = False
+        try:
+            request = await reader.readline()
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+            if not request.startswith(b'GET /stream.mjpeg'):
+                writer.write(b'HTTP/1.0 404 Not Found\r\n\r\n')
+                return
+            self.connections += 1
+            streaming = True
+            writer.write(b'HTTP/1.0 200 OK\r\nContent-Type: multipart/x-mixed-replace; boundary=FRAME\r\n\r\n')
+            i = 0
+            while True:
+                frame = self.frames[i % len(self.frames)]
+                writer.write(b'--FRAME\r\nContent-Type: image/jpeg\r\nContent-Length: %d\r\n\r\n' % len(frame) + frame + b'\r\n')
+                await writer.drain()
+                self.framesServed += 1
+                i += 1
+                await asyncio.sleep(1 / self.fps)
+        except (OSError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            if streaming:
+                self.connections -= 1
+            writer.close()
+
+    def heartbeat(self):
+        # Flip motion on and off now and then, so the grid has something to show
+        if random.random() < 0.1:
+            self.motion = not self.motion
+        payload = packHeartbeat(self.name, self.sequence, self.port, self.fps, self.motion, self.motion, 45 + random.random() * 10, 20000)
+        self.sequence += 1
+        return payload
+
+
+async def beat(nodes, hub, port):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setblocking(False)
+    while True:
+        for node in nodes:
+            if node.beating:
+                sock.sendto(node.heartbeat(), (hub, port))
+        await asyncio.sleep(2)
+
+
+async def watch(url, counts, key):
+    # One viewer of a hub stream. Counts the frames we get in counts[key]
+    url = urllib.parse.urlsplit(url)
+    while True:
+        try:
+            reader, writer = await asyncio.open_connection(url.hostname, url.port)
+            writer.write(b'GET %s HTTP/1.0\r\n\r\n' % url.path.encode('ascii'))
+            if b' 200 ' not in await reader.readline():
+                raise ValueError('Hub refused')
+            while True:
+                line = await reader.readline()
+                if not line:
+                    raise ValueError('Hub closed the stream')
+                if line.lower().startswith(b'content-length:'):
+                    length = int(line.split(b':')[1])
+                    await reader.readline()
+                    await reader.readexactly(length)
+                    counts[key] = counts.get(key, 0) + 1
+        except (OSError, ValueError, asyncio.IncompleteReadError):
+            # Probably the hub hasn't heard from this node yet
+            await asyncio.sleep(2)
+
+
+async def report(nodes, counts, args):
+    previous = 0
+    while True:
+        await asyncio.sleep(5)
+        received = sum(counts.values())
+        connections = [node.connections for node in nodes]
+        line = '%d nodes, %d stream connections to nodes (max %d per node)' % (len(nodes), sum(connections), max(connections))
+        if args.viewers:
+            line += ', viewers getting %.1f frames/s each' % ((received - previous) / 5 / (len(nodes) * args.viewers))
+        previous = received
+        try:
+            with urllib.request.urlopen('http://%s:%d/nodes.json' % (args.hub, args.hub_http_port), timeout=5) as response:
+                o = json.loads(response.read())
+            line += ', hub sees %d online' % sum(1 for node in o['nodes'] if node['online'])
+        except (OSError, ValueError):
+            line += ', hub not responding'
+        print(line)
+
+
+async def stop(nodes, count):
+    await asyncio.sleep(20)
+    for node in nodes[:count]:
+        print('Stopping heartbeats from %s' % node.name)
+        node.beating = False
+
+
+async def run(args):
+    nodes = [SimulatedNode(i + 1, args.port + i, args.fps) for i in range(args.nodes)]
+    for node in nodes:
+        await asyncio.start_server(node.handle, '127.0.0.1', node.port)
+    counts = {}
+    tasks = [beat(nodes, args.hub, args.heartbeat_port), report(nodes, counts, args), stop(nodes, args.stop)]
+    for node in nodes:
+        for i in range(args.viewers):
+            tasks.append(watch('http://%s:%d/cameras/%s/stream.mjpeg' % (args.hub, args.hub_http_port, node.name), counts, (node.name, i)))
+    print('Simulating %d nodes on ports %d-%d' % (len(nodes), args.port, args.port + len(nodes) - 1))
+    await asyncio.gather(*tasks)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulated camera nodes for trying out hub.py')
+    parser.add_argument('--nodes', type=int, default=50)
+    parser.add_argument('--fps', type=int, default=10, help='Frames per second each node streams')
+    parser.add_argument('--port', type=int, default=9000, help='The first node serves on this port, the next on port + 1, and so on')
+    parser.add_argument('--hub', default='127.0.0.1')
+    parser.add_argument('--heartbeat-port', type=int, default=5001)
+    parser.add_argument('--hub-http-port', type=int, default=8081)
+    parser.add_argument('--viewers', type=int, default=0, help='Streams to open through the hub for each camera')
+    parser.add_argument('--stop', type=int, default=0, help='Nodes that stop sending heartbeats after 20 seconds')
+    args = parser.parse_args()
+    try:
+        asyncio.run(run(args))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+# Checks that /still.jpeg never serves a torn frame, meaning one that's partly the previous capture and partly the next.
+# One thread stands in for the camera, filling FrameStore slots one row at a time, each frame with a single value.
+# Other threads read frames straight from the store, and clients fetch /still.jpeg from main.py's request handler.
+# Every frame they get should be one value throughout. For example:
+#
+# python3 tools/still-stress.py --seconds 20 --readers 4 --clients 4
+#
+# --broken makes the camera thread write over the frame readers are using, to show the test catches torn frames
+import argparse
+import http.client
+import os
+import socket
+import sys
+import threading
+import time
+
+import cv2
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import main
+from detection import FrameStore
+from metrics import Metrics
+
+
+class Results:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.checked = {'store': 0, 'http': 0}
+        self.torn = {'store': 0, 'http': 0}
+        self.errors = 0
+        self.example = None
+
+    def check(self, kind, image, tolerance):
+        # JPEG can move a flat image's value by a step or two, but only ever all of it at once
+        low, high = int(image.min()), int(image.max())
+        with self.lock:
+            self.checked[kind] += 1
+            if high - low > tolerance:
+                self.torn[kind] += 1
+                if self.example is None:
+                    self.example = '%s frame with values from %d to %d' % (kind, low, high)
+
+
+def capture(store, deadline, broken, frames):
+    # The camera. Fills a frame a row at a time and yields between rows, so a reader on the same slot would see both values
+    value = 0
+    while time.time() < deadline:
+        if broken:
+            slot = store.latest if store.latest is not None else 0
+        else:
+            slot = store.acquireWrite()
+            if slot is None:
+                time.sleep(0.001)
+                continue
+        value = (value + 37) % 256
+        frame = store.frames[slot]
+        for row in range(0, frame.shape[0], 16):
+            frame[row:row + 16] = value
+            time.sleep(0)
+        store.publish(slot)
+        frames[0] += 1
+
+def reader(store, deadline, results):
+    while time.time() < deadline:
+        acquired = store.acquire()
+        if acquired is None:
+            time.sleep(0.001)
+            continue
+        slot, frame, generation = acquired
+        try:
+            results.check('store', frame, 0)
+        finally:
+            store.release(slot)
+
+def client(port, deadline, results, index):
+    # Asks for a mix of full size and smaller variants, so the cache's resize path gets checked too
+    paths = ['/still.jpeg', '/still.jpeg?width=320', '/still.jpeg?width=640&quality=70']
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+    i = index
+    while time.time() < deadline:
+        try:
+            connection.request('GET', paths[i % len(paths)])
+            response = connection.getresponse()
+            body = response.read()
+            if response.status == 503:
+                # Nothing captured yet
+                time.sleep(0.01)
+                continue
+            if response.status != 200:
+                raise http.client.HTTPException('Got %d' % response.status)
+            image = cv2.imdecode(numpy.frombuffer(body, dtype=numpy.uint8), cv2.IMREAD_GRAYSCALE)
+            results.check('http', image, 4)
+        except (OSError, http.client.HTTPException):
+            with results.lock:
+                results.errors += 1
+            connection.close()
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+        i += 1
+
+
+def run():
+    parser = argparse.ArgumentParser(description='Checks that stills are never torn between two captures')
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--width', type=int, default=1920)
+    parser.add_argument('--height', type=int, default=1088)
+    parser.add_argument('--readers', type=int, default=4, help='Threads reading frames straight from the FrameStore')
+    parser.add_argument('--clients', type=int, default=4, help='Clients fetching /still.jpeg')
+    parser.add_argument('--broken', action='store_true', help='Write over the frame readers are using, which should fail')
+    args = parser.parse_args()
+
+    settings = dict(main.settings, width=args.width, height=args.height)
+    # Three slots, like the still store in luma mode
+    store = FrameStore(3, lambda: numpy.zeros( (args.height, args.width, 3), dtype=numpy.uint8))
+    # The request handler counts requests in main's metrics
+    main.metrics = Metrics(1000, {'host': socket.gethostname()})
+    httpd = main.PooledHTTPServer(('127.0.0.1', 0), main.requestHandler, args.clients)
+    httpd.still = main.StillCache(store, settings)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+
+    results = Results()
+    frames = [0]
+    deadline = time.time() + args.seconds
+    threads = [threading.Thread(target=capture, args=(store, deadline, args.broken, frames))]
+    threads += [threading.Thread(target=reader, args=(store, deadline, results)) for i in range(args.readers)]
+    threads += [threading.Thread(target=client, args=(httpd.server_address[1], deadline, results, i)) for i in range(args.clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    httpd.shutdown()
+
+    print('%d frames captured. Checked %d from the store and %d from /still.jpeg, %d request errors' % (
+        frames[0], results.checked['store'], results.checked['http'], results.errors))
+    torn = results.torn['store'] + results.torn['http']
+    if torn:
+        print('FAIL: %d torn frames (%d from the store, %d from /still.jpeg), like a %s' % (
+            torn, results.torn['store'], results.torn['http'], results.example))
+        return 1
+    if results.checked['store'] + results.checked['http'] == 0 or results.errors:
+        print('FAIL: nothing checked, or requests failed')
+        return 1
+    print('OK: no torn frames')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(run())